@@ -0,0 +1,200 @@
+"""
+Content-adaptive per-tile resolution for large-scene inference.
+
+Most tiles of a remote-sensing scene are homogeneous (water, forest,
+agriculture) and come out the same from a downscaled input. Every batch is
+first run at `low_scale` of its resolution; each tile is scored from the class
+scores of that coarse pass and only the tiles scoring above `threshold` are run
+again at full resolution. The other tiles keep the upsampled coarse prediction.
+
+Scores (higher = more in need of full resolution), averaged over the valid
+pixels of the tile at mask resolution:
+
+- "uncertainty": 1 - probability of the predicted class
+- "margin": 1 - (top-1 - top-2 probability)
+- "boundary": fraction of pixels on a class boundary
+
+The frozen ViT dominates the cost and grows with the number of patch tokens
+(quadratically in attention), so a coarse pass at 0.5 costs about a quarter of a
+full pass. `AdaptiveStats` counts the ViT FLOPs actually spent per tile.
+"""
+
+import torch
+import torch.nn.functional as F
+
+from padding import valid_mask, valid_sizes_from_mask
+from postprocess import boundary_mask, labels_from_semantic_logits, post_process_from_config, semantic_logits
+from tta import View, view_size
+
+CRITERIA = ("uncertainty", "margin", "boundary")
+
+
+def tile_scores(logits, criterion="uncertainty", valid=None):
+    """
+    Per-tile refinement score from the class scores of the coarse pass.
+
+    Args:
+        logits: (B, num_classes, h, w) scores from `semantic_logits`
+        criterion: One of CRITERIA
+        valid: Optional (B, h, w) bool mask of the real (non-padded) pixels
+
+    Returns:
+        (B,) float tensor
+    """
+    if criterion not in CRITERIA:
+        raise ValueError(f"adaptive_resolution.criterion must be in {CRITERIA}, got {criterion!r}")
+    if criterion == "boundary":
+        pixel_scores = boundary_mask(logits.argmax(dim=1)).float()
+    else:
+        probs = logits / logits.sum(dim=1, keepdim=True).clamp(min=1e-6)
+        if criterion == "uncertainty":
+            pixel_scores = 1 - probs.max(dim=1).values
+        else:
+            top2 = probs.topk(2, dim=1).values
+            pixel_scores = 1 - (top2[:, 0] - top2[:, 1])
+    if valid is None:
+        return pixel_scores.mean(dim=(1, 2))
+    valid = valid.to(pixel_scores.dtype)
+    return (pixel_scores * valid).sum(dim=(1, 2)) / valid.sum(dim=(1, 2)).clamp(min=1)
+
+
+def vit_flops(config, height, width, num_layers=None):
+    """
+    Forward FLOPs of the DINOv3 ViT for one image of (height, width) pixels.
+
+    Linear layers (QKV, output projection, MLP) and the two attention matmuls;
+    norms, RoPE and activations are negligible.
+    """
+    d = config.hidden_size
+    mlp = (3 if getattr(config, "use_gated_mlp", False) else 2) * d * config.intermediate_size
+    tokens = (-(-height // config.patch_size)) * (-(-width // config.patch_size)) + 1 + config.num_register_tokens
+    per_layer = 2 * tokens * (4 * d * d + mlp) + 4 * tokens * tokens * d
+    return (num_layers or config.num_hidden_layers) * per_layer
+
+
+class AdaptiveStats:
+    """
+    Tiles refined at full resolution and ViT FLOPs spent, against running every
+    tile at full resolution only.
+
+    Args:
+        vit_config: Config of the DINOv3 ViT
+        num_layers: ViT layers actually run (up to the deepest interaction layer)
+    """
+
+    def __init__(self, vit_config, num_layers=None):
+        self.vit_config = vit_config
+        self.num_layers = num_layers
+        self.tiles = 0
+        self.refined = 0
+        self.flops = 0.0
+        self.full_flops = 0.0
+
+    @classmethod
+    def from_model(cls, model):
+        """Stats for a Mask2FormerForUniversalSegmentation with a DINOv3AdapterBackbone."""
+        backbone = model.model.pixel_level_module.encoder
+        return cls(backbone.dinov3_backbone.model.config, max(backbone.adapter.interaction_indexes) + 1)
+
+    def update(self, valid_sizes, low_valid_sizes, refine):
+        """
+        Args:
+            valid_sizes: (B, 2) full-resolution sizes of the tiles
+            low_valid_sizes: (B, 2) sizes of the tiles in the coarse pass
+            refine: (B,) bool, tiles re-run at full resolution
+        """
+        for (height, width), (low_height, low_width), refined in zip(
+            valid_sizes.tolist(), low_valid_sizes.tolist(), refine.tolist()
+        ):
+            full = vit_flops(self.vit_config, height, width, self.num_layers)
+            self.flops += vit_flops(self.vit_config, low_height, low_width, self.num_layers)
+            self.flops += full if refined else 0.0
+            self.full_flops += full
+            self.tiles += 1
+            self.refined += int(refined)
+
+    def summary(self):
+        tiles = max(self.tiles, 1)
+        return {
+            "tiles": self.tiles,
+            "refined": self.refined,
+            "refined_fraction": self.refined / tiles,
+            "vit_gflops_per_tile": self.flops / tiles / 1e9,
+            "full_resolution_vit_gflops_per_tile": self.full_flops / tiles / 1e9,
+            "flops_fraction": self.flops / self.full_flops if self.full_flops else 0.0,
+        }
+
+    def print_summary(self):
+        summary = self.summary()
+        print(f"🔍 Adaptive resolution: {summary['refined']}/{summary['tiles']} tiles refined "
+              f"({summary['refined_fraction']:.1%}), ViT {summary['vit_gflops_per_tile']:.1f} GFLOPs/tile "
+              f"vs {summary['full_resolution_vit_gflops_per_tile']:.1f} at full resolution "
+              f"({summary['flops_fraction']:.1%})")
+
+
+@torch.no_grad()
+def coarse_pass(model, pixel_values, adaptive_cfg, post_cfg, pixel_mask=None):
+    """
+    Run a batch at `low_scale` and score its tiles.
+
+    Returns:
+        (labels, scores, valid_sizes, low_valid_sizes): (B, H, W) label maps upsampled to
+        the input resolution, (B,) tile scores, and the (B, 2) tile sizes at full and at
+        low resolution
+    """
+    batch_size, _, height, width = pixel_values.shape
+    low_size = view_size((height, width), View(adaptive_cfg.low_scale, None, 0), adaptive_cfg.size_multiple)
+    low_values = F.interpolate(pixel_values, size=low_size, mode="bilinear", align_corners=False)
+    low_mask = None
+    if pixel_mask is not None:
+        low_mask = F.interpolate(pixel_mask[:, None].float(), size=low_size, mode="nearest")[:, 0].long()
+
+    outputs = model(pixel_values=low_values, pixel_mask=low_mask)
+    logits = semantic_logits(outputs.class_queries_logits, outputs.masks_queries_logits)
+
+    full_sizes = torch.tensor([[height, width]] * batch_size)
+    low_sizes = torch.tensor([list(low_size)] * batch_size)
+    valid_sizes = valid_sizes_from_mask(pixel_mask)
+    low_valid_sizes = valid_sizes_from_mask(low_mask)
+    valid = None
+    if low_valid_sizes is not None:
+        valid = valid_mask(low_valid_sizes.to(logits.device), low_size, tuple(logits.shape[-2:]))
+
+    scores = tile_scores(logits, adaptive_cfg.criterion, valid)
+    labels = labels_from_semantic_logits(logits, (height, width), post_cfg.upsample, post_cfg.refine_boundaries)
+    return (
+        labels,
+        scores,
+        full_sizes if valid_sizes is None else valid_sizes.cpu(),
+        low_sizes if low_valid_sizes is None else low_valid_sizes.cpu(),
+    )
+
+
+@torch.no_grad()
+def adaptive_predict(model, pixel_values, adaptive_cfg, post_cfg, pixel_mask=None, stats=None):
+    """
+    Label maps from a coarse pass, with full-resolution passes for uncertain tiles only.
+
+    Args:
+        model: Mask2Former model
+        pixel_values: (B, 3, H, W) tensor on the model's device
+        adaptive_cfg: cfg.model.adaptive_resolution
+        post_cfg: cfg.model.post_processing
+        pixel_mask: Optional (B, H, W) padding mask of the batch (see padding.py)
+        stats: Optional AdaptiveStats updated with this batch
+
+    Returns:
+        (B, H, W) tensor of class ids at input resolution
+    """
+    labels, scores, valid_sizes, low_valid_sizes = coarse_pass(model, pixel_values, adaptive_cfg, post_cfg, pixel_mask)
+    refine = scores > adaptive_cfg.threshold
+    if refine.any():
+        indices = refine.nonzero().flatten()
+        outputs = model(
+            pixel_values=pixel_values[indices],
+            pixel_mask=None if pixel_mask is None else pixel_mask[indices.to(pixel_mask.device)],
+        )
+        labels[indices] = post_process_from_config(outputs, tuple(pixel_values.shape[-2:]), post_cfg)
+    if stats is not None:
+        stats.update(valid_sizes, low_valid_sizes, refine.cpu())
+    return labels
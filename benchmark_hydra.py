@@ -0,0 +1,301 @@
+import json
+import os
+import time
+import numpy as np
+import torch
+import hydra
+from hydra.utils import to_absolute_path
+from omegaconf import DictConfig, OmegaConf
+from torch.utils.data import DataLoader, Subset
+
+from data import LoveDADataset, collate_fn
+from padding import pad_batch
+from eval_pipeline import MetricAccumulator
+from evaluate_hydra import create_metrics, metric_names
+from inference import create_processor, load_model
+from postprocess import post_process_from_config
+from precision import benchmark_policies, print_policy_benchmark
+from serve_hydra import resolve_device
+
+
+def synchronize(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def benchmark_batches(cfg, processor):
+    """
+    Batches to benchmark: the first `num_batches` batches of LoveDA Val (labels
+    included, so mIoU is measured too) or random inputs of the configured size.
+
+    Returns:
+        (list of batches, has_labels)
+    """
+    bench_cfg = cfg.benchmark
+    batch_size = bench_cfg.batch_size
+    num_images = batch_size * (bench_cfg.num_batches + bench_cfg.warmup_batches)
+
+    if bench_cfg.data == "synthetic":
+        size = cfg.data.image_size
+        generator = torch.Generator().manual_seed(0)
+        batches = []
+        for _ in range(bench_cfg.num_batches + bench_cfg.warmup_batches):
+            # Padded to a multiple of 32 like the collate functions do
+            pixel_values, pixel_mask = pad_batch(list(torch.randn(batch_size, 3, size, size, generator=generator)))
+            batches.append({"pixel_values": pixel_values, "pixel_mask": pixel_mask})
+        return batches, False
+
+    val_dataset = LoveDADataset(os.path.join(cfg.data.dataset_root, "Val"), processor)
+    subset = Subset(val_dataset, range(min(num_images, len(val_dataset))))
+    loader = DataLoader(subset, batch_size=batch_size, shuffle=False,
+                        num_workers=cfg.data.num_workers, collate_fn=collate_fn)
+    # Materialize up front so data loading is not part of the measurement
+    return list(loader), True
+
+
+@torch.no_grad()
+def run_benchmark(cfg, model, batches, device, has_labels, forward_fn=None):
+    """
+    Time forward and post-processing per batch and, with labels, accumulate mIoU.
+
+    Args:
+        cfg: Hydra configuration
+        model: Mask2Former model in eval mode
+        batches: Batches from `benchmark_batches`
+        device: Device of the model
+        has_labels: Whether the batches carry mask/class labels
+        forward_fn: Optional (model, pixel_values, pixel_mask) -> outputs replacing
+            `model(pixel_values=..., pixel_mask=...)`
+
+    Returns:
+        dict of timing (and metric) results
+    """
+    forward_fn = forward_fn or (lambda m, pixel_values, pixel_mask: m(pixel_values=pixel_values, pixel_mask=pixel_mask))
+    warmup = cfg.benchmark.warmup_batches
+    accumulator = (
+        MetricAccumulator(create_metrics(cfg, device), cfg.model.num_classes, metric_names(cfg)) if has_labels else None
+    )
+
+    if device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+
+    forward_ms, post_ms, num_images = [], [], 0
+    for batch_idx, batch in enumerate(batches):
+        pixel_values = batch["pixel_values"].to(device)
+        pixel_mask = batch.get("pixel_mask")
+        synchronize(device)
+        start = time.perf_counter()
+        outputs = forward_fn(model, pixel_values, pixel_mask)
+        synchronize(device)
+        forward_end = time.perf_counter()
+        preds = post_process_from_config(outputs, tuple(pixel_values.shape[-2:]), cfg.model.post_processing)
+        synchronize(device)
+        end = time.perf_counter()
+
+        if batch_idx < warmup:
+            continue
+        forward_ms.append((forward_end - start) * 1000.0)
+        post_ms.append((end - forward_end) * 1000.0)
+        num_images += len(pixel_values)
+        if accumulator is not None:
+            accumulator.update((preds, batch))
+
+    total_s = (sum(forward_ms) + sum(post_ms)) / 1000.0
+    results = {
+        "images": num_images,
+        "images_per_s": num_images / total_s if total_s > 0 else 0.0,
+        "forward_ms_per_batch": {"mean": float(np.mean(forward_ms)), "p50": float(np.percentile(forward_ms, 50))},
+        "postprocess_ms_per_batch": {"mean": float(np.mean(post_ms)), "p50": float(np.percentile(post_ms, 50))},
+    }
+    if device.type == "cuda":
+        results["peak_memory_mb"] = torch.cuda.max_memory_allocated(device) / 2**20
+    if accumulator is not None:
+        results["metrics"] = accumulator.compute()
+    return results
+
+
+@torch.no_grad()
+def adapter_breakdown(model, batches, device, warmup=1, repeats=5):
+    """
+    Per-stage adapter timings under the sequential and concurrent schedules.
+
+    Stage times (ViT, SPM, interaction blocks, final fusion) come from the sequential
+    schedule, where the stages run one after another. The overlap achieved is the
+    wall-time saved by the concurrent schedule, out of the time that can overlap at
+    all (the shorter of the ViT and the SPM + interaction blocks).
+
+    Returns:
+        dict with the mean timings of each schedule and the overlap summary
+    """
+    adapter = model.model.pixel_level_module.encoder.adapter
+    pixel_values = batches[0]["pixel_values"].to(device)
+    pixel_mask = batches[0].get("pixel_mask")
+    original_schedule = adapter.schedule
+    timings = {}
+    try:
+        adapter.record_timings = True
+        for schedule in ("sequential", "concurrent"):
+            adapter.schedule = schedule
+            runs = []
+            for i in range(warmup + repeats):
+                model(pixel_values=pixel_values, pixel_mask=pixel_mask)
+                if i >= warmup:
+                    runs.append(adapter.timings)
+            timings[schedule] = {key: float(np.mean([run[key] for run in runs])) for key in runs[0]}
+    finally:
+        adapter.schedule = original_schedule
+        adapter.record_timings = False
+
+    sequential = timings["sequential"]
+    overlappable = min(sequential["vit_ms"], sequential["spm_ms"] + sequential["interactions_ms"])
+    saved = sequential["total_ms"] - timings["concurrent"]["total_ms"]
+    return {
+        "sequential": sequential,
+        "concurrent": timings["concurrent"],
+        "saved_ms": saved,
+        "overlappable_ms": overlappable,
+        "overlap_fraction": saved / overlappable if overlappable > 0 else 0.0,
+    }
+
+
+def print_adapter_breakdown(breakdown):
+    sequential = breakdown["sequential"]
+    print("  Adapter stages (sequential schedule, ms/batch):")
+    for stage in ("vit", "spm", "interactions", "fusion"):
+        print(f"    {stage:<14} {sequential[f'{stage}_ms']:8.1f}")
+    print(f"    {'total':<14} {sequential['total_ms']:8.1f}")
+    print(f"  Concurrent schedule total: {breakdown['concurrent']['total_ms']:.1f} ms/batch")
+    print(f"  Overlap achieved: {breakdown['saved_ms']:.1f} of {breakdown['overlappable_ms']:.1f} ms "
+          f"({breakdown['overlap_fraction'] * 100:.0f}%)")
+
+
+def training_step_benchmark(cfg, device):
+    """
+    Training-step time and memory under every precision setting of `benchmark.training_step`.
+
+    Uses a new model (untrained heads) with the `training.checkpointing` groups ("auto"
+    benchmarks without checkpointing) at the padded training resolution.
+    """
+    # Imported here like in inference.load_model: Lightning is only needed for this part
+    from train_hydra import SegmentationLightningModule
+
+    step_cfg = cfg.benchmark.training_step
+    model = SegmentationLightningModule(cfg).model
+    settings = [(policy, frozen) for policy in step_cfg.policies for frozen in step_cfg.frozen_backbone]
+    image_size = -(-cfg.data.image_size // 32) * 32
+    return benchmark_policies(
+        model, settings, image_size, cfg.benchmark.batch_size, device, step_cfg.steps, step_cfg.warmup_steps
+    )
+
+
+def print_results(label, results):
+    print(f"  {label}")
+    print(f"    Throughput:      {results['images_per_s']:.2f} images/s ({results['images']} images)")
+    print(f"    Forward:         {results['forward_ms_per_batch']['mean']:.1f} ms/batch")
+    print(f"    Post-processing: {results['postprocess_ms_per_batch']['mean']:.1f} ms/batch")
+    if "peak_memory_mb" in results:
+        print(f"    Peak memory:     {results['peak_memory_mb']:.0f} MB")
+    for name, score in results.get("metrics", {}).items():
+        print(f"    {name}: {score:.4f}")
+
+
+def cpu_mode_label(cpu_cfg):
+    """Short description of the CPU inference mode, e.g. "channels_last+fold_bn" or "off"."""
+    if not cpu_cfg.enabled:
+        return "off"
+    parts = [name for name, on in (("channels_last", cpu_cfg.channels_last), ("fold_bn", cpu_cfg.fold_batch_norm)) if on]
+    return "+".join(parts) or "threads_only"
+
+
+def save_results(cfg, record):
+    """Write benchmark_results.json in the run directory and optionally append to a shared JSONL."""
+    with open(cfg.benchmark.output, "w") as f:
+        json.dump(record, f, indent=2, default=str)
+    print(f"📄 Results saved to: {os.path.abspath(cfg.benchmark.output)}")
+    if cfg.benchmark.append_to:
+        path = to_absolute_path(cfg.benchmark.append_to)
+        with open(path, "a") as f:
+            f.write(json.dumps({k: v for k, v in record.items() if k != "config_used"}, default=str) + "\n")
+        print(f"📄 Appended to: {path}")
+
+
+@hydra.main(version_base="1.3", config_path="conf", config_name="config")
+def main(cfg: DictConfig) -> None:
+    """
+    Measure inference throughput (and mIoU on a LoveDA Val subset) of a model configuration.
+
+    Usage:
+        python benchmark_hydra.py checkpoint_path=/path/to/checkpoint.ckpt
+        python benchmark_hydra.py benchmark.data=synthetic               # speed only, untrained heads
+        # Query-count trade-off (one checkpoint per query count, trained with that model.num_queries)
+        python benchmark_hydra.py -m model.num_queries=100,50,20 benchmark.data=synthetic \\
+            benchmark.append_to=queries.jsonl
+        # CPU inference mode: images/s per configuration
+        python benchmark_hydra.py -m benchmark.device=cpu benchmark.data=synthetic \\
+            model.cpu_inference.enabled=false,true model.cpu_inference.channels_last=true,false \\
+            benchmark.append_to=cpu.jsonl
+        # Training-step time and memory per mixed-precision policy
+        python benchmark_hydra.py benchmark.data=synthetic benchmark.adapter_breakdown=false \\
+            benchmark.training_step.policies=[fp32,bf16-mixed,fp16-mixed]
+    """
+    checkpoint_path = getattr(cfg, 'checkpoint_path', None)
+    if checkpoint_path is not None and not os.path.exists(checkpoint_path):
+        print(f"❌ Error: Checkpoint not found: {checkpoint_path}")
+        return
+
+    device = resolve_device(cfg.benchmark.device)
+    torch.set_float32_matmul_precision(cfg.training.precision)
+
+    print("⏱️  DINOv3+Mask2Former Benchmark")
+    print("=" * 60)
+    print(f"📂 Checkpoint: {checkpoint_path or 'none (untrained heads)'}")
+    print(f"🖥️  Device: {device}")
+    print(f"📐 Input size: {cfg.data.image_size}×{cfg.data.image_size}, batch size {cfg.benchmark.batch_size}")
+    print(f"📊 Data: {cfg.benchmark.data} ({cfg.benchmark.num_batches} batches + {cfg.benchmark.warmup_batches} warm-up)")
+    print("=" * 60)
+
+    processor = create_processor(cfg)
+    model = load_model(cfg, checkpoint_path, device)
+    batches, has_labels = benchmark_batches(cfg, processor)
+    if has_labels and checkpoint_path is None:
+        print("⚠️  mIoU of untrained heads is not meaningful")
+
+    results = run_benchmark(cfg, model, batches, device, has_labels)
+
+    settings = {
+        "num_queries": model.config.num_queries,
+        "decoder_depth": len(model.model.transformer_module.decoder.layers),
+        "adapter_schedule": model.model.pixel_level_module.encoder.adapter.schedule,
+        "token_merging": cfg.model.token_merging,
+        "cpu_inference": cpu_mode_label(cfg.model.cpu_inference) if device.type == "cpu" else None,
+        "threads": torch.get_num_threads(),
+        "image_size": cfg.data.image_size,
+        "batch_size": cfg.benchmark.batch_size,
+        "device": str(device),
+    }
+    print("\n🏁 BENCHMARK RESULTS")
+    print("-" * 60)
+    print_results(", ".join(f"{k}={v}" for k, v in settings.items()), results)
+    if cfg.benchmark.adapter_breakdown:
+        results["adapter_breakdown"] = adapter_breakdown(model, batches, device)
+        print_adapter_breakdown(results["adapter_breakdown"])
+    if cfg.benchmark.training_step.policies:
+        # The inference model would count in the training-step peak memory
+        del model
+        print(f"🎚️  Training step by precision policy ({cfg.benchmark.batch_size} images per step):")
+        results["training_step"] = training_step_benchmark(cfg, device)
+        print_policy_benchmark(results["training_step"])
+    print("-" * 60)
+
+    save_results(cfg, {
+        "model": cfg.model.name,
+        "checkpoint_path": checkpoint_path,
+        "data": cfg.benchmark.data,
+        "settings": settings,
+        "results": results,
+        "config_used": OmegaConf.to_yaml(cfg),
+    })
+
+
+if __name__ == "__main__":
+    main()
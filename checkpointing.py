@@ -0,0 +1,312 @@
+"""
+Activation checkpointing policy and memory planner for training.
+
+A policy is a set of module groups whose activations are recomputed in the
+backward pass instead of being kept from the forward:
+
+- "extractors": the deformable-attention Extractors of the adapter (`with_cp`),
+- "spm": the SpatialPriorModule convolution stack,
+- "pixel_decoder": the deformable encoder layers of the pixel decoder,
+- "decoder": the masked-attention transformer decoder layers.
+
+`set_checkpointing` applies a policy to a model. `measure_activations` runs one
+training-mode forward and records, in forward order, the bytes of the tensors
+saved for backward (through `torch.autograd.graph.saved_tensors_hooks`, so it
+works on any device) of every group call and in between, the bytes of the call
+inputs (all a checkpointed call keeps) and its forward time (the recompute
+cost). `plan_checkpointing` then estimates peak memory and recompute time of
+every policy and picks the cheapest one that fits a budget.
+
+The estimate covers weights, gradients, AdamW moments and the activations of
+the model forward; the loss (sampled points) and allocator fragmentation are
+not included, so leave some headroom in the budget.
+"""
+
+import itertools
+import os
+import time
+from functools import partial
+
+import torch
+import torch.utils.checkpoint as cp
+
+from models.backbone.dinov3_adapter import Extractor
+
+CHECKPOINT_GROUPS = ("extractors", "spm", "pixel_decoder", "decoder")
+
+
+def checkpoint_groups(model):
+    """{group: [modules]} of a Mask2Former model with a DINOv3AdapterBackbone."""
+    adapter = model.model.pixel_level_module.encoder.adapter
+    return {
+        "extractors": [module for module in adapter.modules() if isinstance(module, Extractor)],
+        "spm": [adapter.spm],
+        "pixel_decoder": list(model.model.pixel_level_module.decoder.encoder.layers),
+        "decoder": list(model.model.transformer_module.decoder.layers),
+    }
+
+
+def _checkpointed_forward(layer, *args, **kwargs):
+    """Instance forward of a checkpointed HF layer (module-level, so the layer can still be pickled)."""
+    forward = type(layer).forward
+    if layer.training and torch.is_grad_enabled():
+        return cp.checkpoint(forward, layer, *args, use_reentrant=False, **kwargs)
+    return forward(layer, *args, **kwargs)
+
+
+def set_checkpointing(model, groups):
+    """
+    Checkpoint exactly the module groups in `groups` (see CHECKPOINT_GROUPS; empty = none).
+
+    The adapter modules use their own `with_cp` flag; the HF decoder layers get an
+    instance-level forward that wraps the class forward in `torch.utils.checkpoint`.
+    Parameters and state_dict keys are unchanged.
+    """
+    groups = set(groups)
+    unknown = groups - set(CHECKPOINT_GROUPS)
+    if unknown:
+        raise ValueError(f"Unknown checkpointing groups {sorted(unknown)}, expected a subset of {CHECKPOINT_GROUPS}")
+    for group, modules in checkpoint_groups(model).items():
+        enabled = group in groups
+        for module in modules:
+            if group in ("extractors", "spm"):
+                module.with_cp = enabled
+            elif enabled:
+                module.forward = partial(_checkpointed_forward, module)
+            else:
+                module.__dict__.pop("forward", None)
+    return model
+
+
+def checkpointed_groups(model):
+    """Groups currently checkpointed in `model`."""
+    groups = []
+    for group, modules in checkpoint_groups(model).items():
+        if group in ("extractors", "spm"):
+            enabled = all(module.with_cp for module in modules)
+        else:
+            enabled = all("forward" in module.__dict__ for module in modules)
+        if modules and enabled:
+            groups.append(group)
+    return groups
+
+
+def frozen_vit(model):
+    """The frozen ViT (`encoder.vit`, the model inside the adapter's DINOv3CompatibilityWrapper)."""
+    return model.model.pixel_level_module.encoder.vit
+
+
+def _synchronize(device):
+    if torch.device(device).type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def _tensor_bytes(values):
+    storages = {}
+    for value in values:
+        if isinstance(value, torch.Tensor):
+            storage = value.untyped_storage()
+            storages[storage.data_ptr()] = storage.nbytes()
+    return sum(storages.values())
+
+
+def measure_activations(model, image_size, batch_size=1, device="cpu"):
+    """
+    Timeline of the saved activations of one training-mode forward, split at the checkpointing groups.
+
+    Runs the forward without checkpointing on random images; the policy, schedule,
+    train/eval mode and BatchNorm statistics are restored afterwards.
+
+    Returns:
+        dict with the measured "batch_size" and the "timeline": in forward order, one entry
+        per group call ({"group", "saved_bytes", "input_bytes", "seconds"}) and one entry
+        (group None) for the activations saved between them
+    """
+    device = torch.device(device)
+    model.to(device)
+    adapter = model.model.pixel_level_module.encoder.adapter
+    policy, schedule, training = checkpointed_groups(model), adapter.schedule, model.training
+    buffers = [buffer.clone() for buffer in model.buffers()]
+    set_checkpointing(model, [])
+    # One thread, so the forward times are the recompute costs
+    adapter.schedule = "sequential"
+    model.train()
+
+    owners = {}
+    for group, modules in checkpoint_groups(model).items():
+        for module in modules:
+            owners[module] = group
+    seen = {p.untyped_storage().data_ptr() for p in model.parameters()}
+    timeline, calls = [], []
+
+    def pack(tensor):
+        storage = tensor.untyped_storage()
+        if storage.data_ptr() not in seen:
+            seen.add(storage.data_ptr())
+            if calls:
+                calls[-1]["saved_bytes"] += storage.nbytes()
+            else:
+                if not timeline or timeline[-1]["group"] is not None:
+                    timeline.append({"group": None, "saved_bytes": 0, "input_bytes": 0, "seconds": 0.0})
+                timeline[-1]["saved_bytes"] += storage.nbytes()
+        return tensor
+
+    def pre_hook(module, args, kwargs):
+        _synchronize(device)
+        calls.append({
+            "group": owners[module],
+            "saved_bytes": 0,
+            "input_bytes": _tensor_bytes([*args, *kwargs.values()]),
+            "seconds": time.perf_counter(),
+        })
+
+    def post_hook(module, args, kwargs, output):
+        _synchronize(device)
+        call = calls.pop()
+        call["seconds"] = time.perf_counter() - call["seconds"]
+        if calls:
+            # Nested call: its activations belong to the enclosing group
+            calls[-1]["saved_bytes"] += call["saved_bytes"]
+        else:
+            timeline.append(call)
+
+    handles = []
+    for module in owners:
+        handles.append(module.register_forward_pre_hook(pre_hook, with_kwargs=True))
+        handles.append(module.register_forward_hook(post_hook, with_kwargs=True))
+    try:
+        pixel_values = torch.randn(batch_size, 3, image_size, image_size, device=device)
+        with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+            outputs = model(pixel_values=pixel_values)
+        del outputs
+    finally:
+        for handle in handles:
+            handle.remove()
+        with torch.no_grad():
+            for buffer, saved in zip(model.buffers(), buffers):
+                buffer.copy_(saved)
+        set_checkpointing(model, policy)
+        adapter.schedule = schedule
+        model.train(training)
+    return {"timeline": timeline, "batch_size": batch_size}
+
+
+def group_summary(measurement):
+    """{group: {"saved_bytes", "input_bytes", "seconds", "calls"}} per measured image."""
+    summary = {group: {"saved_bytes": 0, "input_bytes": 0, "seconds": 0.0, "calls": 0} for group in CHECKPOINT_GROUPS}
+    for entry in measurement["timeline"]:
+        if entry["group"] is not None:
+            stats = summary[entry["group"]]
+            for key in ("saved_bytes", "input_bytes", "seconds"):
+                stats[key] += entry[key] / measurement["batch_size"]
+            stats["calls"] += 1
+    return summary
+
+
+def static_bytes(model):
+    """Weights (including the frozen ViT), gradients and AdamW moments of the trainable parameters."""
+    weights = sum(p.numel() * p.element_size() for p in model.parameters())
+    trainable = sum(p.numel() * p.element_size() for p in model.parameters() if p.requires_grad)
+    return weights + 3 * trainable
+
+
+def estimate_policy(measurement, groups, batch_size):
+    """
+    (peak activation bytes, recompute seconds) of checkpointing `groups` at `batch_size`.
+
+    A checkpointed call keeps only its inputs. The backward pass recomputes the calls in
+    reverse order, when everything after them has been freed: the peak is the larger of
+    all kept activations and, for every recomputed call, what is kept before it plus its
+    own activations.
+    """
+    scale = batch_size / measurement["batch_size"]
+    peak = kept = recompute = 0.0
+    for entry in measurement["timeline"]:
+        if entry["group"] in groups:
+            peak = max(peak, kept + entry["input_bytes"] + entry["saved_bytes"])
+            kept += entry["input_bytes"]
+            recompute += entry["seconds"]
+        else:
+            kept += entry["saved_bytes"]
+    return max(peak, kept) * scale, recompute * scale
+
+
+def device_memory_bytes(device):
+    """Total memory of a CUDA device, or the physical memory of the host."""
+    device = torch.device(device)
+    if device.type == "cuda":
+        return torch.cuda.get_device_properties(device).total_memory
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+
+def plan_checkpointing(model, image_size, batch_size, memory_budget_mb=None, device="cpu", probe_batch_size=1):
+    """
+    Pick the checkpointing policy with the least recompute time that fits a memory budget.
+
+    Activations are measured at `probe_batch_size` (1 fits where the real batch may not)
+    and scaled linearly to `batch_size`.
+
+    Args:
+        model: Mask2FormerForUniversalSegmentation with a DINOv3AdapterBackbone
+        image_size: Training resolution (square)
+        batch_size: Images per optimizer micro-batch
+        memory_budget_mb: Budget for weights, optimizer state and activations; None uses
+            the whole device (`device_memory_bytes`)
+        device: Device to measure on
+        probe_batch_size: Batch size of the measured forward
+
+    Returns:
+        dict with the chosen "groups", whether it "fits", its estimated memory and
+        recompute time, the budget, the per-group measurement and every candidate
+    """
+    budget = (memory_budget_mb * 2**20) if memory_budget_mb is not None else device_memory_bytes(device)
+    measurement = measure_activations(model, image_size, probe_batch_size, device)
+    static = static_bytes(model)
+    candidates = []
+    for size in range(len(CHECKPOINT_GROUPS) + 1):
+        for groups in itertools.combinations(CHECKPOINT_GROUPS, size):
+            activations, recompute = estimate_policy(measurement, groups, batch_size)
+            candidates.append({
+                "groups": list(groups),
+                "activation_mb": activations / 2**20,
+                "total_mb": (static + activations) / 2**20,
+                "recompute_s": recompute,
+                "fits": static + activations <= budget,
+            })
+    candidates.sort(key=lambda c: (c["recompute_s"], c["total_mb"]))
+    fitting = [c for c in candidates if c["fits"]]
+    # Nothing fits: take the policy with the least memory and let the caller decide
+    chosen = fitting[0] if fitting else min(candidates, key=lambda c: c["total_mb"])
+    return {
+        "groups": chosen["groups"],
+        "fits": chosen["fits"],
+        "total_mb": chosen["total_mb"],
+        "recompute_s": chosen["recompute_s"],
+        "budget_mb": budget / 2**20,
+        "static_mb": static / 2**20,
+        "image_size": image_size,
+        "batch_size": batch_size,
+        "measured": {
+            group: {
+                "saved_mb": stats["saved_bytes"] / 2**20,
+                "input_mb": stats["input_bytes"] / 2**20,
+                "forward_s": stats["seconds"],
+                "calls": stats["calls"],
+            }
+            for group, stats in group_summary(measurement).items()
+        },
+        "candidates": candidates,
+    }
+
+
+def print_plan(plan):
+    """Per-group measurement and chosen policy of `plan_checkpointing`."""
+    print(f"🧮 Checkpointing plan for {plan['batch_size']}×{plan['image_size']}² "
+          f"(budget {plan['budget_mb']:.0f} MB, weights + optimizer state {plan['static_mb']:.0f} MB)")
+    for group, stats in plan["measured"].items():
+        print(f"   {group:<14} {stats['saved_mb']:9.1f} MB saved/image, {stats['input_mb']:7.1f} MB inputs, "
+              f"{stats['forward_s'] * 1000:8.1f} ms forward/image ({stats['calls']} calls)")
+    status = "✅" if plan["fits"] else "⚠️ "
+    print(f"   {status} Policy {plan['groups'] or ['none']}: ~{plan['total_mb']:.0f} MB, "
+          f"~{plan['recompute_s'] * 1000:.0f} ms recompute per step"
+          + ("" if plan["fits"] else " (no policy fits the budget, lower the batch size)"))
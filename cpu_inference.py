@@ -0,0 +1,172 @@
+"""
+CPU inference mode: channels-last convolutions, folded BatchNorms and thread settings.
+
+On CPU the adapter and pixel decoder are dominated by convolutions (SPM, `DWConv`
+of every ConvFFN, the `up` transposed convolution, the pixel-decoder projections),
+which oneDNN runs fastest in channels-last layout. `optimize_for_cpu` prepares an
+eval-mode model:
+
+- the convolution weights and the feature maps the adapter builds from tokens
+  are converted to torch.channels_last; (B, N, C) tokens already are channels-last
+  (B, C, H, W) maps, so `DWConv` no longer transposes them,
+- every Conv + BatchNorm pair of the SpatialPriorModule becomes one convolution,
+- `norm2..norm4` (and `norm1` with the reference fusion) are folded into the 1x1
+  channel projections that follow them. The other fusions already apply `norm1`
+  as an affine map inside the stride-4 fusion at inference. A level without a
+  projection (nn.Identity, width = ViT embedding dim, e.g. the 1024 channels of
+  stride 32 by default) keeps its norm.
+
+The folding replaces the BatchNorms by nn.Identity: the model is for inference only
+afterwards. The frozen ViT is left as is (its only convolution is the patch
+embedding). `configure_threads` sets intra-/inter-op threads and pins the process
+to a set of cores.
+"""
+
+import os
+
+import torch
+import torch.nn as nn
+
+from models.backbone.dinov3_adapter import DWConv
+
+
+def fold_batch_norm(conv, norm):
+    """Convolution equal to norm(conv(x)) for an eval-mode BatchNorm."""
+    scale = norm.weight / torch.sqrt(norm.running_var + norm.eps)
+    shift = norm.bias - norm.running_mean * scale
+    folded = nn.Conv2d(
+        conv.in_channels, conv.out_channels, conv.kernel_size, conv.stride, conv.padding,
+        conv.dilation, conv.groups, bias=True,
+    ).to(conv.weight.device, conv.weight.dtype)
+    bias = conv.bias if conv.bias is not None else torch.zeros_like(shift)
+    with torch.no_grad():
+        folded.weight.copy_(conv.weight * scale[:, None, None, None])
+        folded.bias.copy_(bias * scale + shift)
+    return folded
+
+
+def fold_batch_norm_into_projection(norm, projection):
+    """1x1 convolution equal to projection(norm(x)) for an eval-mode BatchNorm."""
+    if projection.kernel_size != (1, 1) or projection.padding != (0, 0):
+        raise ValueError("only a 1x1 convolution without padding can absorb a preceding BatchNorm")
+    scale = norm.weight / torch.sqrt(norm.running_var + norm.eps)
+    shift = norm.bias - norm.running_mean * scale
+    folded = nn.Conv2d(projection.in_channels, projection.out_channels, 1).to(
+        projection.weight.device, projection.weight.dtype
+    )
+    weight = projection.weight.flatten(1)
+    with torch.no_grad():
+        folded.weight.copy_((weight * scale)[:, :, None, None])
+        folded.bias.copy_(projection.bias + weight @ shift)
+    return folded
+
+
+def fold_spm_batch_norms(spm):
+    """Merge every Conv2d + BatchNorm pair of a SpatialPriorModule; returns the number folded."""
+    folded = 0
+    for stage in (spm.stem, spm.conv2, spm.conv3, spm.conv4):
+        for i in range(len(stage) - 1):
+            if isinstance(stage[i], nn.Conv2d) and isinstance(stage[i + 1], nn.modules.batchnorm._BatchNorm):
+                # Identity keeps the layer indices (and the ReLU positions the padding mask relies on)
+                stage[i] = fold_batch_norm(stage[i], stage[i + 1])
+                stage[i + 1] = nn.Identity()
+                folded += 1
+    return folded
+
+
+def fold_output_norms(backbone):
+    """
+    Fold the adapter output norms into the channel projections of a DINOv3AdapterBackbone.
+
+    Returns:
+        Names of the folded norms
+    """
+    adapter = backbone.adapter
+    levels = [("norm2", 1), ("norm3", 2), ("norm4", 3)]
+    if adapter.fusion == "reference":
+        levels.insert(0, ("norm1", 0))
+    folded = []
+    for name, level in levels:
+        norm = getattr(adapter, name)
+        if isinstance(norm, nn.Identity) or isinstance(backbone.projections[level], nn.Identity):
+            continue
+        backbone.projections[level] = fold_batch_norm_into_projection(norm, backbone.projections[level])
+        setattr(adapter, name, nn.Identity())
+        folded.append(name)
+    return folded
+
+
+def optimize_for_cpu(model, cpu_cfg):
+    """
+    Apply the CPU inference mode to an eval-mode Mask2Former model (in place).
+
+    Args:
+        model: Mask2FormerForUniversalSegmentation with a DINOv3AdapterBackbone
+        cpu_cfg: cfg.model.cpu_inference
+
+    Returns:
+        dict describing what was applied
+    """
+    if model.training:
+        raise ValueError("optimize_for_cpu folds BatchNorms and needs a model in eval mode")
+    backbone = model.model.pixel_level_module.encoder
+    applied = {"folded_batch_norms": 0, "folded_output_norms": [], "channels_last": False}
+    if cpu_cfg.fold_batch_norm:
+        applied["folded_batch_norms"] = fold_spm_batch_norms(backbone.adapter.spm)
+        applied["folded_output_norms"] = fold_output_norms(backbone)
+    if cpu_cfg.channels_last:
+        model.to(memory_format=torch.channels_last)
+        for module in backbone.adapter.modules():
+            if isinstance(module, DWConv):
+                module.memory_format = torch.channels_last
+        backbone.adapter.memory_format = torch.channels_last
+        applied["channels_last"] = True
+    return applied
+
+
+def parse_cores(cores):
+    """Core ids from a list, a single id or a string like "0-7,16-23"."""
+    if cores is None:
+        return None
+    if isinstance(cores, int):
+        return [cores]
+    if isinstance(cores, str):
+        ids = []
+        for part in cores.split(","):
+            start, _, end = part.strip().partition("-")
+            ids.extend(range(int(start), int(end or start) + 1))
+        return ids
+    return [int(core) for core in cores]
+
+
+def configure_threads(intra_op_threads=None, inter_op_threads=None, cores=None):
+    """
+    Pin the process to `cores` and set the intra-/inter-op thread counts.
+
+    Intra-op threads default to the number of pinned cores. The inter-op count can
+    only be set before the first inter-op parallel work, otherwise it is left as is.
+
+    Returns:
+        dict with the resulting settings
+    """
+    cores = parse_cores(cores)
+    if cores is not None:
+        if hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, cores)
+        else:
+            print("⚠️  Core pinning needs os.sched_setaffinity (Linux); ignoring model.cpu_inference.cores")
+            cores = None
+    intra_op_threads = intra_op_threads or (len(cores) if cores is not None else None)
+    if intra_op_threads:
+        torch.set_num_threads(intra_op_threads)
+    if inter_op_threads and inter_op_threads != torch.get_num_interop_threads():
+        try:
+            torch.set_num_interop_threads(inter_op_threads)
+        except RuntimeError:
+            print("⚠️  Inter-op threads can only be set before any parallel work; keeping "
+                  f"{torch.get_num_interop_threads()}")
+    return {
+        "intra_op_threads": torch.get_num_threads(),
+        "inter_op_threads": torch.get_num_interop_threads(),
+        "cores": sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else None,
+    }
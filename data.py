@@ -3,22 +3,106 @@ from PIL import Image
 import torch
 from torch.utils.data import Dataset, DataLoader
 
+from padding import pad_batch, pad_masks
+
 
 def collate_fn(batch):
     """
     Custom collate function to handle batches of data with varying numbers of masks.
 
     This function takes a list of dictionaries (one for each sample in the batch)
-    and combines them into a single dictionary for the model.
+    and combines them into a single dictionary for the model. Images of different
+    sizes are padded at the bottom/right (see padding.py); the batch then carries a
+    `pixel_mask` and the mask labels are padded with zeros to the batch size. The
+    dataset `indices` of the samples are kept (used to look up cached teacher targets).
     """
-    pixel_values = torch.stack([item["pixel_values"] for item in batch])
-    mask_labels = [item["mask_labels"] for item in batch]
+    pixel_values, pixel_mask = pad_batch([item["pixel_values"] for item in batch])
+    mask_labels = [pad_masks(item["mask_labels"], pixel_values.shape[-2:]) for item in batch]
     class_labels = [item["class_labels"] for item in batch]
-    return {
+    collated = {
         "pixel_values": pixel_values,
         "mask_labels": mask_labels,
         "class_labels": class_labels,
+        "indices": [item["index"] for item in batch],
     }
+    if pixel_mask is not None:
+        collated["pixel_mask"] = pixel_mask
+    return collated
+
+
+def inference_collate_fn(batch):
+    """
+    Collate function for unlabeled images (see ImageListDataset).
+
+    Images keep their dataset index and original size so predictions can be written
+    back at the source resolution. Mixed-size images are padded as in `collate_fn`.
+    """
+    pixel_values, pixel_mask = pad_batch([item["pixel_values"] for item in batch])
+    collated = {
+        "pixel_values": pixel_values,
+        "indices": [item["index"] for item in batch],
+        "original_sizes": [item["original_size"] for item in batch],
+    }
+    if pixel_mask is not None:
+        collated["pixel_mask"] = pixel_mask
+    return collated
+
+
+def collect_image_paths(source, extensions=(".png", ".jpg", ".jpeg", ".tif", ".tiff")):
+    """
+    Collect image paths for inference.
+
+    Args:
+        source (str): A directory (searched recursively, e.g. '.../LoveDA/Test') or a
+            text file with one image path per line (relative paths are resolved
+            against the file's directory).
+        extensions: File extensions treated as images when scanning a directory.
+
+    Returns:
+        Sorted list of image paths.
+    """
+    if os.path.isdir(source):
+        extensions = tuple(e.lower() for e in extensions)
+        paths = []
+        for root, _, filenames in os.walk(source):
+            for filename in filenames:
+                if filename.lower().endswith(extensions):
+                    paths.append(os.path.join(root, filename))
+        return sorted(paths)
+
+    base_dir = os.path.dirname(os.path.abspath(source))
+    with open(source) as f:
+        lines = [line.strip() for line in f if line.strip() and not line.startswith("#")]
+    return [line if os.path.isabs(line) else os.path.join(base_dir, line) for line in lines]
+
+
+class ImageListDataset(Dataset):
+    """
+    Unlabeled images for inference (e.g. the LoveDA Test split).
+
+    Each item holds the processed `pixel_values`, the item's `index` into
+    `image_paths` and the `original_size` (height, width) of the source image.
+    """
+    def __init__(self, image_paths, processor):
+        """
+        Args:
+            image_paths (list[str]): Images to process.
+            processor: The Hugging Face AutoImageProcessor for Mask2Former.
+        """
+        self.image_paths = list(image_paths)
+        self.processor = processor
+
+    def __len__(self):
+        return len(self.image_paths)
+
+    def __getitem__(self, idx):
+        image = Image.open(self.image_paths[idx]).convert("RGB")
+        inputs = self.processor(images=image, return_tensors="pt")
+        return {
+            "pixel_values": inputs["pixel_values"].squeeze(0),
+            "index": idx,
+            "original_size": (image.height, image.width),
+        }
 
 
 class LoveDADataset(Dataset):
@@ -87,7 +171,8 @@ class LoveDADataset(Dataset):
         return {
             "pixel_values": inputs["pixel_values"].squeeze(0),
             "mask_labels": inputs["mask_labels"][0],
-            "class_labels": inputs["class_labels"][0]
+            "class_labels": inputs["class_labels"][0],
+            "index": idx,
         }
 
 
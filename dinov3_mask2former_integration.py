@@ -10,6 +10,8 @@ Key differences:
 """
 
 import os
+from contextlib import contextmanager
+
 import torch
 import torch.nn as nn
 from transformers import (
@@ -22,6 +24,9 @@ from transformers import (
 from transformers.utils import BackboneMixin, BackboneConfigMixin
 from transformers.modeling_outputs import BackboneOutput
 from models.backbone.dinov3_adapter import DINOv3_Adapter
+from matcher import install_matcher
+from padding import group_by_size, install_padding_support
+from token_merging import merge_patch_tokens, merge_ratios, unmerge_patch_tokens
 
 # Load test image
 from PIL import Image
@@ -53,6 +58,10 @@ class DINOv3AdapterBackboneConfig(PretrainedConfig, BackboneConfigMixin):
         embed_dim=1024,  # ViT-Large embedding dimension
         patch_size=16,    # DINOv3-ViT-L/16 patch size
         feature_strides=[4, 8, 16, 32],  # Feature map strides
+        projection_channels=None,  # Per-level output widths; None keeps embed_dim at every level
+        fusion="inplace",  # Stride-4 fusion path of the adapter: "reference", "inplace" or "reduced"
+        schedule="concurrent",  # Frozen ViT vs. SPM/interaction blocks: "sequential" or "concurrent"
+        deform_attn_precision="fp32",  # Deformable attention sampling: "fp32" or "reduced"
         **kwargs
     ):
         # DINOv3 + Adapter configuration
@@ -66,6 +75,10 @@ class DINOv3AdapterBackboneConfig(PretrainedConfig, BackboneConfigMixin):
         self.with_cp = with_cp
         self.embed_dim = embed_dim
         self.patch_size = patch_size
+        self.projection_channels = list(projection_channels) if projection_channels is not None else None
+        self.fusion = fusion
+        self.schedule = schedule
+        self.deform_attn_precision = deform_attn_precision
         
         # BackboneMixin required attributes - must be set before calling super().__init__
         self.feature_strides = feature_strides
@@ -95,13 +108,68 @@ class DINOv3CompatibilityWrapper:
         self.patch_size = dinov3_model.config.patch_size  # 16
         self.num_layers = dinov3_model.config.num_hidden_layers  # 24
 
+        # (input tensor, args, outputs) of the last call while feature reuse is active
+        self._reuse_enabled = False
+        self._cached_layers = None
+
+        # Fraction of the patch tokens merged after each layer (token_merging.py), None = off
+        self.merge_ratios = None
+
     def __getattr__(self, name):
         return getattr(self.model, name)
 
     def __call__(self, *args, **kwargs):
         return self.model(*args, **kwargs)
 
-    def get_intermediate_layers(self, x, n, return_class_token=True):
+    @contextmanager
+    def reuse_intermediate_layers(self):
+        """
+        Share one frozen ViT forward between several adapters.
+
+        Inside this context, calling get_intermediate_layers() again with the *same*
+        input tensor object and arguments returns the features of the first call
+        instead of rerunning the backbone. Used to evaluate several checkpoints
+        (whose adapters/decoders share this wrapper) with one ViT pass per batch.
+        """
+        self._reuse_enabled = True
+        try:
+            yield self
+        finally:
+            self._reuse_enabled = False
+            self._cached_layers = None
+
+    def get_intermediate_layers(self, x, n, return_class_token=True, valid_sizes=None):
+        """
+        Extract intermediate layer features from DINOv3, reusing the previous
+        result when called inside reuse_intermediate_layers() with the same input.
+        """
+        if not self._reuse_enabled:
+            return self._get_intermediate_layers(x, n, return_class_token, valid_sizes)
+
+        sizes_key = None if valid_sizes is None else tuple(map(tuple, valid_sizes.tolist()))
+        key = (tuple(n), return_class_token, sizes_key, tuple(self.merge_ratios or ()))
+        if self._cached_layers is not None:
+            cached_x, cached_key, cached_layers = self._cached_layers
+            # Identity check: the cache holds a reference to x, so its id cannot be recycled
+            if cached_x is x and cached_key == key:
+                return cached_layers
+
+        layers = self._get_intermediate_layers(x, n, return_class_token, valid_sizes)
+        self._cached_layers = (x, key, layers)
+        return layers
+
+    def iter_intermediate_layers(self, x, n, return_class_token=True, valid_sizes=None):
+        """
+        Like get_intermediate_layers(), but yields the features of each requested
+        layer as soon as the ViT has computed it (in the order of `n`), so callers can
+        start consuming early layers while later ones are still running.
+        """
+        if self._reuse_enabled:
+            yield from self.get_intermediate_layers(x, n, return_class_token, valid_sizes)
+            return
+        yield from self._iter_intermediate_layers(x, n, return_class_token, valid_sizes)
+
+    def _get_intermediate_layers(self, x, n, return_class_token=True, valid_sizes=None):
         """
         Extract intermediate layer features from DINOv3.
 
@@ -111,48 +179,102 @@ class DINOv3CompatibilityWrapper:
             x: Input tensor of shape (B, C, H, W)
             n: List of layer indices to extract features from (e.g., [4, 11, 17, 23])
             return_class_token: If True, return (patch_tokens, cls_token) tuples
+            valid_sizes: Optional (B, 2) valid (height, width) of a batch padded at the
+                bottom/right (see padding.py)
 
         Returns:
             List of tuples (patch_tokens, cls_token) for each requested layer
         """
-        # Forward through the model with output_hidden_states=True
-        outputs = self.model(x, output_hidden_states=True)
-
-        # hidden_states is a tuple of (embedding_output, layer_1, layer_2, ..., layer_N)
-        # Index 0 is the embedding output, indices 1-N are the transformer layer outputs
-        hidden_states = outputs.hidden_states
-
-        results = []
-        for layer_idx in n:
-            # hidden_states[0] is embedding, hidden_states[1] is layer 0, etc.
-            # So layer_idx=4 means we want hidden_states[5] (after 4 transformer layers)
-            # But HuggingFace uses 0-indexed layers, so layer 4 = hidden_states[4+1] = hidden_states[5]
-            # Actually, let's check: hidden_states has len = num_layers + 1
-            # hidden_states[0] = embeddings
-            # hidden_states[i] = output after layer i-1 (0-indexed)
-            # So to get output after layer_idx (0-indexed), we need hidden_states[layer_idx + 1]
-            state = hidden_states[layer_idx + 1]  # (B, num_tokens, hidden_size)
-
-            # DINOv3 token structure: [CLS, patch_1, ..., patch_N, reg_1, ..., reg_4]
-            # For DINOv3-ViT-L/16: CLS at 0, patches at 1:N+1, registers at N+1:N+5
-            # The adapter expects: patch_tokens (without CLS/registers), cls_token
-
-            cls_token = state[:, 0, :]  # (B, hidden_size) - squeezed to match DINOv2 API
-
-            # Remove CLS (index 0) and register tokens (last 4 tokens)
-            # Registers are at the end for DINOv3
-            num_register_tokens = getattr(self.model.config, 'num_register_tokens', 4)
-            if num_register_tokens > 0:
-                patch_tokens = state[:, 1:-num_register_tokens, :]  # (B, num_patches, hidden_size)
-            else:
-                patch_tokens = state[:, 1:, :]  # (B, num_patches, hidden_size)
-
-            if return_class_token:
-                results.append((patch_tokens, cls_token))
-            else:
-                results.append(patch_tokens)
-
-        return results
+        return list(self._iter_intermediate_layers(x, n, return_class_token, valid_sizes))
+
+    def _iter_intermediate_layers(self, x, n, return_class_token=True, valid_sizes=None):
+        """
+        Run the DINOv3 layers one by one up to the deepest requested layer.
+
+        Same features as `self.model(x, output_hidden_states=True).hidden_states[i + 1]`
+        for layer i (0-indexed), without keeping every hidden state alive and without
+        running the layers after the deepest requested one.
+
+        For a padded batch, images with the same valid token grid are run together on
+        that grid only: padded patches cost nothing, never take part in the attention,
+        and RoPE positions are those of the unpadded image. Patch tokens are scattered
+        back into the padded grid (zeros on padding).
+
+        With `merge_ratios`, similar patch tokens are merged after each layer and the
+        requested layers are unmerged to the full token grid (see token_merging.py).
+        """
+        model = self.model
+        patch_size = self.patch_size
+        grid = (x.shape[-2] // patch_size, x.shape[-1] // patch_size)
+
+        groups = {grid: list(range(x.shape[0]))}
+        if valid_sizes is not None:
+            groups = group_by_size(torch.div(valid_sizes + patch_size - 1, patch_size, rounding_mode="floor"))
+
+        states = []
+        for (height, width), indices in groups.items():
+            pixel_values = x if len(groups) == 1 else x[indices]
+            pixel_values = pixel_values[:, :, : height * patch_size, : width * patch_size]
+            pixel_values = pixel_values.to(model.embeddings.patch_embeddings.weight.dtype)
+            states.append(
+                [indices, (height, width), model.embeddings(pixel_values), model.rope_embeddings(pixel_values), None]
+            )
+
+        num_prefix_tokens = 1 + getattr(model.config, 'num_register_tokens', 0)
+        results = {}
+        next_out = 0
+        for layer_idx, layer_module in enumerate(model.layer[: max(n) + 1]):
+            for state in states:
+                state[2] = layer_module(state[2], position_embeddings=state[3])
+            for i, requested in enumerate(n):
+                if requested == layer_idx:
+                    results[i] = self._gather_tokens(states, x.shape[0], grid, return_class_token)
+            if self.merge_ratios is not None and self.merge_ratios[layer_idx] > 0 and layer_idx < max(n):
+                for state in states:
+                    state[2], state[3], state[4] = merge_patch_tokens(
+                        state[2], state[3], state[4], self.merge_ratios[layer_idx], num_prefix_tokens
+                    )
+            # Yield in the order of `n` as far as it is available
+            while next_out in results:
+                yield results.pop(next_out)
+                next_out += 1
+
+    def _gather_tokens(self, states, batch_size, grid, return_class_token=True):
+        """Patch/CLS tokens of the whole batch from the per-group hidden states (unmerged)."""
+        if len(states) == 1 and states[0][1] == grid:
+            patches, cls = self._split_tokens(states[0][2])
+            patches = unmerge_patch_tokens(patches, states[0][4])
+            return (patches, cls) if return_class_token else patches
+        hidden_size = states[0][2].shape[-1]
+        reference = states[0][2]
+        patch_tokens = reference.new_zeros((batch_size, grid[0], grid[1], hidden_size))
+        cls_token = reference.new_zeros((batch_size, hidden_size))
+        for indices, (height, width), hidden_states, _, merge in states:
+            patches, cls = self._split_tokens(hidden_states)
+            patches = unmerge_patch_tokens(patches, merge)
+            index = torch.as_tensor(indices, device=reference.device)
+            patch_tokens[index, :height, :width] = patches.view(len(indices), height, width, hidden_size)
+            cls_token[index] = cls
+        patch_tokens = patch_tokens.flatten(1, 2)
+        if return_class_token:
+            return patch_tokens, cls_token
+        return patch_tokens
+
+    def _split_tokens(self, state, return_class_token=True):
+        """
+        Split a (B, num_tokens, hidden_size) hidden state into patch tokens and the CLS token.
+
+        DINOv3 token structure: [CLS, reg_1, ..., reg_R, patch_1, ..., patch_N]
+        (HF DINOv3ViTEmbeddings concatenates CLS, registers and patches in this order).
+        The adapter expects patch tokens without CLS/registers and the CLS token
+        squeezed to (B, hidden_size) to match the DINOv2 API.
+        """
+        cls_token = state[:, 0, :]
+        num_register_tokens = getattr(self.model.config, 'num_register_tokens', 0)
+        patch_tokens = state[:, 1 + num_register_tokens:, :]  # (B, num_patches, hidden_size)
+        if return_class_token:
+            return patch_tokens, cls_token
+        return patch_tokens
 
 
 class DINOv3AdapterBackbone(nn.Module, BackboneMixin):
@@ -174,6 +296,11 @@ class DINOv3AdapterBackbone(nn.Module, BackboneMixin):
         
         # Wrap DINOv3 for compatibility with adapter
         self.dinov3_backbone = DINOv3CompatibilityWrapper(dinov3_model)
+        # The frozen ViT is also a registered submodule, so that `.to()`, `share_memory()` and
+        # DDP see it; its weights come from the pretrained model and stay out of checkpoints
+        self.vit = dinov3_model
+        self.register_state_dict_post_hook(_drop_vit_state)
+        self.register_load_state_dict_pre_hook(_fill_vit_state)
         
         # Print model info
         print(f"DINOv3 embedding dim: {self.dinov3_backbone.embed_dim}")
@@ -190,15 +317,32 @@ class DINOv3AdapterBackbone(nn.Module, BackboneMixin):
             n_points=config.n_points,
             deform_num_heads=config.deform_num_heads,
             drop_path_rate=config.drop_path_rate,
-            with_cp=config.with_cp
+            with_cp=config.with_cp,
+            fusion=config.fusion,
+            schedule=config.schedule,
+            deform_attn_precision=config.deform_attn_precision,
         )
         
-        # BackboneMixin required attributes  
-        self.num_features = len(config.out_features)
+        # Per-level channel reduction before the pixel decoder
+        embed_dim = self.dinov3_backbone.embed_dim
+        out_channels = config.projection_channels or [embed_dim] * len(config.stage_names)
+        self.projections = nn.ModuleList(
+            [_channel_projection(embed_dim, channels) for channels in out_channels]
+        )
+        
+        # BackboneMixin required attributes (channels per stage)
+        self.num_features = list(out_channels)
         
         # Store stage names for easy access
         self.stage_names = config.stage_names
+        self._out_features = list(config.out_features)
         
+    def train(self, mode=True):
+        """Train/eval mode of the adapter and projections; the frozen ViT stays in eval mode."""
+        super().train(mode)
+        self.vit.eval()
+        return self
+
     def forward(self, pixel_values, output_hidden_states=None, return_dict=None):
         """
         Forward pass through DINOv3 + Adapter backbone.
@@ -209,13 +353,21 @@ class DINOv3AdapterBackbone(nn.Module, BackboneMixin):
         Returns:
             BackboneOutput with multi-scale features
         """
-        # Get multi-scale features from adapter
-        features = self.adapter(pixel_values)
+        # Get multi-scale features from adapter; the stride-4 projection is applied
+        # inside the adapter so it can be folded into the stride-4 fusion
+        # Padding of the current batch, set by the hooks of padding.install_padding_support
+        padding = getattr(self, "_padding", None)
+        valid_sizes = padding[0] if padding is not None else None
+        features = self.adapter(pixel_values, stride4_projection=self.projections[0], valid_sizes=valid_sizes)
         
         # Convert to the format expected by BackboneOutput
-        # features is a list of [feat1, feat2, feat3, feat4] corresponding to different scales
-        feature_maps = tuple(features)
+        # features is a dict {"1": f1, ..., "4": f4} from stride 4 to stride 32
+        feature_maps = (features["1"],) + tuple(
+            projection(features[key]) for projection, key in zip(self.projections[1:], ("2", "3", "4"))
+        )
         
+        # Mask2Former calls the encoder without return_dict and reads `.feature_maps`
+        return_dict = True if return_dict is None else return_dict
         if not return_dict:
             return feature_maps
             
@@ -226,6 +378,62 @@ class DINOv3AdapterBackbone(nn.Module, BackboneMixin):
         )
 
 
+def _drop_vit_state(module, state_dict, prefix, local_metadata):
+    """state_dict hook: the frozen ViT weights are not saved."""
+    for key in [key for key in state_dict if key.startswith(prefix + "vit.")]:
+        del state_dict[key]
+
+
+def _fill_vit_state(module, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs):
+    """load_state_dict pre-hook: checkpoints without the frozen ViT keep its current weights."""
+    for name, value in module.vit.state_dict(prefix=prefix + "vit.", keep_vars=True).items():
+        state_dict.setdefault(name, value.detach())
+
+
+def _channel_projection(in_channels, out_channels):
+    """
+    1x1 convolution reducing adapter features to `out_channels`.
+
+    Initialized semi-orthogonally (orthonormal rows, zero bias): the projection starts
+    as a norm-preserving subspace selection of the adapter features, so the pretrained
+    pixel-decoder input projections behind it receive well-scaled inputs from the first
+    step. Levels that keep their width are passed through unchanged.
+    """
+    if in_channels == out_channels:
+        return nn.Identity()
+    projection = nn.Conv2d(in_channels, out_channels, kernel_size=1)
+    nn.init.orthogonal_(projection.weight.view(out_channels, in_channels))
+    nn.init.zeros_(projection.bias)
+    return projection
+
+
+def _match_pixel_decoder_inputs(pixel_decoder, channels):
+    """
+    Rebuild the first convolution of pixel-decoder inputs whose width differs from `channels`.
+
+    Level 1 (stride 4) enters through the FPN lateral convolution, levels 2-4 through
+    the deformable-encoder input projections (stored from low to high resolution
+    reversed). Rebuilt convolutions are randomly initialized.
+
+    Returns:
+        dict {level index (0-based): rebuilt convolution}
+    """
+    num_levels = len(channels)
+    inputs = {0: pixel_decoder.adapter_1}
+    for level in range(1, num_levels):
+        inputs[level] = pixel_decoder.input_projections[num_levels - 1 - level]
+
+    rebuilt = {}
+    for level, block in inputs.items():
+        conv = block[0]
+        if conv.in_channels == channels[level]:
+            continue
+        block[0] = nn.Conv2d(channels[level], conv.out_channels, kernel_size=1, bias=conv.bias is not None)
+        rebuilt[level] = block[0]
+    pixel_decoder.feature_channels = list(channels)
+    return rebuilt
+
+
 def _count_params(module):
     """Count total parameters in a module."""
     return sum(p.numel() for p in module.parameters())
@@ -245,12 +453,158 @@ def _log_weight_status(component_name, total_params, pretrained_params, random_p
     return pretrained_params, random_params
 
 
+def select_query_subset(query_features, num_queries, strategy="diverse"):
+    """
+    Choose which pretrained object queries to keep.
+
+    Args:
+        query_features: (Q, D) pretrained query feature embeddings
+        num_queries: Number of queries to keep (<= Q)
+        strategy: "first" (queries 0..K-1), "uniform" (evenly spaced indices),
+            "diverse" (farthest-point sampling on the query features, so the kept
+            queries cover the pretrained embedding space) or an explicit list of indices
+
+    Returns:
+        LongTensor of K sorted query indices
+    """
+    total = query_features.shape[0]
+    if not isinstance(strategy, str):
+        indices = torch.as_tensor(list(strategy), dtype=torch.long)
+        if len(indices) != num_queries or indices.unique().numel() != num_queries:
+            raise ValueError(f"query_init must list {num_queries} distinct indices, got {list(strategy)}")
+        if indices.min() < 0 or indices.max() >= total:
+            raise ValueError(f"query_init indices must be in [0, {total})")
+        return indices.sort().values
+    if num_queries > total:
+        raise ValueError(f"num_queries={num_queries} exceeds the {total} pretrained queries")
+    if strategy == "first":
+        return torch.arange(num_queries)
+    if strategy == "uniform":
+        return torch.linspace(0, total - 1, num_queries).round().long()
+    if strategy == "diverse":
+        features = query_features.detach().float()
+        # Start from the query closest to the mean, then repeatedly add the farthest query
+        selected = [int((features - features.mean(0)).norm(dim=1).argmin())]
+        distances = (features - features[selected[0]]).norm(dim=1)
+        for _ in range(num_queries - 1):
+            selected.append(int(distances.argmax()))
+            distances = torch.minimum(distances, (features - features[selected[-1]]).norm(dim=1))
+        return torch.as_tensor(selected).sort().values
+    raise ValueError(f"query_init must be 'first', 'uniform', 'diverse' or a list of indices, got {strategy!r}")
+
+
+def reduce_queries(model, num_queries, strategy="diverse"):
+    """
+    Keep a subset of the pretrained object queries of a Mask2Former model.
+
+    The query embeddings (`queries_embedder`) and query features (`queries_features`)
+    of the kept queries are copied from the pretrained ones; everything else in the
+    transformer decoder is independent of the query count.
+
+    Args:
+        model: Mask2FormerForUniversalSegmentation
+        num_queries: Number of queries to keep
+        strategy: See `select_query_subset`
+
+    Returns:
+        LongTensor of the kept pretrained query indices
+    """
+    transformer_module = model.model.transformer_module
+    indices = select_query_subset(transformer_module.queries_features.weight, num_queries, strategy)
+    for name in ("queries_embedder", "queries_features"):
+        old = getattr(transformer_module, name)
+        new = nn.Embedding(num_queries, old.embedding_dim).to(old.weight.device, old.weight.dtype)
+        with torch.no_grad():
+            new.weight.copy_(old.weight[indices.to(old.weight.device)])
+        setattr(transformer_module, name, new)
+    model.config.num_queries = num_queries
+    return indices
+
+
+def num_decoder_layers(model):
+    """Number of masked-attention layers of the full transformer decoder."""
+    decoder = model.model.transformer_module.decoder
+    return len(getattr(decoder, "_all_layers", decoder.layers))
+
+
+def set_decoder_depth(model, depth=None):
+    """
+    Run only the first `depth` transformer-decoder layers (anytime inference).
+
+    Mask2Former predicts classes and masks after every decoder layer; with a
+    truncated decoder the model returns the prediction after layer `depth`, which
+    is the auxiliary prediction `depth` of the full decoder (depth 0 = prediction
+    from the learned queries before any layer). Meant for inference only: the
+    auxiliary losses of the removed layers are skipped as well.
+
+    Args:
+        model: Mask2FormerForUniversalSegmentation
+        depth: Decoder layers to run, 0..num_decoder_layers(model); None restores the full decoder
+    """
+    decoder = model.model.transformer_module.decoder
+    if not hasattr(decoder, "_all_layers"):
+        # Plain attribute, not a registered submodule: apply after loading weights and moving the model
+        decoder.__dict__["_all_layers"] = decoder.layers
+    all_layers = decoder._all_layers
+    if depth is None:
+        depth = len(all_layers)
+    if not 0 <= depth <= len(all_layers):
+        raise ValueError(f"decoder depth must be in [0, {len(all_layers)}], got {depth}")
+    decoder.layers = all_layers if depth == len(all_layers) else nn.ModuleList(all_layers[:depth])
+
+
+def set_token_merging(model, ratio=None):
+    """
+    Merge similar patch tokens inside the frozen ViT (see token_merging.py).
+
+    After each ViT layer, `ratio` of the remaining patch tokens are merged into their
+    most similar tokens; the adapter still receives the full token grid. Meant for
+    inference: the features change, so compare mIoU with evaluation.merge_sweep first.
+
+    Args:
+        model: Mask2FormerForUniversalSegmentation with a DINOv3AdapterBackbone
+        ratio: None/0 (off), a fraction in [0, 0.5] for every layer, or a list with
+            one fraction per ViT layer
+    """
+    vit = model.model.pixel_level_module.encoder.dinov3_backbone
+    vit.merge_ratios = merge_ratios(ratio, vit.num_layers)
+
+
+@contextmanager
+def token_merging(model, ratio):
+    """Temporarily merge ViT tokens with `ratio`, see `set_token_merging`."""
+    vit = model.model.pixel_level_module.encoder.dinov3_backbone
+    previous = vit.merge_ratios
+    set_token_merging(model, ratio)
+    try:
+        yield model
+    finally:
+        vit.merge_ratios = previous
+
+
+@contextmanager
+def decoder_depth(model, depth):
+    """Temporarily run only the first `depth` transformer-decoder layers, see `set_decoder_depth`."""
+    decoder = model.model.transformer_module.decoder
+    previous = decoder.layers
+    set_decoder_depth(model, depth)
+    try:
+        yield model
+    finally:
+        decoder.layers = previous
+
+
 def create_dinov3_mask2former(
     dinov3_model_name="facebook/dinov3-vitl16-pretrain-sat493m",
     interaction_indexes=[4, 11, 17, 23],  # For ViT-Large (24 layers)
     pretrain_size=224,
     mask2former_config_name="facebook/mask2former-swin-base-coco-panoptic",
     num_classes=133,  # COCO panoptic classes
+    matcher="reference",
+    matcher_workers=4,
+    num_queries=None,
+    query_init="diverse",
+    projection_channels=None,
     **kwargs
 ):
     """
@@ -262,6 +616,13 @@ def create_dinov3_mask2former(
         pretrain_size: Input size for adapter
         mask2former_config_name: Base Mask2Former config to modify
         num_classes: Number of segmentation classes
+        matcher: Hungarian matcher of the training loss: "reference" (HF, per image)
+            or "batched" (matcher.BatchedHungarianMatcher, identical assignments)
+        matcher_workers: Assignment solver threads for the batched matcher
+        num_queries: Object queries to keep (None keeps all pretrained queries)
+        query_init: Which pretrained queries initialize the kept ones, see `select_query_subset`
+        projection_channels: Output widths of the adapter levels (stride 4, 8, 16, 32) after the
+            channel projections; None matches the pretrained pixel decoder inputs (Swin-B: 128, 256, 512, 1024)
         **kwargs: Additional arguments for adapter
 
     Returns:
@@ -301,11 +662,37 @@ def create_dinov3_mask2former(
         ignore_mismatched_sizes=True,
     )
 
+    # Fewer object queries: fewer decoder tokens, smaller matching and post-processing
+    pretrained_queries = base_config.num_queries
+    if num_queries is not None and num_queries != pretrained_queries:
+        kept = reduce_queries(model, num_queries, query_init)
+        print(f"   Object queries: {num_queries} of {pretrained_queries} pretrained "
+              f"(init: {query_init if isinstance(query_init, str) else 'explicit indices'}, "
+              f"kept {kept[:8].tolist()}{'...' if num_queries > 8 else ''})")
+    else:
+        print(f"   Object queries: {pretrained_queries} (pretrained)")
+
     # =========================================================================
     # STEP 3: Create custom backbone with PRETRAINED DINOv3
     # =========================================================================
     print("\n📦 Creating DINOv3 + ViT-Adapter backbone...")
+    pixel_decoder = model.model.pixel_level_module.decoder
+    pretrained_channels = list(pixel_decoder.feature_channels)
+    backbone_config.projection_channels = list(projection_channels or pretrained_channels)
+    if len(backbone_config.projection_channels) != len(pretrained_channels):
+        raise ValueError(
+            f"projection_channels needs {len(pretrained_channels)} widths (one per level), "
+            f"got {backbone_config.projection_channels}"
+        )
     custom_backbone = DINOv3AdapterBackbone(backbone_config)
+    print(f"   Channel projections: {custom_backbone.dinov3_backbone.embed_dim} → "
+          f"{tuple(backbone_config.projection_channels)} (stride 4, 8, 16, 32)")
+
+    # Pixel decoder inputs built for other widths cannot reuse their pretrained first conv
+    rebuilt_convs = _match_pixel_decoder_inputs(pixel_decoder, backbone_config.projection_channels)
+    if rebuilt_convs:
+        print(f"   ⚠️  Pixel decoder input convs of levels {[l + 1 for l in rebuilt_convs]} re-initialized "
+              f"(pretrained widths {tuple(pretrained_channels)})")
 
     # =========================================================================
     # STEP 4: Log weight status BEFORE replacing backbone
@@ -337,6 +724,7 @@ def create_dinov3_mask2former(
     for name, module in custom_backbone.adapter.named_modules():
         if name and not name.startswith('backbone'):
             adapter_only_params += sum(p.numel() for p in module.parameters(recurse=False))
+    adapter_only_params += _count_params(custom_backbone.projections)
     pretrained, random = _log_weight_status(
         "ViT-Adapter layers",
         adapter_only_params,
@@ -348,13 +736,13 @@ def create_dinov3_mask2former(
 
     # --- Mask2Former Pixel Decoder ---
     print("\n🎨 MASK2FORMER PIXEL DECODER:")
-    pixel_decoder = model.model.pixel_level_module.decoder
     pixel_decoder_params = _count_params(pixel_decoder)
+    rebuilt_params = sum(_count_params(conv) for conv in rebuilt_convs.values())
     pretrained, random = _log_weight_status(
         "Pixel Decoder (FPN + layers)",
         pixel_decoder_params,
-        pixel_decoder_params,  # All pretrained from COCO
-        0
+        pixel_decoder_params - rebuilt_params,  # Pretrained from COCO except re-initialized input convs
+        rebuilt_params
     )
     total_pretrained += pretrained
     total_random += random
@@ -404,6 +792,13 @@ def create_dinov3_mask2former(
     model.model.pixel_level_module.encoder = custom_backbone
     print("✅ Replaced pixel_level_module.encoder with DINOv3 + ViT-Adapter")
 
+    # model(pixel_values, pixel_mask=...) for padded batches of mixed-size images
+    install_padding_support(model)
+
+    # Loss matcher: batched cost matrices + parallel assignment instead of a per-image loop
+    install_matcher(model, matcher, num_workers=matcher_workers)
+    print(f"✅ Hungarian matcher: {type(model.criterion.matcher).__name__}")
+
     # =========================================================================
     # STEP 6: Final summary
     # =========================================================================
@@ -418,16 +813,11 @@ def create_dinov3_mask2former(
 
     print("\n  Component breakdown:")
     print(f"    • DINOv3 backbone:        {dinov3_params:>12,} (pretrained, frozen)")
-    print(f"    • ViT-Adapter:            {adapter_only_params:>12,} (random, trainable)")
+    print(f"    • ViT-Adapter:            {adapter_only_params:>12,} (random, trainable, incl. channel projections)")
     print(f"    • M2F Pixel Decoder:      {pixel_decoder_params:>12,} (pretrained, trainable)")
     print(f"    • M2F Transformer:        {transformer_params:>12,} (pretrained, trainable)")
     print(f"    • Class Predictor:        {class_predictor_params:>12,} (reinitialized, trainable)")
 
-    print("\n⚠️  NOTE: Pixel decoder input projections expect Swin channel dims")
-    print("   (128, 256, 512, 1024) but adapter outputs 1024 at all scales.")
-    print("   This will cause dimension mismatch at forward pass!")
-    print("   TODO: Add projection layers to match Swin channel dimensions.")
-
     print("=" * 70 + "\n")
 
     # =========================================================================
@@ -0,0 +1,284 @@
+"""
+Knowledge distillation from a trained ViT-L model to a smaller DINOv3 student.
+
+The student is the same DINOv3 + ViT-Adapter + Mask2Former model built on a
+smaller DINOv3 backbone, with the teacher's interaction indexes scaled to the
+student depth. Both models project the adapter levels to the pixel-decoder
+widths (`model.projection_channels`), so their adapter outputs can be compared
+directly. The student is trained on
+
+- the usual Mask2Former loss on the labels (`task_weight`),
+- an MSE between the projected adapter outputs of the selected levels
+  (`feature_weight`),
+- a KL divergence between the per-pixel class distributions of the two models
+  (`logit_weight`). Queries are not aligned between teacher and student, so the
+  predictions are compared after combining classes and masks (`semantic_logits`).
+
+The training data is not augmented, so the teacher targets of every training
+image are fixed: `TeacherStore` precomputes them once to memory-mapped fp16
+arrays and the teacher is not run during training.
+
+Layout of one store (one directory per teacher checkpoint hash and image size):
+
+    <root>/<sha256[:16]>_<image_size>/
+        meta.json               shapes, teacher checkpoint, feature levels
+        features_<level>.npy    (N, C_level, h_level, w_level) float16
+        semantic.npy            (N, num_classes, h, w)         float16, at mask resolution
+        done.npy                (N,)                           bool, written samples
+"""
+
+import copy
+import json
+import os
+from datetime import datetime
+
+import numpy as np
+import torch
+from tqdm import tqdm
+from transformers import AutoConfig
+
+from models.backbone.dinov3_adapter import valid_mask
+from padding import valid_sizes_from_mask
+from postprocess import semantic_logits
+
+
+def vit_depth(model_name, token=None):
+    """Number of transformer layers of a DINOv3 checkpoint (from its config only)."""
+    return AutoConfig.from_pretrained(model_name, token=token or None).num_hidden_layers
+
+
+def scale_interaction_indexes(indexes, teacher_depth, student_depth):
+    """
+    Interaction indexes at the same relative depth in a shallower (or deeper) ViT.
+
+    The last layer maps to the last layer, e.g. [4, 11, 17, 23] of 24 layers gives
+    [2, 5, 8, 11] of 12 layers.
+    """
+    scaled = [int((i + 1) * student_depth / teacher_depth + 0.5) - 1 for i in indexes]
+    scaled = [min(max(i, 0), student_depth - 1) for i in scaled]
+    if len(set(scaled)) != len(scaled):
+        raise ValueError(f"interaction indexes {list(indexes)} collapse to {scaled} in a {student_depth}-layer ViT; "
+                         f"set training.distillation.student_interaction_indexes")
+    return scaled
+
+
+def student_config(cfg, token=None):
+    """
+    Config of the student model: `cfg` with the student backbone and its interaction indexes.
+
+    The result describes the checkpoints written by the distillation run, so it is also
+    the config to evaluate or serve them with.
+    """
+    distill_cfg = cfg.training.distillation
+    indexes = distill_cfg.student_interaction_indexes
+    if indexes is None:
+        indexes = scale_interaction_indexes(
+            list(cfg.model.interaction_indexes),
+            vit_depth(cfg.model.dinov3_model_name, token),
+            vit_depth(distill_cfg.student_model, token),
+        )
+    student = copy.deepcopy(cfg)
+    student.model.name = f"{distill_cfg.student_model.split('/')[-1]} + Mask2Former (distilled)"
+    student.model.backbone = distill_cfg.student_model
+    student.model.dinov3_model_name = distill_cfg.student_model
+    student.model.interaction_indexes = list(indexes)
+    return student
+
+
+def teacher_targets(model, pixel_values, pixel_mask, levels):
+    """
+    Teacher adapter outputs of `levels` and per-pixel class scores for a batch.
+
+    Returns:
+        dict with "features" (list of (B, C, h, w) tensors, one per level) and
+        "semantic" ((B, num_classes, h/4, w/4) class scores)
+    """
+    outputs = model(pixel_values=pixel_values, pixel_mask=pixel_mask, output_hidden_states=True)
+    return {
+        "features": [outputs.encoder_hidden_states[level] for level in levels],
+        "semantic": semantic_logits(outputs.class_queries_logits, outputs.masks_queries_logits),
+    }
+
+
+def _class_distribution(scores):
+    return scores / scores.sum(dim=1, keepdim=True).clamp(min=1e-6)
+
+
+def _masked_mean(values, mask):
+    """Mean of (B, h, w) `values` over the True positions of `mask` (all positions if None)."""
+    if mask is None:
+        return values.mean()
+    mask = mask.to(values.dtype)
+    return (values * mask).sum() / mask.sum().clamp(min=1)
+
+
+def distillation_losses(outputs, targets, levels, pixel_values, pixel_mask=None):
+    """
+    Feature and logit distillation losses of a student forward.
+
+    Args:
+        outputs: Student output of a forward with output_hidden_states=True
+        targets: `teacher_targets` of the same batch (or read from a TeacherStore)
+        levels: Adapter levels compared by the feature loss
+        pixel_values: (B, 3, H, W) input batch
+        pixel_mask: Optional padding mask of the batch (padded positions are ignored)
+
+    Returns:
+        dict with "feature" (MSE averaged over levels) and "logit" (per-pixel KL divergence
+        from the teacher's class distribution to the student's)
+    """
+    valid_sizes = valid_sizes_from_mask(pixel_mask)
+    input_size = tuple(pixel_values.shape[-2:])
+
+    def mask_for(shape):
+        return None if valid_sizes is None else valid_mask(valid_sizes.to(pixel_values.device), input_size, shape)
+
+    feature_losses = []
+    for level, target in zip(levels, targets["features"]):
+        student = outputs.encoder_hidden_states[level].float()
+        if student.shape != target.shape:
+            raise ValueError(f"student level {level} has shape {tuple(student.shape)}, teacher {tuple(target.shape)}; "
+                             f"teacher and student need the same model.projection_channels")
+        squared_error = (student - target.float()).pow(2).mean(dim=1)
+        feature_losses.append(_masked_mean(squared_error, mask_for(tuple(student.shape[-2:]))))
+
+    student_probs = _class_distribution(semantic_logits(outputs.class_queries_logits, outputs.masks_queries_logits))
+    teacher_probs = _class_distribution(targets["semantic"].float())
+    kl = (teacher_probs * (teacher_probs.clamp(min=1e-6).log() - student_probs.clamp(min=1e-6).log())).sum(dim=1)
+
+    return {
+        "feature": torch.stack(feature_losses).mean() if feature_losses else kl.new_zeros(()),
+        "logit": _masked_mean(kl, mask_for(tuple(kl.shape[-2:]))),
+    }
+
+
+class TeacherStore:
+    """
+    Read/write access to the precomputed teacher targets of a training set.
+
+    Use `TeacherStore.create(...)` (or `open(path)` to resume/read) and
+    `precompute_teacher_targets` to fill it.
+    """
+
+    def __init__(self, path, meta, mode):
+        self.path = path
+        self.meta = meta
+        self.levels = list(meta["levels"])
+        self.features = [np.load(os.path.join(path, f"features_{level}.npy"), mmap_mode=mode) for level in self.levels]
+        self.semantic = np.load(os.path.join(path, "semantic.npy"), mmap_mode=mode)
+        self.done = np.load(os.path.join(path, "done.npy"), mmap_mode=mode)
+
+    @classmethod
+    def create(cls, path, num_samples, levels, feature_shapes, semantic_shape, **meta):
+        """
+        Allocate a new store (existing arrays in `path` are overwritten).
+
+        Args:
+            feature_shapes: (C, h, w) of every level in `levels`
+            semantic_shape: (num_classes, h, w) of the class scores
+        """
+        os.makedirs(path, exist_ok=True)
+        arrays = {f"features_{level}.npy": ((num_samples, *shape), np.float16) for level, shape in zip(levels, feature_shapes)}
+        arrays["semantic.npy"] = ((num_samples, *semantic_shape), np.float16)
+        arrays["done.npy"] = ((num_samples,), np.bool_)
+        for filename, (shape, dtype) in arrays.items():
+            array = np.lib.format.open_memmap(os.path.join(path, filename), mode="w+", dtype=dtype, shape=shape)
+            array[...] = 0
+            array.flush()
+            del array
+
+        meta = {
+            "num_samples": num_samples,
+            "levels": list(levels),
+            "feature_shapes": [list(shape) for shape in feature_shapes],
+            "semantic_shape": list(semantic_shape),
+            "created": datetime.now().isoformat(timespec="seconds"),
+            **meta,
+        }
+        with open(os.path.join(path, "meta.json"), "w") as f:
+            json.dump(meta, f, indent=2, default=str)
+        return cls(path, meta, mode="r+")
+
+    @classmethod
+    def open(cls, path, mode="r"):
+        """Open an existing store ("r+" to continue filling it)."""
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        return cls(path, meta, mode=mode)
+
+    @property
+    def num_done(self):
+        return int(self.done.sum())
+
+    @property
+    def complete(self):
+        return bool(self.done.all())
+
+    def write(self, indices, targets):
+        """Store `teacher_targets` of the samples with dataset indices `indices`."""
+        indices = np.asarray(indices)
+        for array, features in zip(self.features, targets["features"]):
+            if tuple(features.shape[1:]) != array.shape[1:]:
+                raise ValueError(f"teacher features of shape {tuple(features.shape[1:])} do not fit the store "
+                                 f"({array.shape[1:]}); the teacher cache needs a fixed input size (data.resize=true)")
+            array[indices] = features.half().cpu().numpy()
+        self.semantic[indices] = targets["semantic"].half().cpu().numpy()
+        self.done[indices] = True
+
+    def read(self, indices, device="cpu"):
+        """Teacher targets of the samples with dataset indices `indices`, as float tensors on `device`."""
+        indices = np.asarray(indices)
+        if not self.done[indices].all():
+            raise RuntimeError(f"teacher store {self.path} is missing samples of this batch; precompute it first")
+        return {
+            "features": [torch.from_numpy(np.asarray(array[indices])).to(device).float() for array in self.features],
+            "semantic": torch.from_numpy(np.asarray(self.semantic[indices])).to(device).float(),
+        }
+
+    def flush(self):
+        for array in (*self.features, self.semantic, self.done):
+            array.flush()
+
+
+@torch.no_grad()
+def precompute_teacher_targets(model, loader, path, levels, device, **meta):
+    """
+    Run the teacher once over `loader` and write its targets to the store at `path`.
+
+    The loader must yield batches with dataset `indices` (see data.collate_fn). An
+    existing store with the same levels is resumed: batches whose samples are all
+    written are skipped.
+
+    Returns:
+        TeacherStore opened read-only
+    """
+    levels = list(levels)
+    store = None
+    if os.path.exists(os.path.join(path, "meta.json")):
+        store = TeacherStore.open(path, mode="r+")
+        if store.levels != levels or store.meta["num_samples"] != len(loader.dataset):
+            store = None
+        elif store.complete:
+            print(f"💾 Teacher targets: {path} ({store.num_done} samples, complete)")
+            return TeacherStore.open(path)
+
+    print(f"💾 Precomputing teacher targets to {path}")
+    for batch in tqdm(loader, desc="Teacher targets"):
+        if store is not None and store.done[np.asarray(batch["indices"])].all():
+            continue
+        pixel_values = batch["pixel_values"].to(device)
+        pixel_mask = batch.get("pixel_mask")
+        pixel_mask = None if pixel_mask is None else pixel_mask.to(device)
+        targets = teacher_targets(model, pixel_values, pixel_mask, levels)
+        if store is None:
+            store = TeacherStore.create(
+                path,
+                len(loader.dataset),
+                levels,
+                [tuple(features.shape[1:]) for features in targets["features"]],
+                tuple(targets["semantic"].shape[1:]),
+                **meta,
+            )
+        store.write(batch["indices"], targets)
+    store.flush()
+    return TeacherStore.open(path)
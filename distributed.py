@@ -0,0 +1,172 @@
+"""
+Data-parallel training: one process per device with DistributedDataParallel.
+
+`training.distributed.devices` sets the number of processes: every CUDA device
+(NCCL) or, with a number, as many CPU processes (gloo) on one machine, which is
+enough to test the distributed path without accelerators. With more than one
+process:
+
+- the frozen ViT is a registered submodule (moved with the model) but left out
+  of DDP: it has no gradients to reduce, and its weights and buffers are
+  neither broadcast when DDP wraps the model nor on every forward,
+- DDP runs with `static_graph` (the same parameters take part in every step,
+  activation checkpointing included; not combined with gradient accumulation)
+  and gradient buckets as views of the gradients, without the unused-parameter
+  search,
+- each rank validates its own shard of Val without the padding of Lightning's
+  DistributedSampler, and the confusion matrix is merged once per epoch,
+- `training.effective_batch_size` is split across the ranks.
+
+On CPU the adapter's SyncBatchNorm layers (CUDA only once a process group
+exists) become per-rank BatchNorm2d layers; DDP broadcasts the statistics of
+rank 0 with the other buffers.
+"""
+
+import os
+
+import torch
+import torch.distributed as dist
+import torch.nn as nn
+from pytorch_lightning.strategies import DDPStrategy
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DataLoader, DistributedSampler
+
+from checkpointing import frozen_vit
+
+
+def num_processes(devices):
+    """Number of training processes of `training.distributed.devices` ("auto" = every CUDA device, 1 on CPU)."""
+    if devices == "auto":
+        return max(torch.cuda.device_count(), 1) if torch.cuda.is_available() else 1
+    if int(devices) < 1:
+        raise ValueError(f"devices must be 'auto' or a positive number, got {devices!r}")
+    return int(devices)
+
+
+def local_device():
+    """Device of this process: the CUDA device of its local rank (set by the launcher), else the CPU."""
+    if torch.cuda.is_available():
+        return torch.device("cuda", int(os.environ.get("LOCAL_RANK", 0)))
+    return torch.device("cpu")
+
+
+def per_rank_batch_size(effective_batch_size, world_size):
+    """Images per optimizer step on each rank for `effective_batch_size` images across all ranks."""
+    if effective_batch_size % world_size:
+        raise ValueError(
+            f"effective_batch_size {effective_batch_size} is not divisible by the {world_size} training processes"
+        )
+    return effective_batch_size // world_size
+
+
+def ddp_strategy(distributed_cfg, accumulate_grad_batches=1):
+    """
+    Lightning DDP strategy of `training.distributed` (backend None = NCCL on CUDA, gloo on CPU).
+
+    The static graph is only used without gradient accumulation: DDP records it while
+    reducing the first backward, which Lightning skips (`no_sync`) on accumulating steps.
+    """
+    return DDPStrategy(
+        process_group_backend=distributed_cfg.backend,
+        static_graph=distributed_cfg.static_graph and accumulate_grad_batches == 1,
+        gradient_as_bucket_view=True,
+        find_unused_parameters=False,
+    )
+
+
+def ignore_frozen_vit(module):
+    """
+    Leave the frozen ViT of a LightningModule out of DDP (no broadcast, buffer sync or gradient reduction).
+
+    Returns:
+        Number of ignored parameters and buffers
+    """
+    vit = frozen_vit(module.model)
+    prefix = next(name for name, child in module.named_modules() if child is vit)
+    names = [f"{prefix}.{name}" for name, _ in (*vit.named_parameters(), *vit.named_buffers())]
+    DistributedDataParallel._set_params_and_buffers_to_ignore_for_model(module, names)
+    return len(names)
+
+
+def _batchnorm_from_sync(norm):
+    batchnorm = nn.BatchNorm2d(norm.num_features, norm.eps, norm.momentum, norm.affine, norm.track_running_stats)
+    if norm.affine:
+        batchnorm.weight, batchnorm.bias = norm.weight, norm.bias
+    if norm.track_running_stats:
+        batchnorm.running_mean, batchnorm.running_var = norm.running_mean, norm.running_var
+        batchnorm.num_batches_tracked = norm.num_batches_tracked
+    return batchnorm.train(norm.training)
+
+
+def revert_sync_batchnorm(module):
+    """
+    Replace the SyncBatchNorm layers under `module` by BatchNorm2d layers sharing their weights and statistics.
+
+    Returns:
+        Number of replaced layers
+    """
+    replaced = 0
+    for parent in list(module.modules()):
+        for name, child in parent.named_children():
+            if isinstance(child, nn.SyncBatchNorm):
+                setattr(parent, name, _batchnorm_from_sync(child))
+                replaced += 1
+    return replaced
+
+
+def prepare_data_parallel(module, device):
+    """
+    Prepare a LightningModule for DDP: frozen ViT ignored, per-rank BatchNorm off CUDA.
+
+    Returns:
+        dict with the number of "ignored" ViT tensors and of "reverted_sync_batchnorm" layers
+    """
+    reverted = 0
+    if torch.device(device).type != "cuda":
+        reverted = revert_sync_batchnorm(module.model.model.pixel_level_module.encoder.adapter)
+    return {"ignored": ignore_frozen_vit(module), "reverted_sync_batchnorm": reverted}
+
+
+class ValidationShardSampler(DistributedSampler):
+    """
+    Every `world_size`-th validation sample from the rank's own index, without padding.
+
+    Lightning's DistributedSampler repeats samples so that all ranks get as many,
+    which would count them twice in the merged metrics; here the last ranks may
+    get one sample fewer (validation does not synchronize per step). The rank and
+    world size are read when iterating, as the process group does not exist yet
+    when the DataLoader is built. Lightning keeps a DistributedSampler it finds
+    in a DataLoader.
+    """
+
+    def __init__(self, dataset):
+        # No DistributedSampler.__init__: it needs the process group
+        self.dataset = dataset
+        self.shuffle = False
+        self.epoch = 0
+
+    @property
+    def num_replicas(self):
+        return dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+
+    @property
+    def rank(self):
+        return dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+
+    def __iter__(self):
+        return iter(range(self.rank, len(self.dataset), self.num_replicas))
+
+    def __len__(self):
+        return len(range(self.rank, len(self.dataset), self.num_replicas))
+
+
+def shard_validation(loader):
+    """Same validation DataLoader (batch size, workers, collate_fn) over the rank's ValidationShardSampler."""
+    return DataLoader(
+        loader.dataset,
+        batch_size=loader.batch_size,
+        sampler=ValidationShardSampler(loader.dataset),
+        num_workers=loader.num_workers,
+        collate_fn=loader.collate_fn,
+        pin_memory=loader.pin_memory,
+    )
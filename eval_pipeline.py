@@ -0,0 +1,283 @@
+"""
+Pipelined evaluation stages for evaluate_hydra.py.
+
+The evaluation loop is split into overlapping stages connected by bounded queues:
+
+    DataLoader workers ──► prefetch thread (host → device copy)
+                                  │
+                                  ▼
+                     main thread: forward + post-processing
+                                  │
+              ┌───────────────────┴───────────────────┐
+              ▼                                       ▼
+    metric thread: GT reconstruction       thread pool: PNG encoding of
+    + confusion matrix update()            label maps / colorized overlays
+
+Bounded queues keep memory flat: when a downstream stage falls behind, the
+upstream stage blocks instead of buffering the whole validation set.
+"""
+
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+from PIL import Image
+
+_STOP = object()
+
+
+class BackgroundStage:
+    """
+    Run `fn(item)` for every item put on a bounded queue, in a worker thread.
+
+    Exceptions raised by `fn` are re-raised in the caller on the next `put()`
+    or on `close()`.
+    """
+
+    def __init__(self, fn, maxsize=4, name="stage"):
+        self.fn = fn
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is _STOP:
+                return
+            if self.error is not None:
+                continue  # Drain remaining items after a failure
+            try:
+                self.fn(item)
+            except BaseException as e:  # noqa: B902 - surfaced in the caller
+                self.error = e
+
+    def _raise_if_failed(self):
+        if self.error is not None:
+            raise self.error
+
+    def put(self, item):
+        self._raise_if_failed()
+        self.queue.put(item)
+
+    def close(self):
+        self.queue.put(_STOP)
+        self.thread.join()
+        self._raise_if_failed()
+
+
+def prefetch_to_device(loader, device, depth=2, keys=("pixel_values",)):
+    """
+    Iterate over `loader` while a background thread copies the next `depth`
+    batches to `device`, so host-to-device transfers overlap the forward pass.
+
+    Only tensors under `keys` are moved; the remaining entries (e.g. variable-length
+    mask lists) are passed through unchanged.
+    """
+    if depth <= 0:
+        for batch in loader:
+            yield {k: (v.to(device) if k in keys else v) for k, v in batch.items()}
+        return
+
+    buffer = queue.Queue(maxsize=depth)
+    non_blocking = device.type == "cuda"
+    stop = threading.Event()
+
+    def _producer():
+        try:
+            for batch in loader:
+                if stop.is_set():
+                    break
+                moved = {k: (v.to(device, non_blocking=non_blocking) if k in keys else v) for k, v in batch.items()}
+                buffer.put(moved)
+        except BaseException as e:  # noqa: B902 - surfaced in the consumer
+            buffer.put(e)
+            return
+        buffer.put(_STOP)
+
+    thread = threading.Thread(target=_producer, name="prefetch", daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = buffer.get()
+            if item is _STOP:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        # Unblock the producer if it is waiting on a full queue
+        while thread.is_alive():
+            try:
+                buffer.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        thread.join()
+
+
+def reconstruct_ground_truth(mask_labels, class_labels, size, device):
+    """
+    Rebuild (B, H, W) label maps from the processor's per-image binary masks.
+    Pixels not covered by any mask are set to 255 (ignored).
+    """
+    gt = torch.full((len(mask_labels), *size), 255, dtype=torch.long, device=device)
+    for i, (masks, classes) in enumerate(zip(mask_labels, class_labels)):
+        if len(masks) == 0:
+            continue
+        # 1 + index of the last mask covering each pixel (0 = none), so later masks win;
+        # no per-mask host synchronization
+        order = torch.arange(1, len(masks) + 1, device=device).view(-1, 1, 1)
+        last = (masks.to(device).bool() * order).amax(0)
+        classes = classes.to(device=device, dtype=torch.long)
+        gt[i] = torch.where(last > 0, classes[(last - 1).clamp(min=0)], gt[i])
+    return gt
+
+
+# Reported mIoUs and whether they leave out the background class (see confmat_miou)
+MIOU_METRICS = {"val_mean_iou": False, "val_mean_iou_no_bg": True}
+
+
+class MetricAccumulator:
+    """
+    Accumulates one MulticlassConfusionMatrix from (predictions, batch) pairs.
+
+    The mIoUs `metric_names` (keys of MIOU_METRICS) are all derived from it.
+    `update()` is meant to run in a single `BackgroundStage` thread; `progress()`
+    can be called from the main thread at any time and reads the accumulated
+    confusion matrix without `compute()` (no synchronization, no reset).
+    """
+
+    def __init__(self, confusion, num_classes, metric_names):
+        self.confusion = confusion
+        self.num_classes = num_classes
+        self.metric_names = list(metric_names)
+        self.lock = threading.Lock()
+
+    def update(self, item):
+        preds, batch = item
+        device = preds.device
+        preds = torch.clamp(preds, 0, self.num_classes - 1).long()
+        gt = reconstruct_ground_truth(batch["mask_labels"], batch["class_labels"], preds.shape[-2:], device)
+
+        with self.lock:
+            self.confusion.update(preds, gt)
+
+    def progress(self):
+        """Approximate mIoU per metric from the local confusion matrix."""
+        with self.lock:
+            return confmat_metrics(self.confusion.confmat, self.metric_names)
+
+    def compute(self):
+        """Final mIoU per metric."""
+        return confmat_metrics(self.confusion.compute(), self.metric_names)
+
+
+def confmat_metrics(confmat, metric_names):
+    """The mIoUs `metric_names` (keys of MIOU_METRICS) of a (C, C) confusion matrix."""
+    return {name: confmat_miou(confmat, exclude_background=MIOU_METRICS[name]) for name in metric_names}
+
+
+def confmat_miou(confmat, exclude_background=False):
+    """
+    Mean IoU over classes present in predictions or targets of a (C, C) confusion matrix
+    (rows: targets, columns: predictions).
+
+    With `exclude_background`, class 0 is left out: background pixels are ignored and
+    pixels of the other classes predicted as background count as misses.
+    """
+    confmat = confmat.double()
+    targets = confmat.sum(1)
+    if exclude_background:
+        targets, confmat = targets[1:], confmat[1:, 1:]
+    intersection = confmat.diag()
+    union = confmat.sum(0) + targets - intersection
+    present = union > 0
+    if not present.any():
+        return 0.0
+    return (intersection[present] / union[present]).mean().item()
+
+
+def colorize(labels, class_colors):
+    """Map an (H, W) uint8 label array to an (H, W, 3) RGB array."""
+    palette = np.zeros((256, 3), dtype=np.uint8)
+    palette[: len(class_colors)] = np.asarray(class_colors, dtype=np.uint8)
+    return palette[labels]
+
+
+class PredictionWriter:
+    """
+    Encode predicted label maps (and optional colorized overlays) to PNG in a
+    thread pool. At most `max_pending` images are in flight; `submit()` blocks
+    beyond that so a slow disk cannot grow memory without bound.
+    """
+
+    def __init__(self, output_dir, class_colors=None, overlay=False, overlay_alpha=0.5, num_workers=4, max_pending=16):
+        self.output_dir = output_dir
+        self.class_colors = class_colors
+        self.overlay = overlay and class_colors is not None
+        self.overlay_alpha = overlay_alpha
+        self.executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="png")
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.futures = []
+        self.written = 0
+        # `_write` runs on several encoding threads
+        self.lock = threading.Lock()
+        os.makedirs(output_dir, exist_ok=True)
+
+    def submit(self, labels, image_path, name=None, size=None, on_written=None):
+        """
+        Args:
+            labels: (H, W) tensor or array of class ids at model resolution
+            image_path: Source image, used for the output size and the overlay
+            name: Output file stem, may contain sub-directories (defaults to the source image stem)
+            size: (height, width) of the output; avoids decoding the source image when no overlay is written
+            on_written: Called with `image_path` (from the encoding thread) once the files are on disk
+        """
+        if isinstance(labels, torch.Tensor):
+            labels = labels.to(torch.uint8).cpu().numpy()
+        self.slots.acquire()
+        future = self.executor.submit(self._write, labels, image_path, name, size)
+        future.add_done_callback(lambda _: self.slots.release())
+        if on_written is not None:
+            future.add_done_callback(lambda f: f.exception() is None and on_written(image_path))
+        self.futures.append(future)
+        # Surface failures early and keep the future list short
+        done = [f for f in self.futures if f.done()]
+        for f in done:
+            f.result()
+        self.futures = [f for f in self.futures if not f.done()]
+
+    def _write(self, labels, image_path, name, size):
+        stem = name or os.path.splitext(os.path.basename(image_path))[0]
+        image = None
+        if size is None or self.overlay:
+            image = Image.open(image_path).convert("RGB")
+            size = (image.height, image.width)
+        label_image = Image.fromarray(labels, mode="L")
+        if label_image.size != (size[1], size[0]):
+            label_image = label_image.resize((size[1], size[0]), Image.NEAREST)
+
+        label_path = os.path.join(self.output_dir, f"{stem}.png")
+        os.makedirs(os.path.dirname(label_path), exist_ok=True)
+        # Write to a temporary name first so an interrupted run never leaves a truncated PNG
+        tmp_path = label_path + ".tmp"
+        label_image.save(tmp_path, format="PNG")
+        os.replace(tmp_path, label_path)
+
+        if self.overlay:
+            color = Image.fromarray(colorize(np.asarray(label_image), self.class_colors))
+            blended = Image.blend(image, color, self.overlay_alpha)
+            blended.save(os.path.join(self.output_dir, f"{stem}_overlay.png"))
+        with self.lock:
+            self.written += 1
+
+    def close(self):
+        for f in self.futures:
+            f.result()
+        self.executor.shutdown(wait=True)
+        return self.written
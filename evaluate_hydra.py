@@ -1,3 +1,4 @@
+import copy
 import torch
 import numpy as np
 from torch.utils.data import DataLoader
@@ -8,165 +9,534 @@ import os
 from pathlib import Path
 from tqdm import tqdm
 import json
+import time
+from types import SimpleNamespace
 
 from train_hydra import SegmentationLightningModule
+from dinov3_mask2former_integration import (
+    decoder_depth, num_decoder_layers, set_decoder_depth, set_token_merging, token_merging
+)
 from data import LoveDADataset, collate_fn
-from torchmetrics.classification import JaccardIndex
+from postprocess import post_process_from_config, prediction_agreement
+from eval_pipeline import (
+    BackgroundStage, MetricAccumulator, PredictionWriter, prefetch_to_device, reconstruct_ground_truth
+)
+from logit_cache import LogitStore, store_dir
+from adaptive import AdaptiveStats, adaptive_predict, coarse_pass
+from padding import valid_sizes_from_mask
+from tta import TTAPlan, ViewBudget, build_views
+from torchmetrics.classification import MulticlassConfusionMatrix
 
 
-@hydra.main(version_base="1.3", config_path="conf", config_name="config")
-def main(cfg: DictConfig) -> None:
+def create_metrics(cfg, device):
+    """Confusion matrix from which the mIoUs of cfg.training.validation.metrics are derived."""
+    return MulticlassConfusionMatrix(num_classes=cfg.model.num_classes, ignore_index=255).to(device)
+
+
+def metric_names(cfg):
+    """Names of the mIoUs enabled in cfg.training.validation.metrics (keys of MIOU_METRICS)."""
+    metrics_cfg = cfg.training.validation.metrics
+    return [
+        name for name, enabled in (
+            ("val_mean_iou", metrics_cfg.include_background),
+            ("val_mean_iou_no_bg", metrics_cfg.exclude_background),
+        ) if enabled
+    ]
+
+
+def resolve_sweep_checkpoints(sweep_cfg):
+    """Checkpoint paths of a sweep: explicit list plus every *.ckpt in checkpoint_dir."""
+    paths = [hydra.utils.to_absolute_path(p) for p in sweep_cfg.checkpoint_paths]
+    if sweep_cfg.checkpoint_dir:
+        ckpt_dir = Path(hydra.utils.to_absolute_path(sweep_cfg.checkpoint_dir))
+        paths += [str(p) for p in sorted(ckpt_dir.glob("*.ckpt")) if str(p) not in paths]
+    return paths
+
+
+def load_checkpoint_models(cfg, checkpoint_paths, device):
     """
-    Comprehensive model evaluation using Hydra configuration.
+    Load several checkpoints that share one frozen DINOv3 backbone.
     
-    Usage:
-        python evaluate_hydra.py checkpoint_path=/path/to/checkpoint.ckpt
-        python evaluate_hydra.py checkpoint_path=/path/to/checkpoint.ckpt training=quick_test
+    The first checkpoint is loaded normally (this loads the ViT). The others are
+    copies of that module with the ViT wrapper shared, not duplicated, and their
+    own trainable weights (adapter, pixel decoder, transformer decoder) loaded
+    from the checkpoint's state dict.
+    
+    Returns:
+        dict mapping checkpoint path -> SegmentationLightningModule (eval mode)
     """
+    models = {}
+    first = SegmentationLightningModule.load_from_checkpoint(checkpoint_paths[0], cfg=cfg)
+    first = first.to(device).eval()
+    models[checkpoint_paths[0]] = first
     
-    # Check if checkpoint path is provided
-    checkpoint_path = getattr(cfg, 'checkpoint_path', None)
-    if checkpoint_path is None:
-        print("❌ Error: Please provide checkpoint_path")
-        print("Usage: python evaluate_hydra.py checkpoint_path=/path/to/checkpoint.ckpt")
-        return
+    shared_backbone = first.model.model.pixel_level_module.encoder.dinov3_backbone
+    for checkpoint_path in checkpoint_paths[1:]:
+        print(f"📂 Loading trainable weights: {checkpoint_path}")
+        # Share (not copy) the frozen ViT: it holds no checkpoint state (kept by the load hook)
+        memo = {id(shared_backbone): shared_backbone, id(shared_backbone.model): shared_backbone.model}
+        module = copy.deepcopy(first, memo)
+        state_dict = torch.load(checkpoint_path, map_location=device, weights_only=False)["state_dict"]
+        module.load_state_dict(state_dict)
+        models[checkpoint_path] = module.eval()
+    return models
+
+
+def create_logit_store(cfg, checkpoint_path, outputs, num_samples, val_dataset):
+    """Allocate the logit store of a checkpoint from the shapes of its first outputs."""
+    cache_cfg = cfg.evaluation.logit_cache
+    path = store_dir(hydra.utils.to_absolute_path(cache_cfg.root), checkpoint_path, cfg.data.image_size)
+    _, num_queries, num_labels = outputs.class_queries_logits.shape
+    print(f"💾 Logit cache for {Path(checkpoint_path).name}: {path}")
+    return LogitStore.create(
+        path,
+        num_samples=num_samples,
+        num_queries=num_queries,
+        num_labels=num_labels,
+        mask_size=tuple(outputs.masks_queries_logits.shape[-2:]),
+        label_size=(cfg.data.image_size, cfg.data.image_size),
+        top_k=cache_cfg.top_k,
+        checkpoint_path=checkpoint_path,
+        image_size=cfg.data.image_size,
+        image_paths=list(val_dataset.image_paths),
+    )
+
+
+def _write_to_store(store, item):
+    """Logit cache stage: rebuild the ground truth and write one batch to the store."""
+    start, class_queries_logits, masks_queries_logits, batch = item
+    labels = reconstruct_ground_truth(batch['mask_labels'], batch['class_labels'], store.meta["label_size"], 'cpu')
+    store.write(start, class_queries_logits, masks_queries_logits, labels)
+
+
+def evaluate_models(cfg, models, val_loader, val_dataset, processor, device, adaptive_stats=None):
+    """
+    Run the evaluation pipeline for one or more models over the validation set.
     
-    if not os.path.exists(checkpoint_path):
-        print(f"❌ Error: Checkpoint not found: {checkpoint_path}")
-        return
+    With several models the frozen ViT runs once per batch: all models share the same
+    DINOv3 wrapper, whose intermediate layers are reused for every model's adapter
+    and decoders (see DINOv3CompatibilityWrapper.reuse_intermediate_layers).
     
-    print("🔍 DINOv3+Mask2Former Model Evaluation with Hydra")
-    print("=" * 60)
-    print(f"📁 Run directory: {os.getcwd()}")
-    print(f"📂 Checkpoint: {checkpoint_path}")
-    print(f"🎯 Dataset: {cfg.data.name}")
-    print("=" * 60)
-    
-    # Setup device
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    torch.set_float32_matmul_precision(cfg.training.precision)
+    Args:
+        adaptive_stats: With model.adaptive_resolution enabled, dict mapping model name ->
+            adaptive.AdaptiveStats, updated with the refined tiles and ViT FLOPs
     
-    # Setup processor
-    processor = AutoImageProcessor.from_pretrained(
-        cfg.model.processor.name,
-        do_reduce_labels=cfg.model.processor.do_reduce_labels,
-        ignore_index=cfg.model.processor.ignore_index,
-        size={"height": cfg.data.image_size, "width": cfg.data.image_size}
-    )
+    Returns:
+        dict mapping model name -> {metric name: score}
+    """
+    verify_cfg = cfg.evaluation.verify_post_processing
+    pipeline_cfg = cfg.evaluation.pipeline
+    export_cfg = cfg.evaluation.export
     
-    # Create validation dataset
-    val_dir = os.path.join(cfg.data.dataset_root, 'Val')
-    val_dataset = LoveDADataset(
-        val_dir, 
-        processor
-    )
+    # Pipeline stages per model: metric accumulation and PNG export run behind the forward pass
+    accumulators = {
+        name: MetricAccumulator(create_metrics(cfg, device), cfg.model.num_classes, metric_names(cfg))
+        for name in models
+    }
+    metric_stages = {
+        name: BackgroundStage(accumulators[name].update, maxsize=pipeline_cfg.metric_queue_size, name="metrics")
+        for name in models
+    }
+    writers = {}
+    if export_cfg.enabled:
+        for name in models:
+            output_dir = export_cfg.output_dir
+            if len(models) > 1:
+                output_dir = os.path.join(output_dir, Path(name).stem)
+            writers[name] = PredictionWriter(
+                output_dir,
+                class_colors=OmegaConf.to_container(cfg.data.class_colors),
+                overlay=export_cfg.overlay,
+                overlay_alpha=export_cfg.overlay_alpha,
+                num_workers=export_cfg.num_workers,
+                max_pending=export_cfg.max_pending,
+            )
+        print(f"🖼️  Writing predictions to: {Path(export_cfg.output_dir).resolve()}")
     
-    val_loader = DataLoader(
-        val_dataset, 
-        batch_size=cfg.data.batch_size, 
-        shuffle=False, 
-        num_workers=cfg.data.num_workers,
-        collate_fn=collate_fn,
-        pin_memory=cfg.data.pin_memory
-    )
+    # Optional prediction logit cache per checkpoint (re-scoring without inference)
+    cache_cfg = cfg.evaluation.logit_cache
+    tta_cfg = cfg.model.tta
+    adaptive_cfg = cfg.model.adaptive_resolution
+    if tta_cfg.enabled and adaptive_cfg.enabled:
+        raise ValueError("model.tta and model.adaptive_resolution cannot be enabled together")
+    # Plain forward: per-query logits are available (parity check, logit cache)
+    per_query = not tta_cfg.enabled and not adaptive_cfg.enabled
+    stores = {}
+    cache_stages = {}
+    if cache_cfg.enabled and tta_cfg.enabled:
+        print("⚠️  Logit cache disabled: TTA averages class scores over views, there are no per-query logits to store")
+    elif cache_cfg.enabled and adaptive_cfg.enabled:
+        print("⚠️  Logit cache disabled: adaptive resolution mixes coarse and full-resolution predictions")
+    elif cache_cfg.enabled:
+        for name in models:
+            stores[name] = None  # Allocated on the first batch, once output shapes are known
+            cache_stages[name] = BackgroundStage(
+                lambda item, name=name: _write_to_store(stores[name], item),
+                maxsize=pipeline_cfg.metric_queue_size,
+                name="logit_cache",
+            )
     
-    print(f"📊 Validation dataset: {len(val_dataset)} samples")
-    print(f"📊 Validation batches: {len(val_loader)}")
+    shared_backbone = next(iter(models.values())).model.model.pixel_level_module.encoder.dinov3_backbone
     
-    # Load model from checkpoint
-    print("📂 Loading trained model...")
-    model = SegmentationLightningModule.load_from_checkpoint(
-        checkpoint_path,
-        cfg=cfg
-    )
-    model = model.to(device)
-    model.eval()
-    
-    # Setup metrics based on configuration
-    metrics = {}
-    if cfg.training.validation.metrics.include_background:
-        metrics['val_mean_iou'] = JaccardIndex(
-            task='multiclass', 
-            num_classes=cfg.model.num_classes, 
-            ignore_index=255
-        ).to(device)
-    
-    if cfg.training.validation.metrics.exclude_background:
-        metrics['val_mean_iou_no_bg'] = JaccardIndex(
-            task='multiclass', 
-            num_classes=cfg.model.num_classes - 1,
-            ignore_index=255
-        ).to(device)
+    # Test-time augmentation: all views of a batch packed into forwards under a memory budget
+    if tta_cfg.enabled:
+        tta_views = build_views(tta_cfg)
+        tta_budget = ViewBudget.from_config(tta_cfg)
+        print(f"🔄 TTA: {len(tta_views)} views per image (post-processing parity check skipped)")
+    if adaptive_cfg.enabled:
+        print(f"🔍 Adaptive resolution: {adaptive_cfg.low_scale}× pass, full resolution where "
+              f"{adaptive_cfg.criterion} > {adaptive_cfg.threshold} (post-processing parity check skipped)")
     
     print("🧪 Running evaluation on validation set...")
     print("-" * 60)
     
     # Evaluation loop
-    with torch.no_grad():
-        for batch_idx, batch in enumerate(tqdm(val_loader, desc='Evaluating')):
-            pixel_values = batch['pixel_values'].to(device)
-            
-            # Forward pass
-            outputs = model.model(pixel_values=pixel_values)
+    batches = prefetch_to_device(val_loader, device, depth=pipeline_cfg.prefetch_batches)
+    sample_idx = 0
+    with torch.no_grad(), shared_backbone.reuse_intermediate_layers():
+        for batch_idx, batch in enumerate(tqdm(batches, desc='Evaluating', total=len(val_loader))):
+            pixel_values = batch['pixel_values']
+            target_size = tuple(pixel_values.shape[-2:])
             
-            # Post-process predictions
-            original_sizes = [tuple(img.shape[-2:]) for img in pixel_values]
-            predicted_maps = processor.post_process_semantic_segmentation(
-                outputs, target_sizes=original_sizes
-            )
-            
-            # Reconstruct ground truth
-            ground_truth_maps = []
-            for i in range(len(pixel_values)):
-                gt_map = torch.full_like(predicted_maps[i], 255)
-                for mask, class_id in zip(batch['mask_labels'][i], batch['class_labels'][i]):
-                    gt_map[mask.bool()] = class_id.item()
-                ground_truth_maps.append(gt_map)
-            
-            # Clamp predictions and convert to tensors
-            pred_maps_clamped = [torch.clamp(pred_map, 0, cfg.model.num_classes - 1) for pred_map in predicted_maps]
-            preds_tensor = torch.stack(pred_maps_clamped).to(device).long()
-            gt_tensor = torch.stack(ground_truth_maps).to(device).long()
-            
-            # Update metrics based on configuration
-            if 'val_mean_iou' in metrics:
-                metrics['val_mean_iou'].update(preds_tensor, gt_tensor)
+            if tta_cfg.enabled:
+                # Chunk-major: every chunk of views runs through all models while its ViT features are cached
+                tta_budget.calibrate(next(iter(models.values())).model, tuple(pixel_values.shape[1:]), device)
+                plan = TTAPlan(pixel_values, tta_views, tta_budget, tta_cfg.size_multiple, batch.get('pixel_mask'))
+                tta_scores = dict.fromkeys(models)
+                for entries, inputs in plan:
+                    for name, model in models.items():
+                        tta_scores[name] = plan.accumulate(tta_scores[name], entries, model.model(**inputs))
             
-            if 'val_mean_iou_no_bg' in metrics:
-                # Prepare tensors for no-background metric
-                preds_no_bg = preds_tensor.clone()
-                gt_no_bg = gt_tensor.clone()
+            for model_idx, (name, model) in enumerate(models.items()):
+                if tta_cfg.enabled:
+                    preds_tensor = plan.finalize(tta_scores[name], target_size, cfg.model.post_processing)
+                elif adaptive_cfg.enabled:
+                    preds_tensor = adaptive_predict(
+                        model.model, pixel_values, adaptive_cfg, cfg.model.post_processing,
+                        batch.get('pixel_mask'), adaptive_stats[name] if adaptive_stats else None,
+                    )
+                else:
+                    # Forward pass (the ViT features of this batch are computed once and reused)
+                    outputs = model.model(pixel_values=pixel_values, pixel_mask=batch.get('pixel_mask'))
+                    
+                    # Post-process predictions (batched, class scores combined at mask resolution)
+                    preds_tensor = post_process_from_config(outputs, target_size, cfg.model.post_processing)
                 
-                for original_class in range(cfg.model.num_classes):
-                    if original_class == 0:  # background -> ignore
-                        preds_no_bg[preds_tensor == original_class] = 255
-                        gt_no_bg[gt_tensor == original_class] = 255
-                    else:  # classes 1-6 -> 0-5
-                        preds_no_bg[preds_tensor == original_class] = original_class - 1
-                        gt_no_bg[gt_tensor == original_class] = original_class - 1
+                # Check the batched post-processing against the processor on the first batches
+                if per_query and model_idx == 0 and batch_idx < verify_cfg.num_batches:
+                    reference_maps = processor.post_process_semantic_segmentation(
+                        outputs, target_sizes=[target_size] * len(pixel_values)
+                    )
+                    agreement = prediction_agreement(preds_tensor, reference_maps)
+                    print(f"  🔬 Post-processing parity (batch {batch_idx + 1}): {agreement:.4%} pixels identical")
+                    if agreement < verify_cfg.min_agreement:
+                        raise RuntimeError(
+                            f"Batched post-processing agrees on only {agreement:.4%} of pixels "
+                            f"(< {verify_cfg.min_agreement:.4%}) with processor.post_process_semantic_segmentation"
+                        )
                 
-                metrics['val_mean_iou_no_bg'].update(preds_no_bg, gt_no_bg)
-            
-            # Show progress every 50 batches
-            if (batch_idx + 1) % 50 == 0:
-                progress_metrics = {}
-                for name, metric in metrics.items():
-                    progress_metrics[name] = metric.compute().item()
+                # Hand off to the metric thread (GT reconstruction + metric update)
+                metric_stages[name].put((preds_tensor, batch))
+                
+                # Persist fp16 logits for later re-scoring
+                if name in cache_stages:
+                    if stores[name] is None:
+                        stores[name] = create_logit_store(cfg, name, outputs, len(val_dataset), val_dataset)
+                    cache_stages[name].put((sample_idx, outputs.class_queries_logits, outputs.masks_queries_logits, batch))
                 
-                progress_str = " | ".join([f"{name}={score:.4f}" for name, score in progress_metrics.items()])
-                print(f"  Batch {batch_idx + 1}/{len(val_loader)}: {progress_str}")
+                # Queue PNG encoding (predictions at model resolution, resized to the source image)
+                if name in writers:
+                    valid_sizes = valid_sizes_from_mask(batch.get('pixel_mask'))
+                    for i in range(len(preds_tensor)):
+                        preds = preds_tensor[i] if valid_sizes is None else preds_tensor[i, :valid_sizes[i, 0], :valid_sizes[i, 1]]
+                        writers[name].submit(preds, val_dataset.image_paths[sample_idx + i])
+            sample_idx += len(pixel_values)
+            
+            # Show progress from accumulated state (no compute()/synchronization)
+            if (batch_idx + 1) % pipeline_cfg.progress_every == 0:
+                for name, accumulator in accumulators.items():
+                    progress_str = " | ".join(f"{m}={score:.4f}" for m, score in accumulator.progress().items())
+                    prefix = f"[{Path(name).stem}] " if len(models) > 1 else ""
+                    print(f"  Batch {batch_idx + 1}/{len(val_loader)}: {prefix}{progress_str}")
+    
+    for stage in metric_stages.values():
+        stage.close()
+    for name, stage in cache_stages.items():
+        stage.close()
+        if stores[name] is not None:
+            stores[name].flush()
+            print(f"💾 Logit cache: {stores[name].num_done}/{len(val_dataset)} samples in {stores[name].path}")
+    for writer in writers.values():
+        num_written = writer.close()
+        print(f"🖼️  Wrote {num_written} predictions to {Path(writer.output_dir).resolve()}")
     
     # Compute final results
-    final_results = {}
-    for name, metric in metrics.items():
-        final_results[name] = metric.compute().item()
+    return {name: accumulator.compute() for name, accumulator in accumulators.items()}
+
+
+def measure_latency(model, batches, device, warmup=1):
+    """Mean forward time (ms per batch) over (pixel_values, pixel_mask) `batches`, after `warmup` untimed batches."""
+    timings = []
+    for batch_idx, (pixel_values, pixel_mask) in enumerate(batches):
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+        start = time.perf_counter()
+        model(pixel_values=pixel_values, pixel_mask=pixel_mask)
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+        if batch_idx >= warmup:
+            timings.append((time.perf_counter() - start) * 1000.0)
+    return float(np.mean(timings)) if timings else float("nan")
+
+
+def evaluate_decoder_depths(cfg, module, val_loader, device):
+    """
+    mIoU and latency of the prediction after each transformer-decoder depth.
+    
+    mIoU for all depths comes from a single pass over the validation set: the full
+    decoder already predicts after every layer (`auxiliary_logits`). Latency is then
+    measured per depth with a truncated decoder on the first batches.
+    
+    Returns:
+        dict mapping depth -> {"metrics", "forward_ms_per_batch", "images_per_s"}
+    """
+    sweep_cfg = cfg.evaluation.depth_sweep
+    model = module.model
+    max_depth = num_decoder_layers(model)
+    depths = sorted({max_depth if d is None else int(d) for d in sweep_cfg.depths})
+    if depths[0] < 0 or depths[-1] > max_depth:
+        raise ValueError(f"evaluation.depth_sweep.depths must be in [0, {max_depth}], got {depths}")
     
+    accumulators = {
+        d: MetricAccumulator(create_metrics(cfg, device), cfg.model.num_classes, metric_names(cfg)) for d in depths
+    }
+    latency_batches = []
+    
+    print(f"🪜 Decoder depth sweep: depths {depths} of {max_depth}")
+    batches = prefetch_to_device(val_loader, device, depth=cfg.evaluation.pipeline.prefetch_batches)
+    with torch.no_grad():
+        for batch in tqdm(batches, desc='Evaluating depths', total=len(val_loader)):
+            pixel_values = batch['pixel_values']
+            target_size = tuple(pixel_values.shape[-2:])
+            outputs = model(pixel_values=pixel_values, pixel_mask=batch.get('pixel_mask'), output_auxiliary_logits=True)
+            for depth in depths:
+                depth_outputs = outputs if depth == max_depth else SimpleNamespace(**outputs.auxiliary_logits[depth])
+                preds = post_process_from_config(depth_outputs, target_size, cfg.model.post_processing)
+                accumulators[depth].update((preds, batch))
+            if len(latency_batches) < sweep_cfg.latency_batches + 1:
+                latency_batches.append((pixel_values, batch.get('pixel_mask')))
+        
+        results = {}
+        for depth in depths:
+            with decoder_depth(model, depth):
+                forward_ms = measure_latency(model, latency_batches, device)
+            images_per_batch = latency_batches[0][0].shape[0]
+            results[depth] = {
+                "metrics": accumulators[depth].compute(),
+                "forward_ms_per_batch": forward_ms,
+                "images_per_s": images_per_batch / forward_ms * 1000.0,
+            }
+    return results
+
+
+def report_depth_sweep(cfg, depth_results, checkpoint_path, num_samples):
+    """Print the mIoU / latency table of a decoder depth sweep and save depth_sweep_results.json."""
+    metric_names = list(next(iter(depth_results.values()))["metrics"].keys())
+    
+    print("=" * 60)
+    print("🪜 DECODER DEPTH SWEEP")
+    print("=" * 60)
+    print(f"Checkpoint: {checkpoint_path}")
+    print(f"Dataset: {cfg.data.name} Validation Set ({num_samples} samples)")
+    print()
+    header = f"{'Depth':>5} " + " ".join(f"{m:>20}" for m in metric_names) + f" {'ms/batch':>10} {'images/s':>10}"
+    print(header)
+    print("-" * len(header))
+    for depth, result in depth_results.items():
+        scores = " ".join(f"{result['metrics'][m]:>20.4f}" for m in metric_names)
+        print(f"{depth:>5} {scores} {result['forward_ms_per_batch']:>10.1f} {result['images_per_s']:>10.2f}")
+    
+    summary = {
+        "model": cfg.model.name,
+        "dataset": cfg.data.name,
+        "checkpoint_path": checkpoint_path,
+        "depths": {str(depth): result for depth, result in depth_results.items()},
+        "image_size": f"{cfg.data.image_size}x{cfg.data.image_size}",
+        "samples_evaluated": num_samples,
+        "config_used": OmegaConf.to_yaml(cfg),
+    }
+    results_path = Path("depth_sweep_results.json")
+    with open(results_path, "w") as f:
+        json.dump(summary, f, indent=2, default=str)
+    print(f"📄 Depth sweep results saved to: {results_path}")
+    print("=" * 60)
+
+
+def evaluate_merge_ratios(cfg, module, val_loader, device):
+    """
+    mIoU and latency of token merging in the frozen ViT for every ratio.
+    
+    Merging changes the ViT features, so every ratio takes its own pass over the
+    validation set; latency is measured on the first batches of that pass.
+    
+    Returns:
+        dict mapping ratio (str) -> {"ratio", "metrics", "forward_ms_per_batch", "images_per_s"}
+    """
+    sweep_cfg = cfg.evaluation.merge_sweep
+    model = module.model
+    ratios = [OmegaConf.to_container(r) if OmegaConf.is_list(r) else r for r in sweep_cfg.ratios]
+    
+    print(f"🧩 Token merging sweep: ratios {ratios}")
+    results = {}
+    with torch.no_grad():
+        for ratio in ratios:
+            accumulator = MetricAccumulator(create_metrics(cfg, device), cfg.model.num_classes, metric_names(cfg))
+            latency_batches = []
+            with token_merging(model, ratio):
+                batches = prefetch_to_device(val_loader, device, depth=cfg.evaluation.pipeline.prefetch_batches)
+                for batch in tqdm(batches, desc=f'Evaluating ratio {ratio}', total=len(val_loader)):
+                    pixel_values = batch['pixel_values']
+                    outputs = model(pixel_values=pixel_values, pixel_mask=batch.get('pixel_mask'))
+                    preds = post_process_from_config(outputs, tuple(pixel_values.shape[-2:]), cfg.model.post_processing)
+                    accumulator.update((preds, batch))
+                    if len(latency_batches) < sweep_cfg.latency_batches + 1:
+                        latency_batches.append((pixel_values, batch.get('pixel_mask')))
+                forward_ms = measure_latency(model, latency_batches, device)
+            results[str(ratio)] = {
+                "ratio": ratio,
+                "metrics": accumulator.compute(),
+                "forward_ms_per_batch": forward_ms,
+                "images_per_s": latency_batches[0][0].shape[0] / forward_ms * 1000.0,
+            }
+    return results
+
+
+def report_merge_sweep(cfg, merge_results, checkpoint_path, num_samples):
+    """Print the mIoU / throughput table of a token merging sweep and save merge_sweep_results.json."""
+    metric_names = list(next(iter(merge_results.values()))["metrics"].keys())
+    
+    print("=" * 60)
+    print("🧩 TOKEN MERGING SWEEP")
+    print("=" * 60)
+    print(f"Checkpoint: {checkpoint_path}")
+    print(f"Dataset: {cfg.data.name} Validation Set ({num_samples} samples)")
+    print()
+    width = max(5, *(len(key) for key in merge_results))
+    header = f"{'Ratio':>{width}} " + " ".join(f"{m:>20}" for m in metric_names) + f" {'ms/batch':>10} {'images/s':>10}"
+    print(header)
+    print("-" * len(header))
+    for key, result in merge_results.items():
+        scores = " ".join(f"{result['metrics'][m]:>20.4f}" for m in metric_names)
+        print(f"{key:>{width}} {scores} {result['forward_ms_per_batch']:>10.1f} {result['images_per_s']:>10.2f}")
+    
+    summary = {
+        "model": cfg.model.name,
+        "dataset": cfg.data.name,
+        "checkpoint_path": checkpoint_path,
+        "ratios": merge_results,
+        "image_size": f"{cfg.data.image_size}x{cfg.data.image_size}",
+        "samples_evaluated": num_samples,
+        "config_used": OmegaConf.to_yaml(cfg),
+    }
+    results_path = Path("merge_sweep_results.json")
+    with open(results_path, "w") as f:
+        json.dump(summary, f, indent=2, default=str)
+    print(f"📄 Token merging sweep results saved to: {results_path}")
+    print("=" * 60)
+
+
+def evaluate_adaptive_thresholds(cfg, module, val_loader, device):
+    """
+    mIoU, refined fraction and ViT FLOPs of adaptive resolution for every threshold.
+    
+    One coarse pass (model.adaptive_resolution.low_scale) and one full-resolution pass
+    per batch: for each threshold, tiles scoring above it take the full-resolution
+    prediction and the others the coarse one.
+    
+    Returns:
+        dict mapping threshold -> {"metrics", **AdaptiveStats.summary()}
+    """
+    adaptive_cfg = cfg.model.adaptive_resolution
+    post_cfg = cfg.model.post_processing
+    model = module.model
+    thresholds = sorted(float(t) for t in cfg.evaluation.adaptive_sweep.thresholds)
+    accumulators = {
+        t: MetricAccumulator(create_metrics(cfg, device), cfg.model.num_classes, metric_names(cfg)) for t in thresholds
+    }
+    stats = {t: AdaptiveStats.from_model(model) for t in thresholds}
+    
+    print(f"🔍 Adaptive resolution sweep: {adaptive_cfg.low_scale}× coarse pass, "
+          f"{adaptive_cfg.criterion} thresholds {thresholds}")
+    batches = prefetch_to_device(val_loader, device, depth=cfg.evaluation.pipeline.prefetch_batches)
+    with torch.no_grad():
+        for batch in tqdm(batches, desc='Evaluating thresholds', total=len(val_loader)):
+            pixel_values = batch['pixel_values']
+            pixel_mask = batch.get('pixel_mask')
+            coarse, scores, valid_sizes, low_valid_sizes = coarse_pass(
+                model, pixel_values, adaptive_cfg, post_cfg, pixel_mask
+            )
+            outputs = model(pixel_values=pixel_values, pixel_mask=pixel_mask)
+            full = post_process_from_config(outputs, tuple(pixel_values.shape[-2:]), post_cfg)
+            for threshold in thresholds:
+                refine = scores > threshold
+                preds = torch.where(refine[:, None, None], full, coarse)
+                accumulators[threshold].update((preds, batch))
+                stats[threshold].update(valid_sizes, low_valid_sizes, refine.cpu())
+    
+    return {
+        threshold: {
+            "metrics": accumulators[threshold].compute(),
+            **stats[threshold].summary(),
+        }
+        for threshold in thresholds
+    }
+
+
+def report_adaptive_sweep(cfg, sweep_results, checkpoint_path, num_samples):
+    """Print the mIoU / FLOPs table of an adaptive resolution sweep and save adaptive_sweep_results.json."""
+    metric_names = list(next(iter(sweep_results.values()))["metrics"].keys())
+    
+    print("=" * 60)
+    print("🔍 ADAPTIVE RESOLUTION SWEEP")
+    print("=" * 60)
+    print(f"Checkpoint: {checkpoint_path}")
+    print(f"Dataset: {cfg.data.name} Validation Set ({num_samples} samples)")
+    print(f"Coarse pass: {cfg.model.adaptive_resolution.low_scale}×, criterion: {cfg.model.adaptive_resolution.criterion}")
+    print()
+    header = (f"{'Threshold':>9} {'refined':>8} " + " ".join(f"{m:>20}" for m in metric_names)
+              + f" {'ViT GFLOPs/tile':>16} {'of full':>8}")
+    print(header)
+    print("-" * len(header))
+    for threshold, result in sweep_results.items():
+        scores = " ".join(f"{result['metrics'][m]:>20.4f}" for m in metric_names)
+        print(f"{threshold:>9.3f} {result['refined_fraction']:>8.1%} {scores} "
+              f"{result['vit_gflops_per_tile']:>16.1f} {result['flops_fraction']:>8.1%}")
+    
+    summary = {
+        "model": cfg.model.name,
+        "checkpoint_path": checkpoint_path,
+        "adaptive_resolution": OmegaConf.to_container(cfg.model.adaptive_resolution),
+        "thresholds": {str(threshold): result for threshold, result in sweep_results.items()},
+        "image_size": f"{cfg.data.image_size}x{cfg.data.image_size}",
+        "samples_evaluated": num_samples,
+        "config_used": OmegaConf.to_yaml(cfg),
+    }
+    results_path = Path("adaptive_sweep_results.json")
+    with open(results_path, "w") as f:
+        json.dump(summary, f, indent=2, default=str)
+    print(f"📄 Adaptive sweep results saved to: {results_path}")
+    print("=" * 60)
+
+
+def report_results(cfg, final_results, checkpoint_path, num_samples,
+                   results_filename="evaluation_results.json", extra=None):
+    """Print the evaluation report for one checkpoint and save it as JSON."""
     print("=" * 60)
     print("🏆 FINAL EVALUATION RESULTS")
     print("=" * 60)
     print(f"Model: {cfg.model.name}")
     print(f"Dataset: {cfg.data.name} Validation Set")
-    print(f"Samples Evaluated: {len(val_dataset)}")
+    print(f"Samples Evaluated: {num_samples}")
     print()
     
     # Display results based on configuration
@@ -219,11 +589,12 @@ def main(cfg: DictConfig) -> None:
         "primary_score": primary_score,
         "num_classes": cfg.model.num_classes,
         "image_size": f"{cfg.data.image_size}x{cfg.data.image_size}",
-        "samples_evaluated": len(val_dataset),
-        "config_used": OmegaConf.to_yaml(cfg)
+        "samples_evaluated": num_samples,
+        "config_used": OmegaConf.to_yaml(cfg),
+        **(extra or {}),
     }
     
-    results_path = Path("evaluation_results.json")
+    results_path = Path(results_filename)
     with open(results_path, "w") as f:
         json.dump(results_summary, f, indent=2, default=str)
     
@@ -232,5 +603,174 @@ def main(cfg: DictConfig) -> None:
     print("✅ Evaluation complete!")
 
 
+
+def report_sweep(cfg, all_results, num_samples):
+    """Print one results table for a checkpoint sweep and save sweep_results.json."""
+    metric_names = list(next(iter(all_results.values())).keys())
+    primary = cfg.training.validation.primary_metric
+    ranked = sorted(all_results.items(), key=lambda kv: kv[1].get(primary, 0), reverse=True)
+    
+    print("=" * 60)
+    print("🏆 CHECKPOINT SWEEP RESULTS")
+    print("=" * 60)
+    print(f"Model: {cfg.model.name}")
+    print(f"Dataset: {cfg.data.name} Validation Set ({num_samples} samples)")
+    print()
+    header = f"{'Checkpoint':<50} " + " ".join(f"{m:>20}" for m in metric_names)
+    print(header)
+    print("-" * len(header))
+    for path, results in ranked:
+        print(f"{Path(path).name[:50]:<50} " + " ".join(f"{results[m]:>20.4f}" for m in metric_names))
+    print()
+    print(f"🥇 Best by {primary}: {Path(ranked[0][0]).name}")
+    
+    sweep_summary = {
+        "model": cfg.model.name,
+        "dataset": cfg.data.name,
+        "primary_metric": primary,
+        "best_checkpoint": ranked[0][0],
+        "checkpoints": [
+            {"checkpoint_path": path, "evaluation_results": results, "primary_score": results.get(primary, 0)}
+            for path, results in ranked
+        ],
+        "num_classes": cfg.model.num_classes,
+        "image_size": f"{cfg.data.image_size}x{cfg.data.image_size}",
+        "samples_evaluated": num_samples,
+        "config_used": OmegaConf.to_yaml(cfg),
+    }
+    results_path = Path("sweep_results.json")
+    with open(results_path, "w") as f:
+        json.dump(sweep_summary, f, indent=2, default=str)
+    print(f"📄 Sweep results saved to: {results_path}")
+    print("=" * 60)
+    print("✅ Sweep complete!")
+
+
+@hydra.main(version_base="1.3", config_path="conf", config_name="config")
+def main(cfg: DictConfig) -> None:
+    """
+    Comprehensive model evaluation using Hydra configuration.
+    
+    Usage:
+        python evaluate_hydra.py checkpoint_path=/path/to/checkpoint.ckpt
+        python evaluate_hydra.py checkpoint_path=/path/to/checkpoint.ckpt training=quick_test
+        python evaluate_hydra.py evaluation.sweep.checkpoint_dir=runs/<run>/checkpoints
+    """
+    
+    # Multi-checkpoint sweep (one frozen ViT pass per batch for all checkpoints)
+    sweep_checkpoints = resolve_sweep_checkpoints(cfg.evaluation.sweep)
+    if sweep_checkpoints:
+        missing = [p for p in sweep_checkpoints if not os.path.exists(p)]
+        if missing:
+            print(f"❌ Error: Checkpoints not found: {missing}")
+            return
+    
+    # Check if checkpoint path is provided
+    checkpoint_path = getattr(cfg, 'checkpoint_path', None)
+    if checkpoint_path is None and not sweep_checkpoints:
+        print("❌ Error: Please provide checkpoint_path")
+        print("Usage: python evaluate_hydra.py checkpoint_path=/path/to/checkpoint.ckpt")
+        return
+    
+    if checkpoint_path is not None and not os.path.exists(checkpoint_path):
+        print(f"❌ Error: Checkpoint not found: {checkpoint_path}")
+        return
+    
+    print("🔍 DINOv3+Mask2Former Model Evaluation with Hydra")
+    print("=" * 60)
+    print(f"📁 Run directory: {os.getcwd()}")
+    if sweep_checkpoints:
+        print(f"📂 Checkpoint sweep: {len(sweep_checkpoints)} checkpoints")
+    else:
+        print(f"📂 Checkpoint: {checkpoint_path}")
+    print(f"🎯 Dataset: {cfg.data.name}")
+    print("=" * 60)
+    
+    # Setup device
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    torch.set_float32_matmul_precision(cfg.training.precision)
+    
+    # Setup processor
+    processor = AutoImageProcessor.from_pretrained(
+        cfg.model.processor.name,
+        do_reduce_labels=cfg.model.processor.do_reduce_labels,
+        ignore_index=cfg.model.processor.ignore_index,
+        do_resize=cfg.data.resize,
+        size={"height": cfg.data.image_size, "width": cfg.data.image_size}
+    )
+    
+    # Create validation dataset
+    val_dir = os.path.join(cfg.data.dataset_root, 'Val')
+    val_dataset = LoveDADataset(
+        val_dir, 
+        processor
+    )
+    
+    val_loader = DataLoader(
+        val_dataset, 
+        batch_size=cfg.data.batch_size, 
+        shuffle=False, 
+        num_workers=cfg.data.num_workers,
+        collate_fn=collate_fn,
+        pin_memory=cfg.data.pin_memory
+    )
+    
+    print(f"📊 Validation dataset: {len(val_dataset)} samples")
+    print(f"📊 Validation batches: {len(val_loader)}")
+    
+    # Load model(s) from checkpoint(s)
+    print("📂 Loading trained model...")
+    models = load_checkpoint_models(cfg, sweep_checkpoints or [checkpoint_path], device)
+    
+    # mIoU vs latency over transformer-decoder depths (single checkpoint)
+    if cfg.evaluation.depth_sweep.depths and not sweep_checkpoints:
+        depth_results = evaluate_decoder_depths(cfg, models[checkpoint_path], val_loader, device)
+        report_depth_sweep(cfg, depth_results, checkpoint_path, len(val_dataset))
+        return
+    
+    # mIoU vs throughput over ViT token merging ratios (single checkpoint)
+    if cfg.evaluation.merge_sweep.ratios and not sweep_checkpoints:
+        merge_results = evaluate_merge_ratios(cfg, models[checkpoint_path], val_loader, device)
+        report_merge_sweep(cfg, merge_results, checkpoint_path, len(val_dataset))
+        return
+    
+    # mIoU vs ViT FLOPs over adaptive resolution thresholds (single checkpoint)
+    if cfg.evaluation.adaptive_sweep.thresholds and not sweep_checkpoints:
+        sweep_results = evaluate_adaptive_thresholds(cfg, models[checkpoint_path], val_loader, device)
+        report_adaptive_sweep(cfg, sweep_results, checkpoint_path, len(val_dataset))
+        return
+    
+    # Anytime inference: stop after model.decoder_depth decoder layers
+    if cfg.model.decoder_depth is not None:
+        for module in models.values():
+            set_decoder_depth(module.model, cfg.model.decoder_depth)
+        print(f"🪜 Decoder depth: {cfg.model.decoder_depth} of {num_decoder_layers(module.model)} layers")
+    
+    # Token merging in the frozen ViT
+    if cfg.model.token_merging:
+        for module in models.values():
+            set_token_merging(module.model, cfg.model.token_merging)
+        print(f"🧩 Token merging: {cfg.model.token_merging}")
+    
+    adaptive_stats = {}
+    if cfg.model.adaptive_resolution.enabled:
+        adaptive_stats = {name: AdaptiveStats.from_model(module.model) for name, module in models.items()}
+    
+    all_results = evaluate_models(cfg, models, val_loader, val_dataset, processor, device, adaptive_stats)
+    for name, stats in adaptive_stats.items():
+        if len(models) > 1:
+            print(f"[{Path(name).stem}]", end=" ")
+        stats.print_summary()
+    
+    if sweep_checkpoints:
+        report_sweep(cfg, all_results, len(val_dataset))
+        return
+    
+    final_results = all_results[checkpoint_path]
+    
+    extra = {"adaptive_resolution": adaptive_stats[checkpoint_path].summary()} if adaptive_stats else None
+    report_results(cfg, final_results, checkpoint_path, len(val_dataset), extra=extra)
+
+
 if __name__ == "__main__":
     main() 
\ No newline at end of file
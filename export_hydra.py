@@ -0,0 +1,244 @@
+import json
+import os
+import time
+import warnings
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import hydra
+from hydra.utils import to_absolute_path
+from omegaconf import DictConfig, OmegaConf
+
+from benchmark_hydra import synchronize
+from inference import create_processor, load_model, predict_labels
+from padding import SIZE_DIVISOR, pad_batch
+from postprocess import labels_from_semantic_logits, semantic_logits
+from serve_hydra import resolve_device
+
+
+class ExportedSegmenter(nn.Module):
+    """
+    Module exported as the inference graph of one input resolution.
+
+    Takes normalized (B, 3, height, width) images, pads them to a multiple of 32
+    with the padding mask of `padding.py` (a constant at a fixed resolution) and
+    returns (labels, scores): (B, height, width) uint8 class ids and the
+    (B, num_classes, h, w) class scores at mask resolution. Labels use the
+    "logits" upsampling of postprocess.py. The frozen ViT weights are saved as
+    parameters of the graph with the rest of the model.
+    """
+
+    def __init__(self, model, image_size):
+        super().__init__()
+        self.model = model
+        self.image_size = tuple(image_size)
+        self.input_size = tuple(-(-s // SIZE_DIVISOR) * SIZE_DIVISOR for s in self.image_size)
+
+    def forward(self, pixel_values):
+        height, width = self.image_size
+        pad_h, pad_w = self.input_size[0] - height, self.input_size[1] - width
+        pixel_mask = None
+        if pad_h or pad_w:
+            pixel_values = F.pad(pixel_values, (0, pad_w, 0, pad_h))
+            pixel_mask = torch.zeros(
+                (pixel_values.shape[0], *self.input_size), dtype=torch.long, device=pixel_values.device
+            )
+            pixel_mask[:, :height, :width] = 1
+        outputs = self.model(pixel_values=pixel_values, pixel_mask=pixel_mask)
+        scores = semantic_logits(outputs.class_queries_logits, outputs.masks_queries_logits)
+        labels = labels_from_semantic_logits(scores, self.input_size, upsample="logits")
+        return labels[:, :height, :width].to(torch.uint8), scores
+
+
+def export_graph(model, image_size, batch_size, device, path):
+    """
+    Trace an ExportedSegmenter at (height, width) and save it as TorchScript.
+
+    The level shapes, the padding mask and the per-image ViT grids are constants
+    at a fixed resolution, so tracing records them once. (torch.export cannot
+    capture the padded path, whose grids depend on the mask values.)
+    """
+    segmenter = ExportedSegmenter(model, image_size).eval()
+    example = torch.randn(batch_size, 3, *image_size, device=device)
+    with torch.no_grad(), warnings.catch_warnings():
+        warnings.simplefilter("ignore", torch.jit.TracerWarning)
+        graph = torch.jit.trace(segmenter, (example,), check_trace=False)
+    graph.save(path)
+    return segmenter
+
+
+@torch.no_grad()
+def check_parity(cfg, model, graph, image_size, device):
+    """
+    Exported graph against the eager prediction path (pad_batch + predict_labels) on random inputs.
+
+    Returns:
+        dict with the largest class-score difference and the label agreement
+    """
+    export_cfg = cfg.export
+    post_cfg = OmegaConf.merge(cfg.model.post_processing, {"upsample": "logits"})
+    generator = torch.Generator().manual_seed(0)
+    max_score_diff, agreement = 0.0, []
+    for _ in range(export_cfg.parity_batches):
+        images = torch.randn(export_cfg.batch_size, 3, *image_size, generator=generator)
+        labels, scores = graph(images.to(device))
+
+        pixel_values, pixel_mask = pad_batch(list(images))
+        pixel_values = pixel_values.to(device)
+        pixel_mask = None if pixel_mask is None else pixel_mask.to(device)
+        outputs = model(pixel_values=pixel_values, pixel_mask=pixel_mask)
+        eager_scores = semantic_logits(outputs.class_queries_logits, outputs.masks_queries_logits)
+        eager_labels = predict_labels(model, pixel_values, post_cfg, pixel_mask=pixel_mask)
+        eager_labels = eager_labels[:, : image_size[0], : image_size[1]]
+
+        max_score_diff = max(max_score_diff, (scores - eager_scores).abs().max().item())
+        agreement.append((labels.long() == eager_labels).float().mean().item())
+    return {
+        "max_score_diff": max_score_diff,
+        "label_agreement": float(np.mean(agreement)),
+        "passed": max_score_diff <= export_cfg.tolerance,
+    }
+
+
+@torch.no_grad()
+def time_runtime(forward, image_size, batch_size, device, num_batches, warmup_batches):
+    """images/s and ms/batch of `forward` on random inputs."""
+    images = torch.randn(batch_size, 3, *image_size, device=device)
+    times = []
+    for i in range(warmup_batches + num_batches):
+        synchronize(device)
+        start = time.perf_counter()
+        forward(images)
+        synchronize(device)
+        if i >= warmup_batches:
+            times.append(time.perf_counter() - start)
+    return {
+        "images_per_s": batch_size * len(times) / sum(times),
+        "ms_per_batch": 1000.0 * float(np.mean(times)),
+    }
+
+
+def preprocessing_metadata(processor):
+    """Preprocessing the exported graph expects, for hosts without the processor."""
+    return {
+        "rescale_factor": processor.rescale_factor,
+        "image_mean": list(processor.image_mean),
+        "image_std": list(processor.image_std),
+        "channel_order": "RGB",
+        "layout": "NCHW float32, normalized: (pixel * rescale_factor - mean) / std",
+    }
+
+
+@hydra.main(version_base="1.3", config_path="conf", config_name="config")
+def main(cfg: DictConfig) -> None:
+    """
+    Export the full DINOv3+adapter+Mask2Former model as TorchScript graphs at fixed resolutions.
+
+    Every size in `export.image_sizes` gets one graph (`model_<H>x<W>.pt`) that needs only
+    torch to load: no transformers, remote code or this repository. Each graph is checked against the eager model and timed
+    against it; if any graph exceeds `export.tolerance`, the failed graphs are removed and
+    the command exits with status 1.
+
+    Usage:
+        python export_hydra.py checkpoint_path=/path/to/checkpoint.ckpt
+        python export_hydra.py checkpoint_path=... export.image_sizes=[512,720,1024] export.batch_size=4
+        python export_hydra.py checkpoint_path=... export.device=cuda
+
+        # On the inference host
+        graph = torch.jit.load("model_720x720.pt")
+        labels, scores = graph(pixel_values)   # (B, 3, 720, 720) normalized images
+    """
+    checkpoint_path = getattr(cfg, 'checkpoint_path', None)
+    if checkpoint_path is not None and not os.path.exists(checkpoint_path):
+        print(f"❌ Error: Checkpoint not found: {checkpoint_path}")
+        return
+
+    export_cfg = cfg.export
+    device = resolve_device(export_cfg.device)
+    output_dir = to_absolute_path(export_cfg.output_dir)
+    os.makedirs(output_dir, exist_ok=True)
+    torch.set_float32_matmul_precision(cfg.training.precision)
+
+    print("📦 DINOv3+Mask2Former Export")
+    print("=" * 60)
+    print(f"📂 Checkpoint: {checkpoint_path or 'none (untrained heads)'}")
+    print(f"🖥️  Device: {device}")
+    print(f"📐 Sizes: {list(export_cfg.image_sizes)}, batch size {export_cfg.batch_size}")
+    print(f"📤 Output: {output_dir}")
+    print("=" * 60)
+
+    processor = create_processor(cfg)
+    model = load_model(cfg, checkpoint_path, device)
+    # The graph is traced on one thread: no background ViT thread or side stream
+    model.model.pixel_level_module.encoder.adapter.schedule = "sequential"
+
+    graphs = []
+    for size in export_cfg.image_sizes:
+        image_size = (size, size) if isinstance(size, int) else tuple(size)
+        name = f"model_{image_size[0]}x{image_size[1]}.pt"
+        path = os.path.join(output_dir, name)
+        print(f"\n🔧 Tracing {image_size[0]}×{image_size[1]} → {name}")
+        segmenter = export_graph(model, image_size, export_cfg.batch_size, device, path)
+        graph = torch.jit.load(path, map_location=device)
+
+        parity = check_parity(cfg, model, graph, image_size, device)
+        status = "✅" if parity["passed"] else "❌"
+        print(f"   {status} Parity: max class-score difference {parity['max_score_diff']:.2e} "
+              f"(tolerance {export_cfg.tolerance:.0e}), label agreement {parity['label_agreement']:.4%}")
+
+        timing = {
+            runtime: time_runtime(
+                forward, image_size, export_cfg.batch_size, device,
+                export_cfg.benchmark_batches, export_cfg.warmup_batches,
+            )
+            for runtime, forward in (("eager", segmenter), ("exported", graph))
+        }
+        print(f"   ⏱️  Eager {timing['eager']['images_per_s']:.2f} images/s, "
+              f"exported {timing['exported']['images_per_s']:.2f} images/s")
+
+        graphs.append({
+            "file": name,
+            "image_size": list(image_size),
+            "input_size": list(segmenter.input_size),
+            "size_mb": os.path.getsize(path) / 2**20,
+            "parity": parity,
+            "timing": timing,
+        })
+
+    metadata = {
+        "model": cfg.model.name,
+        "checkpoint_path": checkpoint_path,
+        "format": "torchscript",
+        "torch_version": torch.__version__,
+        "batch_size": export_cfg.batch_size,
+        "device": str(device),
+        "outputs": {
+            "labels": "(B, height, width) uint8 class ids",
+            "scores": "(B, num_classes, h, w) float32 class scores at mask resolution (1/4 of the padded input)",
+        },
+        "class_names": list(cfg.data.class_names),
+        "class_colors": [list(c) for c in cfg.data.class_colors],
+        "preprocessing": preprocessing_metadata(processor),
+        "graphs": graphs,
+    }
+    metadata_path = os.path.join(output_dir, "export_metadata.json")
+    with open(metadata_path, "w") as f:
+        json.dump(metadata, f, indent=2, default=str)
+
+    print("\n" + "=" * 60)
+    print(f"📄 Metadata: {metadata_path}")
+    failed = [g["file"] for g in graphs if not g["parity"]["passed"]]
+    if failed:
+        # Failed graphs are not left where a deployment could pick them up
+        for name in failed:
+            os.remove(os.path.join(output_dir, name))
+        print(f"❌ Parity check failed for {failed} (removed; their results are kept in the metadata)")
+        print("=" * 60)
+        raise SystemExit(1)
+    print(f"✅ {len(graphs)} graph(s) exported and checked")
+    print("=" * 60)
+
+
+if __name__ == "__main__":
+    main()
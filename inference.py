@@ -0,0 +1,140 @@
+"""
+Shared inference helpers: processor/model loading and image → label map prediction.
+
+Used by the inference server (serve_hydra.py) and other entry points that run
+the model outside of training/evaluation.
+"""
+
+import io
+
+import numpy as np
+import torch
+from PIL import Image
+from transformers import AutoImageProcessor
+
+from adaptive import adaptive_predict
+from cpu_inference import configure_threads, optimize_for_cpu
+from postprocess import post_process_from_config
+from tta import tta_predict
+
+
+def create_processor(cfg):
+    """Mask2Former image processor configured like training (resize to data.image_size unless data.resize=false)."""
+    return AutoImageProcessor.from_pretrained(
+        cfg.model.processor.name,
+        do_reduce_labels=cfg.model.processor.do_reduce_labels,
+        ignore_index=cfg.model.processor.ignore_index,
+        do_resize=cfg.data.resize,
+        size={"height": cfg.data.image_size, "width": cfg.data.image_size}
+    )
+
+
+def load_model(cfg, checkpoint_path=None, device="cpu"):
+    """
+    Load the Mask2Former model for inference.
+
+    Args:
+        cfg: Hydra configuration
+        checkpoint_path: Lightning checkpoint; None keeps the randomly initialized
+            adapter/class predictor (useful to test the serving stack without a trained model)
+        device: Target device
+
+    Returns:
+        Mask2FormerForUniversalSegmentation in eval mode
+    """
+    # Imported here so light-weight users of this module do not pull in Lightning
+    from train_hydra import SegmentationLightningModule
+    from dinov3_mask2former_integration import num_decoder_layers, set_decoder_depth, set_token_merging
+
+    cpu_cfg = cfg.model.cpu_inference
+    cpu_mode = cpu_cfg.enabled and torch.device(device).type == "cpu"
+    if cpu_mode:
+        # Before the model is built: inter-op threads cannot be changed after parallel work
+        threads = configure_threads(cpu_cfg.intra_op_threads, cpu_cfg.inter_op_threads, cpu_cfg.cores)
+        print(f"🧵 CPU threads: {threads['intra_op_threads']} intra-op, {threads['inter_op_threads']} inter-op"
+              + (f", {len(threads['cores'])} cores" if threads["cores"] is not None else ""))
+    if checkpoint_path is None:
+        print("⚠️  No checkpoint_path given: serving with untrained adapter and class predictor weights")
+        module = SegmentationLightningModule(cfg)
+    else:
+        module = SegmentationLightningModule.load_from_checkpoint(checkpoint_path, cfg=cfg)
+    model = module.model.to(device).eval()
+    if cfg.model.decoder_depth is not None:
+        set_decoder_depth(model, cfg.model.decoder_depth)
+        print(f"🪜 Decoder depth: {cfg.model.decoder_depth} of {num_decoder_layers(model)} layers")
+    if cfg.model.token_merging:
+        set_token_merging(model, cfg.model.token_merging)
+        print(f"🧩 Token merging: {cfg.model.token_merging}")
+    if cpu_mode:
+        applied = optimize_for_cpu(model, cpu_cfg)
+        print(f"🖥️  CPU mode: {applied['folded_batch_norms']} SPM BatchNorms folded, output norms folded: "
+              f"{applied['folded_output_norms'] or 'none'}, channels_last={applied['channels_last']}")
+    return model
+
+
+def preprocess_image(processor, image):
+    """
+    Convert a PIL image into model input.
+
+    Returns:
+        (pixel_values (3, H, W) tensor, original (height, width))
+    """
+    image = image.convert("RGB")
+    pixel_values = processor(images=image, return_tensors="pt")["pixel_values"][0]
+    return pixel_values, (image.height, image.width)
+
+
+def decode_image(data):
+    """Decode encoded image bytes (PNG, JPEG, TIFF, ...) into a PIL image."""
+    return Image.open(io.BytesIO(data))
+
+
+@torch.no_grad()
+def predict_labels(
+    model, pixel_values, post_cfg, tta_cfg=None, tta_budget=None, pixel_mask=None, adaptive_cfg=None,
+    adaptive_stats=None,
+):
+    """
+    Run the model and the batched semantic post-processing.
+
+    Args:
+        model: Mask2Former model
+        pixel_values: (B, 3, H, W) tensor on the model's device
+        post_cfg: cfg.model.post_processing
+        tta_cfg: cfg.model.tta; with `enabled` the scores are averaged over the TTA views
+        tta_budget: tta.ViewBudget reused across calls (keeps the CUDA calibration)
+        pixel_mask: Optional (B, H, W) padding mask of a batch of mixed-size images
+            (see padding.py); labels on padded pixels are meaningless
+        adaptive_cfg: cfg.model.adaptive_resolution; with `enabled` a coarse pass decides
+            which tiles are run at full resolution (adaptive.py)
+        adaptive_stats: adaptive.AdaptiveStats counting refined tiles and ViT FLOPs
+
+    Returns:
+        (B, H, W) tensor of class ids at input resolution
+    """
+    adaptive = adaptive_cfg is not None and adaptive_cfg.enabled
+    if tta_cfg is not None and tta_cfg.enabled:
+        if adaptive:
+            raise ValueError("model.tta and model.adaptive_resolution cannot be enabled together")
+        return tta_predict(model, pixel_values, tta_cfg, post_cfg, tta_budget, pixel_mask)
+    if adaptive:
+        return adaptive_predict(model, pixel_values, adaptive_cfg, post_cfg, pixel_mask, adaptive_stats)
+    outputs = model(pixel_values=pixel_values, pixel_mask=pixel_mask)
+    return post_process_from_config(outputs, tuple(pixel_values.shape[-2:]), post_cfg)
+
+
+def resize_labels(labels, size):
+    """Resize an (H, W) label map to (height, width) with nearest neighbour; returns uint8 numpy."""
+    if isinstance(labels, torch.Tensor):
+        labels = labels.to(torch.uint8).cpu().numpy()
+    labels = labels.astype(np.uint8, copy=False)
+    if labels.shape != tuple(size):
+        labels = np.asarray(Image.fromarray(labels, mode="L").resize((size[1], size[0]), Image.NEAREST))
+    return labels
+
+
+def encode_png(labels):
+    """Encode a uint8 (H, W) label map as PNG bytes."""
+    buffer = io.BytesIO()
+    Image.fromarray(labels, mode="L").save(buffer, format="PNG")
+    return buffer.getvalue()
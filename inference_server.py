@@ -0,0 +1,312 @@
+"""
+asyncio HTTP inference server with dynamic request batching.
+
+Incoming tiles are decoded and preprocessed in a thread pool, queued, and
+grouped into batches of up to `max_batch_size` images or whatever has arrived
+when the oldest request has waited `max_latency_ms`. Each batch runs one
+forward + semantic post-processing in a dedicated model thread, and every
+request gets back its own label map.
+
+Endpoints:
+    POST /predict[?format=png|raw]   body: encoded image (PNG/JPEG/...)
+        png (default): label map as a grayscale PNG (class ids)
+        raw:           uint8 class ids, row-major; shape in X-Height / X-Width headers
+    GET  /health                     {"status": "ok", ...}
+    GET  /metrics                    queue depth, batch size histogram, p50/p99 latency
+
+The server is model-agnostic: it is constructed with a `preprocess_fn`
+(bytes → (pixel_values, original_size)) and a `predict_fn`
+((pixel_values batch, pixel_mask) → label maps), so it runs on CPU with any (also
+randomly initialized) model. Requests of different sizes share a forward as a
+padded batch (see padding.py).
+"""
+
+import asyncio
+import json
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+import torch
+
+from inference import encode_png, resize_labels
+from padding import pad_batch
+
+_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+            413: "Payload Too Large", 500: "Internal Server Error", 503: "Service Unavailable"}
+
+
+class _Request:
+    __slots__ = ("pixel_values", "original_size", "future", "enqueued")
+
+    def __init__(self, pixel_values, original_size, future):
+        self.pixel_values = pixel_values
+        self.original_size = original_size
+        self.future = future
+        self.enqueued = time.perf_counter()
+
+
+class ServerStats:
+    """Counters and latency samples reported by /metrics."""
+
+    def __init__(self, window=10000):
+        self.batch_sizes = Counter()
+        self.latencies_ms = deque(maxlen=window)
+        self.forward_ms = deque(maxlen=window)
+        self.requests = 0
+        self.errors = 0
+        self.rejected = 0
+        self.started = time.time()
+
+    def snapshot(self, queue_depth):
+        latencies = np.asarray(self.latencies_ms) if self.latencies_ms else np.zeros(1)
+        forward = np.asarray(self.forward_ms) if self.forward_ms else np.zeros(1)
+        num_batches = sum(self.batch_sizes.values())
+        return {
+            "queue_depth": queue_depth,
+            "requests": self.requests,
+            "errors": self.errors,
+            "rejected": self.rejected,
+            "batches": num_batches,
+            "mean_batch_size": (sum(k * v for k, v in self.batch_sizes.items()) / num_batches) if num_batches else 0.0,
+            "batch_size_histogram": {str(k): v for k, v in sorted(self.batch_sizes.items())},
+            "latency_ms": {
+                "p50": float(np.percentile(latencies, 50)),
+                "p99": float(np.percentile(latencies, 99)),
+                "max": float(latencies.max()),
+            },
+            "forward_ms": {"p50": float(np.percentile(forward, 50)), "p99": float(np.percentile(forward, 99))},
+            "uptime_s": time.time() - self.started,
+        }
+
+
+class InferenceServer:
+    """
+    Dynamic-batching HTTP server around a segmentation model.
+
+    Args:
+        preprocess_fn: bytes -> (pixel_values (3, H, W) tensor, (orig_height, orig_width));
+            runs in the preprocessing thread pool
+        predict_fn: ((B, 3, H, W) tensor, (B, H, W) pixel mask or None) -> (B, H, W) label
+            tensor; runs in the model thread
+        max_batch_size: Upper bound on images per forward
+        max_latency_ms: Longest time the first request of a batch waits for more requests
+        max_queue_size: Requests queued beyond this are rejected with 503
+        num_preprocess_workers: Threads for decoding/preprocessing and PNG encoding
+        max_body_bytes: Largest accepted request body
+    """
+
+    def __init__(
+        self,
+        preprocess_fn,
+        predict_fn,
+        max_batch_size=8,
+        max_latency_ms=20.0,
+        max_queue_size=256,
+        num_preprocess_workers=4,
+        max_body_bytes=64 * 1024 * 1024,
+    ):
+        self.preprocess_fn = preprocess_fn
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1000.0
+        self.max_queue_size = max_queue_size
+        self.max_body_bytes = max_body_bytes
+        self.stats = ServerStats()
+
+        self._cpu_pool = ThreadPoolExecutor(max_workers=num_preprocess_workers, thread_name_prefix="preprocess")
+        # A single model thread: batches run one after another, never concurrently
+        self._model_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="model")
+        self._queue = None
+        self._batcher = None
+        self._server = None
+
+    # ------------------------------------------------------------------
+    # Lifecycle
+    # ------------------------------------------------------------------
+    async def start(self, host="127.0.0.1", port=8080):
+        """Start the batcher and listen on (host, port). Port 0 picks a free port."""
+        self._queue = asyncio.Queue(maxsize=self.max_queue_size)
+        self._batcher = asyncio.create_task(self._batch_loop())
+        self._server = await asyncio.start_server(self._handle_connection, host, port)
+        return self._server.sockets[0].getsockname()[:2]
+
+    async def serve_forever(self):
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        if self._batcher is not None:
+            self._batcher.cancel()
+            try:
+                await self._batcher
+            except asyncio.CancelledError:
+                pass
+        self._cpu_pool.shutdown(wait=False)
+        self._model_pool.shutdown(wait=True)
+
+    # ------------------------------------------------------------------
+    # Batching
+    # ------------------------------------------------------------------
+    async def predict(self, image_bytes):
+        """Queue one encoded image and wait for its label map at the original size (uint8 numpy)."""
+        loop = asyncio.get_running_loop()
+        pixel_values, original_size = await loop.run_in_executor(self._cpu_pool, self.preprocess_fn, image_bytes)
+        request = _Request(pixel_values, original_size, loop.create_future())
+        try:
+            self._queue.put_nowait(request)
+        except asyncio.QueueFull:
+            self.stats.rejected += 1
+            raise
+        labels = await request.future
+        self.stats.latencies_ms.append((time.perf_counter() - request.enqueued) * 1000.0)
+        return labels
+
+    async def _collect_batch(self):
+        """Wait for one request, then gather more until the batch is full or the deadline passes."""
+        first = await self._queue.get()
+        batch = [first]
+        deadline = first.enqueued + self.max_latency
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                # Deadline passed: still take whatever is already waiting
+                while len(batch) < self.max_batch_size and not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    def _run_batch(self, batch):
+        """Model thread: pad, forward, post-process and resize each map to its original size."""
+        start = time.perf_counter()
+        # Requests of different preprocessed sizes share one padded forward
+        pixel_values, pixel_mask = pad_batch([request.pixel_values for request in batch])
+        labels = self.predict_fn(pixel_values, pixel_mask).to(torch.uint8).cpu()
+        results = []
+        for j, request in enumerate(batch):
+            height, width = request.pixel_values.shape[-2:]
+            results.append(resize_labels(labels[j, :height, :width], request.original_size))
+        self.stats.forward_ms.append((time.perf_counter() - start) * 1000.0)
+        return results
+
+    async def _batch_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect_batch()
+            self.stats.batch_sizes[len(batch)] += 1
+            try:
+                results = await loop.run_in_executor(self._model_pool, self._run_batch, batch)
+            except Exception as e:  # Fail the whole batch, keep serving
+                self.stats.errors += len(batch)
+                for request in batch:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+                continue
+            for request, labels in zip(batch, results):
+                if not request.future.done():
+                    request.future.set_result(labels)
+
+    # ------------------------------------------------------------------
+    # HTTP
+    # ------------------------------------------------------------------
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                try:
+                    method, target, _ = request_line.decode("latin-1").split(" ", 2)
+                except ValueError:
+                    await self._respond(writer, 400, b"malformed request line")
+                    break
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    key, _, value = line.decode("latin-1").partition(":")
+                    headers[key.strip().lower()] = value.strip()
+
+                try:
+                    length = int(headers.get("content-length", 0))
+                    if length < 0:
+                        raise ValueError(length)
+                except ValueError:
+                    # The body cannot be delimited: answer and drop the connection
+                    await self._respond(writer, 400, b"malformed content-length")
+                    break
+                if length > self.max_body_bytes:
+                    await self._respond(writer, 413, b"request body too large")
+                    break
+                body = await reader.readexactly(length) if length else b""
+
+                keep_alive = headers.get("connection", "").lower() != "close"
+                await self._dispatch(writer, method, target, body)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionResetError):
+            pass
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionResetError:
+                pass
+
+    async def _dispatch(self, writer, method, target, body):
+        url = urlsplit(target)
+        if url.path == "/health":
+            payload = {"status": "ok", "queue_depth": self._queue.qsize(), "max_batch_size": self.max_batch_size}
+            return await self._respond_json(writer, 200, payload)
+        if url.path == "/metrics":
+            return await self._respond_json(writer, 200, self.stats.snapshot(self._queue.qsize()))
+        if url.path != "/predict":
+            return await self._respond(writer, 404, b"not found")
+        if method != "POST":
+            return await self._respond(writer, 405, b"use POST with an encoded image body")
+
+        output_format = parse_qs(url.query).get("format", ["png"])[0]
+        if output_format not in ("png", "raw"):
+            return await self._respond(writer, 400, b"format must be png or raw")
+
+        self.stats.requests += 1
+        try:
+            labels = await self.predict(body)
+        except asyncio.QueueFull:
+            return await self._respond(writer, 503, b"queue full")
+        except (OSError, ValueError) as e:  # Undecodable image
+            self.stats.errors += 1
+            return await self._respond(writer, 400, f"invalid image: {e}".encode())
+        except Exception as e:
+            return await self._respond(writer, 500, f"inference failed: {e}".encode())
+
+        height, width = labels.shape
+        extra = {"X-Height": str(height), "X-Width": str(width)}
+        if output_format == "raw":
+            return await self._respond(writer, 200, labels.tobytes(), "application/octet-stream", extra)
+        png = await asyncio.get_running_loop().run_in_executor(self._cpu_pool, encode_png, labels)
+        return await self._respond(writer, 200, png, "image/png", extra)
+
+    async def _respond_json(self, writer, status, payload):
+        await self._respond(writer, status, json.dumps(payload).encode(), "application/json")
+
+    async def _respond(self, writer, status, body, content_type="text/plain", extra_headers=None):
+        headers = [
+            f"HTTP/1.1 {status} {_REASONS.get(status, '')}",
+            f"Content-Type: {content_type}",
+            f"Content-Length: {len(body)}",
+        ]
+        headers += [f"{k}: {v}" for k, v in (extra_headers or {}).items()]
+        writer.write(("\r\n".join(headers) + "\r\n\r\n").encode("latin-1") + body)
+        await writer.drain()
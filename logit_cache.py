@@ -0,0 +1,157 @@
+"""
+Memory-mapped store of per-image Mask2Former predictions for re-scoring.
+
+evaluate_hydra.py can persist, for every validation image, the class logits and
+the mask logits at model (1/4) resolution in fp16, plus the ground-truth label
+map. rescore_hydra.py then recomputes all metrics from the store with the
+current post-processing and metric settings, without running the model.
+
+Layout of one store (one directory per checkpoint hash and image size):
+
+    <root>/<sha256[:16]>_<image_size>/
+        meta.json           shapes, checkpoint path, image paths
+        class_logits.npy    (N, K, num_classes + 1) float16
+        mask_logits.npy     (N, K, h, w)            float16
+        labels.npy          (N, H, W)               uint8, 255 = ignore
+        done.npy            (N,)                    bool, written samples
+
+K is the number of queries kept per image (all queries, or the top-k by
+non-null class probability when `top_k` is set).
+"""
+
+import hashlib
+import json
+import os
+from datetime import datetime
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+
+
+def checkpoint_hash(checkpoint_path, chunk_size=1 << 24):
+    """SHA-256 of the checkpoint file contents (hex)."""
+    digest = hashlib.sha256()
+    with open(checkpoint_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def store_dir(root, checkpoint_path, image_size):
+    """Directory of the store for a checkpoint and input resolution."""
+    return os.path.join(root, f"{checkpoint_hash(checkpoint_path)[:16]}_{image_size}")
+
+
+def select_top_queries(class_queries_logits, masks_queries_logits, top_k):
+    """
+    Keep the `top_k` queries with the highest non-null class probability per image.
+
+    Returns:
+        (class_logits (B, K, C+1), mask_logits (B, K, h, w))
+    """
+    if top_k is None or top_k >= class_queries_logits.shape[1]:
+        return class_queries_logits, masks_queries_logits
+    scores = class_queries_logits.softmax(dim=-1)[..., :-1].max(dim=-1).values
+    idx = scores.topk(top_k, dim=1).indices
+    class_logits = torch.gather(class_queries_logits, 1, idx[..., None].expand(-1, -1, class_queries_logits.shape[-1]))
+    h, w = masks_queries_logits.shape[-2:]
+    mask_logits = torch.gather(masks_queries_logits, 1, idx[..., None, None].expand(-1, -1, h, w))
+    return class_logits, mask_logits
+
+
+class LogitStore:
+    """
+    Read/write access to one memory-mapped prediction store.
+
+    Use `LogitStore.create(...)` before evaluation and `LogitStore.open(path)`
+    for re-scoring.
+    """
+
+    def __init__(self, path, meta, mode):
+        self.path = path
+        self.meta = meta
+        self.class_logits = np.load(os.path.join(path, "class_logits.npy"), mmap_mode=mode)
+        self.mask_logits = np.load(os.path.join(path, "mask_logits.npy"), mmap_mode=mode)
+        self.labels = np.load(os.path.join(path, "labels.npy"), mmap_mode=mode)
+        self.done = np.load(os.path.join(path, "done.npy"), mmap_mode=mode)
+
+    @classmethod
+    def create(cls, path, num_samples, num_queries, num_labels, mask_size, label_size, top_k=None, **meta):
+        """Allocate a new store (existing arrays in `path` are overwritten)."""
+        os.makedirs(path, exist_ok=True)
+        kept = num_queries if top_k is None else min(top_k, num_queries)
+        arrays = {
+            "class_logits.npy": ((num_samples, kept, num_labels), np.float16),
+            "mask_logits.npy": ((num_samples, kept, *mask_size), np.float16),
+            "labels.npy": ((num_samples, *label_size), np.uint8),
+            "done.npy": ((num_samples,), np.bool_),
+        }
+        for filename, (shape, dtype) in arrays.items():
+            array = np.lib.format.open_memmap(os.path.join(path, filename), mode="w+", dtype=dtype, shape=shape)
+            array[...] = 0
+            array.flush()
+            del array
+
+        meta = {
+            "num_samples": num_samples,
+            "num_queries": num_queries,
+            "queries_kept": kept,
+            "num_labels": num_labels,
+            "mask_size": list(mask_size),
+            "label_size": list(label_size),
+            "created": datetime.now().isoformat(timespec="seconds"),
+            **meta,
+        }
+        with open(os.path.join(path, "meta.json"), "w") as f:
+            json.dump(meta, f, indent=2, default=str)
+        return cls(path, meta, mode="r+")
+
+    @classmethod
+    def open(cls, path):
+        """Open an existing store read-only."""
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        return cls(path, meta, mode="r")
+
+    @property
+    def num_done(self):
+        return int(self.done.sum())
+
+    def write(self, start, class_queries_logits, masks_queries_logits, labels):
+        """
+        Store a batch of predictions for samples start .. start + B - 1.
+
+        Args:
+            start: Dataset index of the first sample in the batch
+            class_queries_logits: (B, Q, C+1) tensor
+            masks_queries_logits: (B, Q, h, w) tensor
+            labels: (B, H, W) ground-truth tensor (255 = ignore)
+        """
+        class_logits, mask_logits = select_top_queries(
+            class_queries_logits.float(), masks_queries_logits.float(), self.meta["queries_kept"]
+        )
+        end = start + class_logits.shape[0]
+        self.class_logits[start:end] = class_logits.half().cpu().numpy()
+        self.mask_logits[start:end] = mask_logits.half().cpu().numpy()
+        self.labels[start:end] = labels.to(torch.uint8).cpu().numpy()
+        self.done[start:end] = True
+
+    def batches(self, batch_size, device="cpu"):
+        """
+        Yield (indices, outputs, labels) for all written samples, where `outputs`
+        mimics the model output (`class_queries_logits`, `masks_queries_logits`).
+        """
+        indices = np.flatnonzero(self.done)
+        for start in range(0, len(indices), batch_size):
+            idx = indices[start : start + batch_size]
+            outputs = SimpleNamespace(
+                class_queries_logits=torch.from_numpy(np.asarray(self.class_logits[idx])).to(device).float(),
+                masks_queries_logits=torch.from_numpy(np.asarray(self.mask_logits[idx])).to(device).float(),
+            )
+            labels = torch.from_numpy(np.asarray(self.labels[idx])).to(device).long()
+            yield idx, outputs, labels
+
+    def flush(self):
+        for array in (self.class_logits, self.mask_logits, self.labels, self.done):
+            array.flush()
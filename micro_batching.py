@@ -0,0 +1,146 @@
+"""
+Micro-batching: the largest batch that fits, accumulated to a target batch size.
+
+With `training.effective_batch_size` set, the DataLoaders are built with a
+micro-batch size and Lightning accumulates `effective / micro` micro-batches
+per optimizer step, so one config runs unchanged on devices with different
+memory. The micro-batch size is the largest divisor of the effective batch
+size (so the effective batch is exact) that fits:
+
+- on CUDA, a full training step (forward, Mask2Former loss, backward) at the
+  training resolution is tried for each candidate, largest first; a candidate
+  fits if it does not run out of memory and its peak plus the AdamW moments
+  (not allocated yet) stays within `memory_fraction` of the device memory,
+- elsewhere there is no out-of-memory error to catch, so the step memory is
+  estimated with the activation measurement of checkpointing.py (weights,
+  optimizer state and peak activations under the active checkpointing policy)
+  against `memory_fraction` of the host memory.
+
+Probing restores the BatchNorm statistics and leaves no gradients behind.
+"""
+
+import torch
+from torch.utils.data import DataLoader, RandomSampler
+
+from checkpointing import (
+    checkpointed_groups,
+    device_memory_bytes,
+    estimate_policy,
+    measure_activations,
+    static_bytes,
+)
+
+
+def micro_batch_candidates(effective_batch_size, max_micro_batch_size=None):
+    """Divisors of the effective batch size up to `max_micro_batch_size`, largest first."""
+    limit = min(effective_batch_size, max_micro_batch_size or effective_batch_size)
+    return [size for size in range(limit, 0, -1) if effective_batch_size % size == 0]
+
+
+def probe_inputs(batch_size, image_size, num_labels, device):
+    """Random images with `num_labels` horizontal stripe masks each (the loss cost grows with the masks)."""
+    pixel_values = torch.randn(batch_size, 3, image_size, image_size, device=device)
+    stripes = torch.arange(image_size, device=device) * num_labels // image_size
+    masks = (stripes[None, :, None] == torch.arange(num_labels, device=device)[:, None, None])
+    masks = masks.expand(-1, -1, image_size).float()
+    labels = torch.arange(num_labels, device=device)
+    return pixel_values, [masks] * batch_size, [labels] * batch_size
+
+
+def try_training_step(model, batch_size, image_size, device):
+    """
+    Peak CUDA memory (bytes) of one training step at `batch_size`, or None if it runs out of memory.
+    """
+    buffers = [buffer.clone() for buffer in model.buffers()]
+    num_labels = model.config.num_labels
+    outputs = None
+    torch.cuda.empty_cache()
+    torch.cuda.reset_peak_memory_stats(device)
+    try:
+        pixel_values, mask_labels, class_labels = probe_inputs(batch_size, image_size, num_labels, device)
+        outputs = model(pixel_values=pixel_values, mask_labels=mask_labels, class_labels=class_labels)
+        outputs.loss.backward()
+        torch.cuda.synchronize(device)
+        return torch.cuda.max_memory_allocated(device)
+    except torch.cuda.OutOfMemoryError:
+        return None
+    finally:
+        del outputs
+        model.zero_grad(set_to_none=True)
+        with torch.no_grad():
+            for buffer, saved in zip(model.buffers(), buffers):
+                buffer.copy_(saved)
+        torch.cuda.empty_cache()
+
+
+def probe_micro_batch_size(model, image_size, effective_batch_size, device,
+                           max_micro_batch_size=None, memory_fraction=0.9):
+    """
+    Largest micro-batch size that fits, with the accumulation steps reaching `effective_batch_size`.
+
+    Args:
+        model: Mask2FormerForUniversalSegmentation with its training checkpointing policy applied
+        image_size: Training resolution (square, as the processor outputs it)
+        effective_batch_size: Images per optimizer step
+        device: Training device
+        max_micro_batch_size: Upper bound of the probed sizes (None = effective_batch_size)
+        memory_fraction: Share of the device memory a micro-batch may use
+
+    Returns:
+        dict with "micro_batch_size", "accumulate_grad_batches", "effective_batch_size",
+        the probe "method", the "budget_mb" and every probed size
+    """
+    device = torch.device(device)
+    budget = memory_fraction * device_memory_bytes(device)
+    candidates = micro_batch_candidates(effective_batch_size, max_micro_batch_size)
+    training = model.training
+    model.to(device).train()
+
+    probes = []
+    if device.type == "cuda":
+        method = "training step"
+        moments = 2 * sum(p.numel() * p.element_size() for p in model.parameters() if p.requires_grad)
+        for size in candidates:
+            peak = try_training_step(model, size, image_size, device)
+            if peak is not None:
+                peak += moments
+            fits = peak is not None and peak <= budget
+            probes.append({"micro_batch_size": size, "peak_mb": None if peak is None else peak / 2**20, "fits": fits})
+            if fits:
+                break
+    else:
+        method = "estimate"
+        measurement = measure_activations(model, image_size, 1, device)
+        static, groups = static_bytes(model), checkpointed_groups(model)
+        for size in candidates:
+            peak = static + estimate_policy(measurement, groups, size)[0]
+            fits = peak <= budget
+            probes.append({"micro_batch_size": size, "peak_mb": peak / 2**20, "fits": fits})
+            if fits:
+                break
+    model.train(training)
+
+    fitting = [probe for probe in probes if probe["fits"]]
+    # Not even one image fits: train with one and let the step fail or swap visibly
+    micro_batch_size = fitting[0]["micro_batch_size"] if fitting else 1
+    return {
+        "micro_batch_size": micro_batch_size,
+        "accumulate_grad_batches": effective_batch_size // micro_batch_size,
+        "effective_batch_size": effective_batch_size,
+        "fits": bool(fitting),
+        "method": method,
+        "budget_mb": budget / 2**20,
+        "probes": probes,
+    }
+
+
+def rebatch(loader, batch_size):
+    """Same DataLoader (dataset, shuffling, workers, collate_fn) with another batch size."""
+    return DataLoader(
+        loader.dataset,
+        batch_size=batch_size,
+        shuffle=isinstance(loader.sampler, RandomSampler),
+        num_workers=loader.num_workers,
+        collate_fn=loader.collate_fn,
+        pin_memory=loader.pin_memory,
+    )
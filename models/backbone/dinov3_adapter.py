@@ -4,6 +4,9 @@
 # the terms of the DINOv3 License Agreement.
 
 import math
+import queue
+import threading
+import time
 
 import torch
 import torch.nn as nn
@@ -12,7 +15,7 @@ import torch.utils.checkpoint as cp
 
 from functools import partial
 
-from models.utils.ms_deform_attn import MSDeformAttn
+from models.utils.ms_deform_attn import DEFORM_ATTN_PRECISIONS, MSDeformAttn
 
 
 def drop_path(x, drop_prob: float = 0.0, training: bool = False):
@@ -70,6 +73,38 @@ def deform_inputs(x, patch_size):
     return deform_inputs1, deform_inputs2
 
 
+def valid_mask(valid_sizes, input_size, shape):
+    """
+    (B, h, w) bool mask, True on the valid (non-padded) region of a feature map of `shape`.
+
+    Images are padded at the bottom/right; a feature map of size (h, w) computed from an
+    (H, W) input covers a valid (height, width) with ceil(height * h / H) x ceil(width * w / W)
+    positions.
+    """
+    height, width = shape
+    heights = torch.div(valid_sizes[:, 0] * height + input_size[0] - 1, input_size[0], rounding_mode="floor")
+    widths = torch.div(valid_sizes[:, 1] * width + input_size[1] - 1, input_size[1], rounding_mode="floor")
+    rows = torch.arange(height, device=valid_sizes.device)[None, :] < heights[:, None]
+    cols = torch.arange(width, device=valid_sizes.device)[None, :] < widths[:, None]
+    return rows[:, :, None] & cols[:, None, :]
+
+
+def replicate_padding(x, valid_sizes, input_size):
+    """
+    Fill the padded region of a (B, C, h, w) feature map with its last valid row/column.
+
+    Bilinear resizing then sees the same border as for the unpadded image (edge
+    clamping), so the valid region of the result does not depend on the padding.
+    """
+    mask = valid_mask(valid_sizes, input_size, x.shape[-2:])
+    last_row = mask[:, :, 0].sum(1, keepdim=True).clamp(min=1) - 1
+    last_col = mask[:, 0, :].sum(1, keepdim=True).clamp(min=1) - 1
+    rows = torch.minimum(torch.arange(x.shape[-2], device=x.device)[None, :], last_row)
+    cols = torch.minimum(torch.arange(x.shape[-1], device=x.device)[None, :], last_col)
+    x = x.gather(2, rows[:, None, :, None].expand(-1, x.shape[1], -1, x.shape[-1]))
+    return x.gather(3, cols[:, None, None, :].expand(-1, x.shape[1], x.shape[-2], -1))
+
+
 class ConvFFN(nn.Module):
     def __init__(self, in_features, hidden_features=None, out_features=None, act_layer=nn.GELU, drop=0.0):
         super().__init__()
@@ -81,9 +116,9 @@ class ConvFFN(nn.Module):
         self.fc2 = nn.Linear(hidden_features, out_features)
         self.drop = nn.Dropout(drop)
 
-    def forward(self, x, H, W):
+    def forward(self, x, H, W, valid=None):
         x = self.fc1(x)
-        x = self.dwconv(x, H, W)
+        x = self.dwconv(x, H, W, valid)
         x = self.act(x)
         x = self.drop(x)
         x = self.fc2(x)
@@ -95,13 +130,25 @@ class DWConv(nn.Module):
     def __init__(self, dim=768):
         super().__init__()
         self.dwconv = nn.Conv2d(dim, dim, 3, 1, 1, bias=True, groups=dim)
-
-    def forward(self, x, H, W):
+        # torch.channels_last convolves the (B, N, C) tokens without transposing them
+        self.memory_format = torch.contiguous_format
+
+    def forward(self, x, H, W, valid=None):
+        """
+        Args:
+            x: (B, N, C) tokens of the stride 8, 16 and 32 levels (2H x 2W, H x W, H/2 x W/2)
+            H, W: Size of the stride-16 level
+            valid: Optional (B, N, 1) mask zeroing padded positions, so that the
+                convolution sees them like its own zero padding
+        """
         B, N, C = x.shape
-        n = N // 21
-        x1 = x[:, 0 : 16 * n, :].transpose(1, 2).view(B, C, H * 2, W * 2).contiguous()
-        x2 = x[:, 16 * n : 20 * n, :].transpose(1, 2).view(B, C, H, W).contiguous()
-        x3 = x[:, 20 * n :, :].transpose(1, 2).view(B, C, H // 2, W // 2).contiguous()
+        if valid is not None:
+            x = x * valid
+        # Level sizes follow from H, W (N // 21 per unit only holds when H and W are even)
+        n1, n2 = 4 * H * W, H * W
+        x1 = x[:, 0:n1, :].transpose(1, 2).view(B, C, H * 2, W * 2).contiguous(memory_format=self.memory_format)
+        x2 = x[:, n1 : n1 + n2, :].transpose(1, 2).view(B, C, H, W).contiguous(memory_format=self.memory_format)
+        x3 = x[:, n1 + n2 :, :].transpose(1, 2).view(B, C, H // 2, W // 2).contiguous(memory_format=self.memory_format)
         x1 = self.dwconv(x1).flatten(2).transpose(1, 2)
         x2 = self.dwconv(x2).flatten(2).transpose(1, 2)
         x3 = self.dwconv(x3).flatten(2).transpose(1, 2)
@@ -137,19 +184,27 @@ class Extractor(nn.Module):
             self.ffn_norm = norm_layer(dim)
             self.drop_path = DropPath(drop_path) if drop_path > 0.0 else nn.Identity()
 
-    def forward(self, query, reference_points, feat, spatial_shapes, level_start_index, H, W):
+    def forward(
+        self, query, reference_points, feat, spatial_shapes, level_start_index, H, W,
+        input_padding_mask=None, query_valid=None,
+    ):
         def _inner_forward(query, feat):
             attn = self.attn(
-                self.query_norm(query), reference_points, self.feat_norm(feat), spatial_shapes, level_start_index, None
+                self.query_norm(query),
+                reference_points,
+                self.feat_norm(feat),
+                spatial_shapes,
+                level_start_index,
+                input_padding_mask,
             )
             query = query + attn
 
             if self.with_cffn:
-                query = query + self.drop_path(self.ffn(self.ffn_norm(query), H, W))
+                query = query + self.drop_path(self.ffn(self.ffn_norm(query), H, W, query_valid))
             return query
 
         if self.with_cp and query.requires_grad:
-            query = cp.checkpoint(_inner_forward, query, feat)
+            query = cp.checkpoint(_inner_forward, query, feat, use_reentrant=False)
         else:
             query = _inner_forward(query, feat)
 
@@ -207,7 +262,9 @@ class InteractionBlockWithCls(nn.Module):
         else:
             self.extra_extractors = None
 
-    def forward(self, x, c, cls, deform_inputs1, deform_inputs2, H_c, W_c, H_toks, W_toks):
+    def forward(self, x, c, cls, deform_inputs1, deform_inputs2, H_c, W_c, H_toks, W_toks, padding=None):
+        """`padding`: optional (ViT token padding mask (B, N_x), True on padding; (B, N_c, 1) valid mask of c)"""
+        input_padding_mask, query_valid = padding if padding is not None else (None, None)
         c = self.extractor(
             query=c,
             reference_points=deform_inputs2[0],
@@ -216,6 +273,8 @@ class InteractionBlockWithCls(nn.Module):
             level_start_index=deform_inputs2[2],
             H=H_c,
             W=W_c,
+            input_padding_mask=input_padding_mask,
+            query_valid=query_valid,
         )
         if self.extra_extractors is not None:
             for extractor in self.extra_extractors:
@@ -227,6 +286,8 @@ class InteractionBlockWithCls(nn.Module):
                     level_start_index=deform_inputs2[2],
                     H=H_c,
                     W=W_c,
+                    input_padding_mask=input_padding_mask,
+                    query_valid=query_valid,
                 )
         return x, c, cls
 
@@ -276,32 +337,109 @@ class SpatialPriorModule(nn.Module):
         self.fc3 = nn.Conv2d(4 * inplanes, embed_dim, kernel_size=1, stride=1, padding=0, bias=True)
         self.fc4 = nn.Conv2d(4 * inplanes, embed_dim, kernel_size=1, stride=1, padding=0, bias=True)
 
-    def forward(self, x):
+    def forward(self, x, project_c1=True, valid_sizes=None):
+        """
+        With project_c1=False, c1 is returned before `fc1` (inplanes channels). With
+        `valid_sizes` (B, 2) of a padded batch, padded positions are zeroed after every
+        activation, so the next convolution treats them like zero padding.
+        """
+        input_size = x.shape[-2:]
+
+        def _stage(stage, x):
+            if valid_sizes is None:
+                return stage(x)
+            for layer in stage:
+                x = layer(x)
+                if isinstance(layer, nn.ReLU):
+                    x = x * valid_mask(valid_sizes, input_size, x.shape[-2:])[:, None]
+            return x
+
         def _inner_forward(x):
-            c1 = self.stem(x)
-            c2 = self.conv2(c1)
-            c3 = self.conv3(c2)
-            c4 = self.conv4(c3)
-            c1 = self.fc1(c1)
+            c1 = _stage(self.stem, x)
+            c2 = _stage(self.conv2, c1)
+            c3 = _stage(self.conv3, c2)
+            c4 = _stage(self.conv4, c3)
+            if project_c1:
+                c1 = self.fc1(c1)
             c2 = self.fc2(c2)
             c3 = self.fc3(c3)
             c4 = self.fc4(c4)
 
-            bs, dim, _, _ = c1.shape
+            bs, dim, _, _ = c2.shape
             # c1 = c1.view(bs, dim, -1).transpose(1, 2)  # 4s
-            c2 = c2.view(bs, dim, -1).transpose(1, 2)  # 8s
-            c3 = c3.view(bs, dim, -1).transpose(1, 2)  # 16s
-            c4 = c4.view(bs, dim, -1).transpose(1, 2)  # 32s
+            c2 = c2.flatten(2).transpose(1, 2)  # 8s
+            c3 = c3.flatten(2).transpose(1, 2)  # 16s
+            c4 = c4.flatten(2).transpose(1, 2)  # 32s
 
             return c1, c2, c3, c4
 
-        if self.with_cp and x.requires_grad:
-            outs = cp.checkpoint(_inner_forward, x)
+        # The input images never require grad: checkpoint whenever gradients are recorded
+        if self.with_cp and torch.is_grad_enabled():
+            outs = cp.checkpoint(_inner_forward, x, use_reentrant=False)
         else:
             outs = _inner_forward(x)
         return outs
 
 
+FUSION_MODES = ("reference", "inplace", "reduced")
+SCHEDULES = ("sequential", "concurrent")
+# Precision of the frozen ViT (precision.py): None keeps bf16 autocast on CUDA only,
+# "bf16-true" runs the ViT with bf16 weights outside autocast
+VIT_PRECISIONS = (None, "fp32", "bf16-autocast", "fp16-autocast", "bf16-true")
+_VIT_AUTOCAST_DTYPES = {"bf16-autocast": torch.bfloat16, "fp16-autocast": torch.float16}
+
+# The bilinear upsampling of the first ViT level is added channel chunk by channel chunk,
+# so only 1 / _FUSION_CHUNKS of a stride-4 tensor is ever allocated for it
+_FUSION_CHUNKS = 8
+
+
+def _add_interpolated_(out, x, size):
+    """out += bilinear upsampling of x to `size`, one channel chunk at a time (exact)."""
+    step = max(1, x.shape[1] // _FUSION_CHUNKS)
+    for start in range(0, x.shape[1], step):
+        out[:, start : start + step] += F.interpolate(
+            x[:, start : start + step], size=size, mode="bilinear", align_corners=False
+        )
+    return out
+
+
+def _batch_norm_affine(norm):
+    """(scale, shift) such that norm(x) == x * scale + shift in eval mode."""
+    scale = norm.weight / torch.sqrt(norm.running_var + norm.eps)
+    return scale, norm.bias - norm.running_mean * scale
+
+
+class _StageTimer:
+    """Elapsed time between named marks (CUDA events on the current stream on GPU)."""
+
+    def __init__(self, device):
+        self.cuda = device.type == "cuda"
+        self.marks = []
+        self.mark("start")
+
+    def mark(self, name):
+        if self.cuda:
+            event = torch.cuda.Event(enable_timing=True)
+            event.record()
+            self.marks.append((name, event))
+        else:
+            self.marks.append((name, time.perf_counter()))
+
+    def _elapsed_ms(self, start, end):
+        return start.elapsed_time(end) if self.cuda else (end - start) * 1000.0
+
+    def result(self):
+        """{"<stage>_ms": time since the previous mark, ..., "total_ms": first to last mark}"""
+        if self.cuda:
+            torch.cuda.synchronize()
+        timings = {
+            f"{name}_ms": self._elapsed_ms(previous, current)
+            for (_, previous), (name, current) in zip(self.marks, self.marks[1:])
+        }
+        timings["total_ms"] = self._elapsed_ms(self.marks[0][1], self.marks[-1][1])
+        return timings
+
+
 class DINOv3_Adapter(nn.Module):
     def __init__(
         self,
@@ -319,6 +457,9 @@ class DINOv3_Adapter(nn.Module):
         add_vit_feature=True,
         use_extra_extractor=True,
         with_cp=True,
+        fusion="reference",
+        schedule="sequential",
+        deform_attn_precision="fp32",
     ):
         super(DINOv3_Adapter, self).__init__()
         self.backbone = backbone
@@ -328,6 +469,24 @@ class DINOv3_Adapter(nn.Module):
         self.pretrain_size = (pretrain_size, pretrain_size)
         self.interaction_indexes = interaction_indexes
         self.add_vit_feature = add_vit_feature
+        if fusion not in FUSION_MODES:
+            raise ValueError(f"fusion must be one of {FUSION_MODES}, got {fusion!r}")
+        self.fusion = fusion
+        if schedule not in SCHEDULES:
+            raise ValueError(f"schedule must be one of {SCHEDULES}, got {schedule!r}")
+        self.schedule = schedule
+        if deform_attn_precision not in DEFORM_ATTN_PRECISIONS:
+            raise ValueError(
+                f"deform_attn_precision must be one of {DEFORM_ATTN_PRECISIONS}, got {deform_attn_precision!r}"
+            )
+        # Precision of the frozen ViT, one of VIT_PRECISIONS (set by precision.apply_precision_policy)
+        self.vit_precision = None
+        # Set record_timings to store per-stage times of the next forwards in self.timings
+        self.record_timings = False
+        self.timings = None
+        # Layout of the feature maps built from tokens (cpu_inference.py sets torch.channels_last)
+        self.memory_format = torch.contiguous_format
+        self._timer = None
         embed_dim = self.backbone.embed_dim
         self.patch_size = self.backbone.patch_size
         print("embed dim", embed_dim)
@@ -368,6 +527,9 @@ class DINOv3_Adapter(nn.Module):
         self.interactions.apply(self._init_weights)
         self.apply(self._init_deform_weights)
         torch.nn.init.normal_(self.level_embed)
+        for module in self.modules():
+            if isinstance(module, MSDeformAttn):
+                module.precision = deform_attn_precision
 
     def _init_weights(self, m):
         if isinstance(m, nn.Linear):
@@ -405,44 +567,212 @@ class DINOv3_Adapter(nn.Module):
         c4 = c4 + self.level_embed[2]
         return c2, c3, c4
 
-    def forward(self, x):
+    def _vit_layers(self, x, valid_sizes=None):
+        """
+        Iterator over the (patch tokens, cls token) of the interaction layers.
+
+        Backbones with `iter_intermediate_layers` (DINOv3CompatibilityWrapper) get the
+        valid sizes of a padded batch and run every image on its own token grid;
+        otherwise padded tokens are only masked in the extractors.
+        """
+        n = self.interaction_indexes
+        if hasattr(self.backbone, "iter_intermediate_layers"):
+            layers = self.backbone.iter_intermediate_layers(x, n=n, return_class_token=True, valid_sizes=valid_sizes)
+        else:
+            layers = iter(self.backbone.get_intermediate_layers(x, n=n, return_class_token=True))
+        if self.vit_precision == "bf16-true":
+            # The adapter gets fp32 tokens, like the fp32 residual stream of a ViT under autocast
+            return ((tokens.float(), cls.float()) for tokens, cls in layers)
+        return layers
+
+    def _vit_precision_context(self, device):
+        """Autocast state the frozen ViT runs under on `device` (see VIT_PRECISIONS)."""
+        if self.vit_precision is None:
+            return torch.autocast("cuda", torch.bfloat16)
+        if self.vit_precision in _VIT_AUTOCAST_DTYPES:
+            return torch.autocast(device.type, _VIT_AUTOCAST_DTYPES[self.vit_precision])
+        # fp32 or bf16 weights: no autocast, even inside the autocast of a mixed policy
+        return torch.autocast(device.type, enabled=False)
+
+    def _start_vit(self, x, valid_sizes=None):
+        """
+        Start the frozen ViT and return an iterator over its interaction-layer features.
+
+        The interaction blocks never write back into the ViT tokens, so the ViT is
+        independent of the SPM and of the interaction blocks fed by earlier layers:
+
+        - "sequential": all layers are computed before returning (original order).
+        - "concurrent" on CUDA: the ViT is queued on a side stream with an event per
+          requested layer; the SPM runs on the current stream meanwhile and interaction
+          block i waits only for the event of layer i.
+        - "concurrent" elsewhere: the ViT runs in a background thread (PyTorch ops
+          release the GIL) and hands each layer over as soon as it is computed.
+        """
+        if self.schedule == "sequential":
+            with self._vit_precision_context(x.device), torch.no_grad():
+                return iter(list(self._vit_layers(x, valid_sizes)))
+        if x.device.type == "cuda":
+            return self._start_vit_on_stream(x, valid_sizes)
+        return self._start_vit_in_thread(x, valid_sizes)
+
+    def _start_vit_on_stream(self, x, valid_sizes):
+        main = torch.cuda.current_stream(x.device)
+        stream = torch.cuda.Stream(device=x.device)
+        stream.wait_stream(main)
+        x.record_stream(stream)
+        ready = []
+        with torch.cuda.stream(stream), self._vit_precision_context(x.device), torch.no_grad():
+            for tokens, cls in self._vit_layers(x, valid_sizes):
+                event = torch.cuda.Event()
+                event.record(stream)
+                ready.append((tokens, cls, event))
+
+        def _consume():
+            for tokens, cls, event in ready:
+                main.wait_event(event)
+                # The caching allocator must not reuse these blocks before `main` is done with them
+                tokens.record_stream(main)
+                cls.record_stream(main)
+                yield tokens, cls
+
+        return _consume()
+
+    def _start_vit_in_thread(self, x, valid_sizes):
+        results = queue.Queue()
+
+        def _produce():
+            try:
+                # Grad mode and autocast are thread-local
+                with self._vit_precision_context(x.device), torch.no_grad():
+                    for layer in self._vit_layers(x, valid_sizes):
+                        results.put(layer)
+            except BaseException as e:  # noqa: B902 - surfaced in the consumer
+                results.put(e)
+
+        thread = threading.Thread(target=_produce, name="vit", daemon=True)
+        thread.start()
+
+        def _consume():
+            for _ in self.interaction_indexes:
+                item = results.get()
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+            thread.join()
+
+        return _consume()
+
+    def _mark(self, stage):
+        if self._timer is not None:
+            self._timer.mark(stage)
+
+    def _fuse_stride4(self, c1, c2, x1, size, projection):
+        """
+        f1 = norm1(up(c2) + c1 + interp(x1)), followed by `projection` if given.
+
+        `c1` is the SPM stem output before `fc1`. Equal to the reference path up to
+        rounding, with fewer full-size stride-4 tensors:
+
+        - "inplace": fc1(c1) is the accumulator, up(c2) and the chunked upsampling of
+          x1 are added into it, and in inference the eval-mode norm is applied in place
+          (reference: up, c1, two sums, the upsampling and the norm output).
+        - "reduced": in inference the norm (an affine map in eval mode) and the 1x1
+          `projection` are folded into fc1 and `up`, and the upsampling commutes with
+          the projection, so the sum is built directly at the projected width and no
+          embed_dim-wide stride-4 tensor exists. Training falls back to "inplace".
+        """
+        inference = not torch.is_grad_enabled() and not self.norm1.training
+        folded = (
+            self.fusion == "reduced" and inference and isinstance(projection, nn.Conv2d)
+        )
+        if folded:
+            # W' = P diag(scale): one (out, embed_dim) matrix applied to every summand
+            scale, shift = _batch_norm_affine(self.norm1)
+            weight = projection.weight.flatten(1) * scale
+            bias = weight @ (self.spm.fc1.bias + self.up.bias) + projection.weight.flatten(1) @ shift + projection.bias
+            up_weight = torch.einsum("oc,ickl->iokl", weight, self.up.weight)
+            out = F.conv_transpose2d(c2, up_weight, bias, stride=self.up.stride)
+            out += F.conv2d(c1, (weight @ self.spm.fc1.weight.flatten(1))[:, :, None, None])
+            if x1 is not None:
+                _add_interpolated_(out, F.conv2d(x1.to(weight.dtype), weight[:, :, None, None]), size)
+            return out
+
+        out = self.spm.fc1(c1)
+        out += self.up(c2)
+        if x1 is not None:
+            _add_interpolated_(out, x1, size)
+        if inference:
+            scale, shift = _batch_norm_affine(self.norm1)
+            out = out.mul_(scale[:, None, None]).add_(shift[:, None, None])
+        else:
+            out = self.norm1(out)
+        return projection(out) if projection is not None else out
+
+    def forward(self, x, stride4_projection=None, valid_sizes=None):
+        """
+        Args:
+            x: (B, 3, H, W) images
+            stride4_projection: Optional 1x1 convolution applied to f1 (the caller's
+                channel projection); with fusion="reduced" it is folded into the
+                stride-4 fusion at inference
+            valid_sizes: Optional (B, 2) valid (height, width) of the images of a batch
+                padded at the bottom/right; padded positions are masked throughout
+
+        Returns:
+            dict {"1": f1, "2": f2, "3": f3, "4": f4} at strides 4, 8, 16 and 32
+        """
+        self._timer = _StageTimer(x.device) if self.record_timings else None
+        try:
+            features = self._forward(x, stride4_projection, valid_sizes)
+            self._mark("fusion")
+            if self._timer is not None:
+                self.timings = self._timer.result()
+            return features
+        finally:
+            self._timer = None
+
+    def _forward(self, x, stride4_projection, valid_sizes):
+        if x.shape[2] % 32 or x.shape[3] % 32:
+            raise ValueError(
+                f"DINOv3_Adapter needs inputs with sides divisible by 32, got {tuple(x.shape[2:])}; "
+                f"pad the batch (padding.pad_batch) and pass the valid sizes"
+            )
         deform_inputs1, deform_inputs2 = deform_inputs(x, self.patch_size)
 
+        # Frozen ViT first (sequential) or in the background (concurrent)
+        vit_layers = self._start_vit(x, valid_sizes)
+        self._mark("vit")
+
         # SPM forward
-        c1, c2, c3, c4 = self.spm(x)
+        c1, c2, c3, c4 = self.spm(x, project_c1=self.fusion == "reference", valid_sizes=valid_sizes)
         c2, c3, c4 = self._add_level_embed(c2, c3, c4)
 
         c = torch.cat([c2, c3, c4], dim=1)
+        self._mark("spm")
 
         # Code for matching with oss
         H_c, W_c = x.shape[2] // 16, x.shape[3] // 16
         H_toks, W_toks = x.shape[2] // self.patch_size, x.shape[3] // self.patch_size
         bs, C, h, w = x.shape
 
-        with torch.autocast("cuda", torch.bfloat16):
-            with torch.no_grad():
-                all_layers = self.backbone.get_intermediate_layers(
-                    x, n=self.interaction_indexes, return_class_token=True
-                )
-
-        x_for_shape, _ = all_layers[0]
-        bs, _, dim = x_for_shape.shape
-        del x_for_shape
-
-        cls, x = (
-            x[
-                :,
-                :1,
-            ],
-            x[
-                :,
-                5:,
-            ],
-        )
+        dim = self.backbone.embed_dim
+
+        padding = None
+        if valid_sizes is not None:
+            input_size = (h, w)
+            vit_padding_mask = ~valid_mask(valid_sizes, input_size, (H_toks, W_toks)).flatten(1)
+            c_valid = torch.cat(
+                [
+                    valid_mask(valid_sizes, input_size, shape).flatten(1)
+                    for shape in ((2 * H_c, 2 * W_c), (H_c, W_c), (H_c // 2, W_c // 2))
+                ],
+                dim=1,
+            )
+            padding = (vit_padding_mask, c_valid[..., None].to(c.dtype))
 
         outs = list()
         for i, layer in enumerate(self.interactions):
-            x, cls = all_layers[i]
+            x, cls = next(vit_layers)
             _, c, _ = layer(
                 x,
                 c,
@@ -453,17 +783,32 @@ class DINOv3_Adapter(nn.Module):
                 W_c,
                 H_toks,
                 W_toks,
+                padding=padding,
             )
-            outs.append(x.transpose(1, 2).view(bs, dim, H_toks, W_toks).contiguous())
+            outs.append(x.transpose(1, 2).view(bs, dim, H_toks, W_toks).contiguous(memory_format=self.memory_format))
+        self._mark("interactions")
+        if valid_sizes is not None:
+            outs = [replicate_padding(out, valid_sizes, (h, w)) for out in outs]
 
         # Split & Reshape
         c2 = c[:, 0 : c2.size(1), :]
         c3 = c[:, c2.size(1) : c2.size(1) + c3.size(1), :]
         c4 = c[:, c2.size(1) + c3.size(1) :, :]
 
-        c2 = c2.transpose(1, 2).view(bs, dim, H_c * 2, W_c * 2).contiguous()
-        c3 = c3.transpose(1, 2).view(bs, dim, H_c, W_c).contiguous()
-        c4 = c4.transpose(1, 2).view(bs, dim, H_c // 2, W_c // 2).contiguous()
+        c2 = c2.transpose(1, 2).view(bs, dim, H_c * 2, W_c * 2).contiguous(memory_format=self.memory_format)
+        c3 = c3.transpose(1, 2).view(bs, dim, H_c, W_c).contiguous(memory_format=self.memory_format)
+        c4 = c4.transpose(1, 2).view(bs, dim, H_c // 2, W_c // 2).contiguous(memory_format=self.memory_format)
+
+        if self.fusion != "reference":
+            x1 = outs[0] if self.add_vit_feature else None
+            f1 = self._fuse_stride4(c1, c2, x1, (4 * H_c, 4 * W_c), stride4_projection)
+            if self.add_vit_feature:
+                _, x2, x3, x4 = outs
+                c2 = c2 + F.interpolate(x2, size=(2 * H_c, 2 * W_c), mode="bilinear", align_corners=False)
+                c3 = c3 + F.interpolate(x3, size=(1 * H_c, 1 * W_c), mode="bilinear", align_corners=False)
+                c4 = c4 + F.interpolate(x4, size=(H_c // 2, W_c // 2), mode="bilinear", align_corners=False)
+            return {"1": f1, "2": self.norm2(c2), "3": self.norm3(c3), "4": self.norm4(c4)}
+
         c1 = self.up(c2) + c1
 
         if self.add_vit_feature:
@@ -480,5 +825,7 @@ class DINOv3_Adapter(nn.Module):
         f2 = self.norm2(c2)
         f3 = self.norm3(c3)
         f4 = self.norm4(c4)
+        if stride4_projection is not None:
+            f1 = stride4_projection(f1)
 
         return {"1": f1, "2": f2, "3": f3, "4": f4}
@@ -18,10 +18,14 @@ from torch.nn.init import constant_, xavier_uniform_
 try:
     import MultiScaleDeformableAttention as MSDA
 except ImportError:
-    # if we just care about inference, we don't need
-    # the compiled extension for multi-scale deformable attention
+    # without the compiled extension, MSDeformAttn runs (and trains through)
+    # the pure PyTorch decomposition of multi-scale deformable attention
     MSDA = None
 
+# "fp32" runs the sampling in float32 (inputs are upcast under autocast); "reduced" keeps
+# value and attention weights in their (autocast) dtype and only the sampling locations in fp32
+DEFORM_ATTN_PRECISIONS = ("fp32", "reduced")
+
 
 class MSDeformAttnFunction(Function):
     @staticmethod
@@ -66,6 +70,52 @@ class MSDeformAttnFunction(Function):
         return grad_value, None, None, grad_sampling_loc, grad_attn_weight, None
 
 
+class MSDeformAttnReducedFunction(Function):
+    """
+    Reduced-precision variant: value and attention_weights stay in their dtype (bf16/fp16).
+
+    Only value, sampling_locations (fp32) and attention_weights are saved, as for
+    MSDeformAttnFunction but without the fp32 copies. The forward samples level by level
+    in fp32 (`ms_deform_attn_core_reduced`); the backward recomputes one level at a time
+    and differentiates its `grid_sample`, so no intermediate outlives its level.
+    """
+
+    @staticmethod
+    @custom_fwd(device_type="cuda")
+    def forward(ctx, value, value_spatial_shapes, sampling_locations, attention_weights):
+        output = ms_deform_attn_core_reduced(value, value_spatial_shapes, sampling_locations, attention_weights)
+        ctx.save_for_backward(value, value_spatial_shapes, sampling_locations, attention_weights)
+        return output
+
+    @staticmethod
+    @once_differentiable
+    @custom_bwd(device_type="cuda")
+    def backward(ctx, grad_output):
+        value, value_spatial_shapes, sampling_locations, attention_weights = ctx.saved_tensors
+        N_, S_, M_, D_ = value.shape
+        _, Lq_, _, L_, P_, _ = sampling_locations.shape
+        # N_, Lq_, M_*D_ -> N_*M_, D_, Lq_
+        grad_output = grad_output.float().transpose(1, 2).reshape(N_ * M_, D_, Lq_)
+        value_list = value.split([H_ * W_ for H_, W_ in value_spatial_shapes], dim=1)
+        grad_value, grad_sampling_loc, grad_attn_weight = [], [], []
+        with torch.enable_grad(), torch.autocast(value.device.type, enabled=False):
+            for lid_, (H_, W_) in enumerate(value_spatial_shapes):
+                value_l = value_list[lid_].detach().requires_grad_()
+                sampling_locations_l = sampling_locations[:, :, :, lid_].detach().requires_grad_()
+                attention_weights_l = attention_weights[:, :, :, lid_].detach().requires_grad_()
+                output_l = _sample_level(*_level_inputs(value_l, sampling_locations_l, attention_weights_l, H_, W_))
+                grads = torch.autograd.grad(output_l, (value_l, sampling_locations_l, attention_weights_l), grad_output)
+                grad_value.append(grads[0])
+                grad_sampling_loc.append(grads[1])
+                grad_attn_weight.append(grads[2])
+        return (
+            torch.cat(grad_value, dim=1),
+            None,
+            torch.stack(grad_sampling_loc, dim=3),
+            torch.stack(grad_attn_weight, dim=3),
+        )
+
+
 def ms_deform_attn_core_pytorch(value, value_spatial_shapes, sampling_locations, attention_weights):
     # for debug and test only,
     # need to use cuda version instead
@@ -90,6 +140,53 @@ def ms_deform_attn_core_pytorch(value, value_spatial_shapes, sampling_locations,
     return output.transpose(1, 2).contiguous()
 
 
+def _sample_level(value_l, sampling_grid_l, attention_weights_l):
+    # (N_*M_, D_, H_, W_), (N_*M_, Lq_, P_, 2), (N_*M_, 1, Lq_, P_) -> N_*M_, D_, Lq_
+    sampling_value_l = F.grid_sample(
+        value_l, sampling_grid_l, mode="bilinear", padding_mode="zeros", align_corners=False
+    )
+    return (sampling_value_l * attention_weights_l).sum(-1)
+
+
+def _level_inputs(value_l, sampling_locations_l, attention_weights_l, H_, W_):
+    """fp32 grid_sample inputs of one level: value (N, H*W, M, D), locations (N, Lq, M, P, 2), weights (N, Lq, M, P)."""
+    N_, _, M_, D_ = value_l.shape
+    _, Lq_, _, P_, _ = sampling_locations_l.shape
+    # N_, H_*W_, M_, D_ -> N_, M_*D_, H_*W_ -> N_*M_, D_, H_, W_
+    value_l = value_l.flatten(2).transpose(1, 2).reshape(N_ * M_, D_, H_, W_).float()
+    # N_, Lq_, M_, P_, 2 -> N_*M_, Lq_, P_, 2
+    sampling_grid_l = (2 * sampling_locations_l.float() - 1).transpose(1, 2).flatten(0, 1)
+    # N_, Lq_, M_, P_ -> N_*M_, 1, Lq_, P_
+    attention_weights_l = attention_weights_l.float().transpose(1, 2).reshape(N_ * M_, 1, Lq_, P_)
+    return value_l, sampling_grid_l, attention_weights_l
+
+
+def ms_deform_attn_core_reduced(value, value_spatial_shapes, sampling_locations, attention_weights):
+    """
+    `ms_deform_attn_core_pytorch` one level at a time, for values in bf16/fp16.
+
+    Each level of `value` is upcast just before its `grid_sample` and the output is accumulated
+    in fp32, so at most one level exists in fp32 at a time. `grid_sample` computes the source
+    pixel in the dtype of its input, which in bf16 is off by up to a pixel on a 128-wide level
+    even for an exact grid, hence the fp32 sampling.
+
+    Returns:
+        (N, Lq, M * D) tensor in the dtype of `value`
+    """
+    N_, S_, M_, D_ = value.shape
+    _, Lq_, M_, L_, P_, _ = sampling_locations.shape
+    value_list = value.split([H_ * W_ for H_, W_ in value_spatial_shapes], dim=1)
+    output = 0
+    with torch.autocast(value.device.type, enabled=False):
+        for lid_, (H_, W_) in enumerate(value_spatial_shapes):
+            output = output + _sample_level(
+                *_level_inputs(
+                    value_list[lid_], sampling_locations[:, :, :, lid_], attention_weights[:, :, :, lid_], H_, W_
+                )
+            )
+    return output.view(N_, M_ * D_, Lq_).transpose(1, 2).to(value.dtype).contiguous()
+
+
 def _is_power_of_2(n):
     if (not isinstance(n, int)) or (n < 0):
         raise ValueError("invalid input for _is_power_of_2: {} (type: {})".format(n, type(n)))
@@ -119,6 +216,8 @@ class MSDeformAttn(nn.Module):
             )
 
         self.im2col_step = 64
+        # One of DEFORM_ATTN_PRECISIONS, see ms_deform_attn_core_reduced
+        self.precision = "fp32"
 
         self.d_model = d_model
         self.n_levels = n_levels
@@ -187,6 +286,13 @@ class MSDeformAttn(nn.Module):
         attention_weights = self.attention_weights(query).view(N, Len_q, self.n_heads, self.n_levels * self.n_points)
         attention_weights = F.softmax(attention_weights, -1).view(N, Len_q, self.n_heads, self.n_levels, self.n_points)
 
+        if self.precision == "reduced":
+            # Locations in fp32 (small offsets added to coordinates in [0, 1]); value and
+            # weights keep the autocast dtype
+            reference_points = reference_points.float()
+            sampling_offsets = sampling_offsets.float()
+            attention_weights = attention_weights.to(value.dtype)
+
         if reference_points.shape[-1] == 2:
             offset_normalizer = torch.stack([input_spatial_shapes[..., 1], input_spatial_shapes[..., 0]], -1)
             sampling_locations = (
@@ -202,13 +308,30 @@ class MSDeformAttn(nn.Module):
             raise ValueError(
                 "Last dim of reference_points must be 2 or 4, but get {} instead.".format(reference_points.shape[-1])
             )
-        output = MSDeformAttnFunction.apply(
-            value,
-            input_spatial_shapes,
-            input_level_start_index,
-            sampling_locations,
-            attention_weights,
-            self.im2col_step,
-        )
+        if self.precision == "reduced" and value.dtype != torch.float32:
+            # fp32 values (no autocast) take the fp32 path below; traced graphs cannot
+            # serialize the autograd Function and run the same sampling as plain ops
+            if torch.jit.is_tracing():
+                output = ms_deform_attn_core_reduced(value, input_spatial_shapes, sampling_locations, attention_weights)
+            else:
+                output = MSDeformAttnReducedFunction.apply(
+                    value, input_spatial_shapes, sampling_locations, attention_weights
+                )
+        elif torch.jit.is_tracing() or MSDA is None or not value.is_cuda:
+            # Pure PyTorch decomposition, differentiated by autograd: exported graphs cannot
+            # serialize the autograd Function, and its backward needs the CUDA extension.
+            # Same upcast as the custom_fwd of MSDeformAttnFunction (also under CPU autocast)
+            output = ms_deform_attn_core_pytorch(
+                value.float(), input_spatial_shapes, sampling_locations.float(), attention_weights.float()
+            )
+        else:
+            output = MSDeformAttnFunction.apply(
+                value,
+                input_spatial_shapes,
+                input_level_start_index,
+                sampling_locations,
+                attention_weights,
+                self.im2col_step,
+            )
         output = self.output_proj(output)
         return output
@@ -0,0 +1,252 @@
+"""
+Padded batching of mixed-size images.
+
+Images of different sizes are placed top-left in a zero-padded batch whose
+height and width are multiples of 32 (the coarsest adapter level), together
+with a `pixel_mask` (B, H, W) that is 1 on real pixels, as in the HF image
+processors. `Mask2FormerForUniversalSegmentation` accepts `pixel_mask` but its
+pixel level module ignores it; `install_padding_support()` carries it to the
+places that need it:
+
+- the backbone (DINOv3AdapterBackbone): the frozen ViT runs every image on its
+  own token grid, the SPM, the deformable extractors and the ConvFFN treat
+  padded positions like zero padding,
+- the pixel decoder: padding masks and valid ratios of its deformable encoder,
+  GroupNorm statistics over the valid region only, zero padding in front of the
+  FPN convolutions and edge values on the padding of the encoder outputs (so
+  the bilinear upsampling matches the unpadded image),
+- the sine position embeddings (pixel decoder and transformer decoder): positions
+  are normalized by the valid size instead of the padded size,
+- the transformer decoder: padded pixels are excluded from the masked attention.
+
+Predictions for padded pixels are meaningless and should be cropped with
+`valid_sizes_from_mask()`.
+"""
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from models.backbone.dinov3_adapter import replicate_padding, valid_mask
+
+SIZE_DIVISOR = 32
+
+
+def _round_up(value, multiple):
+    return (value + multiple - 1) // multiple * multiple
+
+
+def pad_batch(images, size_divisor=SIZE_DIVISOR):
+    """
+    Stack (3, H_i, W_i) images into a (B, 3, H, W) batch padded at the bottom/right.
+
+    Returns:
+        (pixel_values, pixel_mask) where pixel_mask is a (B, H, W) long tensor with 1 on
+        real pixels, or None when all images already have the same size, a multiple of
+        `size_divisor` (the batch is then simply stacked)
+    """
+    height = _round_up(max(image.shape[-2] for image in images), size_divisor)
+    width = _round_up(max(image.shape[-1] for image in images), size_divisor)
+    if all(tuple(image.shape[-2:]) == (height, width) for image in images):
+        return torch.stack(images), None
+
+    pixel_values = images[0].new_zeros((len(images), images[0].shape[0], height, width))
+    pixel_mask = torch.zeros((len(images), height, width), dtype=torch.long)
+    for i, image in enumerate(images):
+        pixel_values[i, :, : image.shape[-2], : image.shape[-1]] = image
+        pixel_mask[i, : image.shape[-2], : image.shape[-1]] = 1
+    return pixel_values, pixel_mask
+
+
+def pad_masks(masks, size):
+    """Zero-pad (N, h, w) binary masks at the bottom/right to `size` (height, width)."""
+    pad_h, pad_w = size[0] - masks.shape[-2], size[1] - masks.shape[-1]
+    if pad_h == 0 and pad_w == 0:
+        return masks
+    return F.pad(masks, (0, pad_w, 0, pad_h))
+
+
+def valid_sizes_from_mask(pixel_mask):
+    """
+    (B, 2) valid (height, width) of the images of a padded batch.
+
+    Returns:
+        long tensor, or None if `pixel_mask` is None or contains no padding
+    """
+    if pixel_mask is None:
+        return None
+    pixel_mask = pixel_mask.bool()
+    if bool(pixel_mask.all()):
+        return None
+    return torch.stack([pixel_mask[:, :, 0].sum(1), pixel_mask[:, 0, :].sum(1)], dim=1)
+
+
+def group_by_size(sizes):
+    """{(height, width): [batch indices]} for a (B, 2) tensor of sizes, in order of first occurrence."""
+    groups = {}
+    for i, (height, width) in enumerate(sizes.tolist()):
+        groups.setdefault((height, width), []).append(i)
+    return groups
+
+
+# Hooks are module-level functions that only use the module they are called with,
+# so models with installed hooks can still be deep-copied and pickled.
+
+
+def _capture_padding(model, args, kwargs):
+    """Mask2FormerModel pre-hook: share the padding of this forward with the hooked modules."""
+    pixel_values = kwargs["pixel_values"] if "pixel_values" in kwargs else args[0]
+    pixel_mask = kwargs.get("pixel_mask", args[1] if len(args) > 1 else None)
+    valid_sizes = valid_sizes_from_mask(pixel_mask)
+    padding = None
+    if valid_sizes is not None:
+        padding = (valid_sizes.to(pixel_values.device), tuple(pixel_values.shape[-2:]))
+    for module in _padded_modules(model):
+        module._padding = padding
+
+
+def _release_padding(model, args, kwargs, output):
+    for module in _padded_modules(model):
+        module._padding = None
+    return output
+
+
+def _padded_modules(model):
+    return (
+        model.pixel_level_module.encoder,
+        model.pixel_level_module.decoder.encoder,
+        model.pixel_level_module.decoder.position_embedding,
+        model.transformer_module.position_embedder,
+        model.transformer_module.decoder.mask_predictor,
+        *model.pixel_level_module.decoder.output_convolutions,
+        *_group_norms(model),
+    )
+
+
+def _group_norms(model):
+    return [module for module in model.pixel_level_module.decoder.modules() if isinstance(module, nn.GroupNorm)]
+
+
+def _mask_group_norm(norm, args, output):
+    """GroupNorm hook: statistics of the valid region only, zeros on padding."""
+    padding = getattr(norm, "_padding", None)
+    if padding is None:
+        return output
+    valid_sizes, input_size = padding
+    x = args[0]
+    batch_size, channels, height, width = x.shape
+    mask = valid_mask(valid_sizes, input_size, (height, width))[:, None, None].to(x.dtype)
+    grouped = x.view(batch_size, norm.num_groups, channels // norm.num_groups, height, width)
+    count = mask.sum((2, 3, 4), keepdim=True) * grouped.shape[2]
+    mean = (grouped * mask).sum((2, 3, 4), keepdim=True) / count
+    var = ((grouped - mean) ** 2 * mask).sum((2, 3, 4), keepdim=True) / count
+    normalized = ((grouped - mean) * torch.rsqrt(var + norm.eps) * mask).view_as(x)
+    if norm.affine:
+        normalized = normalized * norm.weight[:, None, None] + norm.bias[:, None, None] * mask.view(batch_size, 1, height, width)
+    return normalized
+
+
+def _replicate_encoder_padding(encoder, args, kwargs, output):
+    """Pixel-decoder encoder hook: padded positions of every level take the nearest valid values."""
+    padding = getattr(encoder, "_padding", None)
+    if padding is None:
+        return output
+    valid_sizes, input_size = padding
+    hidden_states = output[0]
+    batch_size, _, channels = hidden_states.shape
+    shapes = kwargs["spatial_shapes_list"]
+    levels = hidden_states.split([height * width for height, width in shapes], dim=1)
+    hidden_states = torch.cat(
+        [
+            replicate_padding(level.transpose(1, 2).view(batch_size, channels, *shape), valid_sizes, input_size)
+            .flatten(2)
+            .transpose(1, 2)
+            for level, shape in zip(levels, shapes)
+        ],
+        dim=1,
+    )
+    if isinstance(output, tuple):
+        return (hidden_states, *output[1:])
+    output.last_hidden_state = hidden_states
+    return output
+
+
+def _zero_padding(module, args):
+    """Pre-hook: zero the padded positions of the input, like the zero padding of a convolution."""
+    padding = getattr(module, "_padding", None)
+    if padding is None:
+        return None
+    valid_sizes, input_size = padding
+    x = args[0]
+    return (x * valid_mask(valid_sizes, input_size, tuple(x.shape[-2:]))[:, None].to(x.dtype), *args[1:])
+
+
+def _mask_position_embedding(position_embedding, args):
+    """Sine position embedding pre-hook: pass the padding mask of the feature map (True = padding)."""
+    padding = getattr(position_embedding, "_padding", None)
+    if padding is None:
+        return None
+    valid_sizes, input_size = padding
+    shape = args[0]
+    return (*args[:3], ~valid_mask(valid_sizes, input_size, tuple(shape[2:])))
+
+
+def _mask_pixel_decoder(encoder, args, kwargs):
+    """Pixel-decoder encoder pre-hook: padding masks and valid ratios of every level."""
+    padding = getattr(encoder, "_padding", None)
+    if padding is None:
+        return None
+    valid_sizes, input_size = padding
+    dtype = kwargs["inputs_embeds"].dtype
+    masks = [valid_mask(valid_sizes, input_size, shape) for shape in kwargs["spatial_shapes_list"]]
+    # HF convention: True marks padding; valid ratios are (width, height) per level
+    kwargs["attention_mask"] = torch.cat([~mask.flatten(1) for mask in masks], 1)
+    kwargs["valid_ratios"] = torch.stack(
+        [
+            torch.stack(
+                [mask[:, 0, :].sum(1).to(dtype) / mask.shape[2], mask[:, :, 0].sum(1).to(dtype) / mask.shape[1]], -1
+            )
+            for mask in masks
+        ],
+        1,
+    )
+    return args, kwargs
+
+
+def _mask_attention_to_padding(mask_predictor, args, output):
+    """Mask-predictor hook: padded pixels never take part in the masked cross-attention."""
+    padding = getattr(mask_predictor, "_padding", None)
+    if padding is None:
+        return output
+    valid_sizes, input_size = padding
+    outputs_mask, attention_mask = output
+    target_size = args[2] if len(args) > 2 else outputs_mask.shape[-2:]
+    padded = ~valid_mask(valid_sizes, input_size, tuple(target_size)).flatten(1)
+    # attention_mask is (batch * heads, queries, h * w) with True = not attended
+    padded = padded[:, None, None, :].expand(-1, mask_predictor.num_heads, 1, -1).flatten(0, 1)
+    return outputs_mask, attention_mask | padded
+
+
+def install_padding_support(model):
+    """
+    Make `model(pixel_values=..., pixel_mask=...)` honour the padding mask.
+
+    Args:
+        model: Mask2FormerForUniversalSegmentation whose encoder is a DINOv3AdapterBackbone
+    """
+    mask2former = model.model
+    mask2former.register_forward_pre_hook(_capture_padding, with_kwargs=True)
+    mask2former.register_forward_hook(_release_padding, with_kwargs=True)
+    pixel_decoder = mask2former.pixel_level_module.decoder
+    pixel_decoder.encoder.register_forward_pre_hook(_mask_pixel_decoder, with_kwargs=True)
+    pixel_decoder.encoder.register_forward_hook(_replicate_encoder_padding, with_kwargs=True)
+    for output_convolution in pixel_decoder.output_convolutions:
+        output_convolution.register_forward_pre_hook(_zero_padding)
+    pixel_decoder.position_embedding.register_forward_pre_hook(_mask_position_embedding)
+    mask2former.transformer_module.position_embedder.register_forward_pre_hook(_mask_position_embedding)
+    for norm in _group_norms(mask2former):
+        norm.register_forward_hook(_mask_group_norm)
+    mask2former.transformer_module.decoder.mask_predictor.register_forward_hook(_mask_attention_to_padding)
+    for module in _padded_modules(mask2former):
+        module._padding = None
+    return model
@@ -0,0 +1,169 @@
+"""
+Batched semantic post-processing for Mask2Former outputs.
+
+`Mask2FormerImageProcessor.post_process_semantic_segmentation` upsamples every
+query mask to 384x384, combines them with the class probabilities and then
+resizes each image's class logits to its target size in a Python loop. For
+semantic segmentation only the per-class combination is needed, so here the
+class-weighted sum is taken at mask resolution (1/4 of the input) and only the
+`num_classes` combined maps (or only the label map) are upsampled, in chunks of
+images to bound peak memory.
+"""
+
+import torch
+import torch.nn.functional as F
+
+
+def semantic_logits(class_queries_logits, masks_queries_logits):
+    """
+    Combine query class probabilities and mask probabilities into per-class scores.
+
+    Args:
+        class_queries_logits: Tensor of shape (B, Q, num_classes + 1)
+        masks_queries_logits: Tensor of shape (B, Q, h, w)
+
+    Returns:
+        Tensor of shape (B, num_classes, h, w) at mask resolution
+    """
+    # Remove the null class `[..., :-1]`
+    masks_classes = class_queries_logits.float().softmax(dim=-1)[..., :-1]
+    masks_probs = masks_queries_logits.float().sigmoid()
+    return torch.einsum("bqc, bqhw -> bchw", masks_classes, masks_probs)
+
+
+def boundary_mask(labels):
+    """Pixels whose 3x3 neighbourhood contains more than one label. labels: (B, H, W)."""
+    labels = labels.unsqueeze(1).float()
+    local_max = F.max_pool2d(labels, kernel_size=3, stride=1, padding=1)
+    local_min = -F.max_pool2d(-labels, kernel_size=3, stride=1, padding=1)
+    return (local_max != local_min).squeeze(1)
+
+
+def _refine_boundaries(labels, logits, target_size):
+    """
+    Replace nearest-upsampled labels on class boundaries by the argmax of the
+    bilinearly upsampled logits, evaluated only at those pixels.
+
+    Boundaries are found at mask resolution and upsampled, so the refined band
+    covers every output pixel whose nearest low-resolution label may be wrong.
+    """
+    low_res_labels = logits.argmax(dim=1)
+    boundary = boundary_mask(low_res_labels).unsqueeze(1).float()
+    boundary = F.interpolate(boundary, size=target_size, mode="nearest").squeeze(1).bool()
+    if not boundary.any():
+        return labels
+
+    H, W = target_size
+    b_idx, y_idx, x_idx = boundary.nonzero(as_tuple=True)
+    # Pixel centres in normalized [-1, 1] coordinates (align_corners=False convention)
+    grid_x = (x_idx.float() + 0.5) / W * 2 - 1
+    grid_y = (y_idx.float() + 0.5) / H * 2 - 1
+
+    refined = labels.clone()
+    for b in range(labels.shape[0]):
+        sel = b_idx == b
+        if not sel.any():
+            continue
+        grid = torch.stack([grid_x[sel], grid_y[sel]], dim=-1).view(1, 1, -1, 2)
+        # (1, C, 1, N) -> (N, C)
+        samples = F.grid_sample(
+            logits[b : b + 1], grid.to(logits.dtype), mode="bilinear", padding_mode="border", align_corners=False
+        )
+        refined[b, y_idx[sel], x_idx[sel]] = samples[0, :, 0].argmax(dim=0).to(refined.dtype)
+    return refined
+
+
+@torch.no_grad()
+def post_process_semantic_segmentation(
+    outputs,
+    target_size,
+    chunk_size=4,
+    upsample="logits",
+    refine_boundaries=True,
+):
+    """
+    Batched replacement for `processor.post_process_semantic_segmentation`.
+
+    Args:
+        outputs: Mask2Former output with `class_queries_logits` and `masks_queries_logits`
+        target_size: (height, width) of the returned label maps, shared by the whole batch
+        chunk_size: Number of images combined and upsampled at once (bounds peak memory)
+        upsample: "logits" upsamples the per-class scores bilinearly before the argmax
+            (closest to the processor); "labels" takes the argmax at mask resolution and
+            upsamples only the label map with nearest neighbour
+        refine_boundaries: With upsample="labels", recompute the bilinear argmax on
+            class boundaries so only boundary pixels pay for full-resolution logits
+
+    Returns:
+        Tensor of shape (B, height, width) with class ids (torch.long)
+    """
+    if upsample not in ("logits", "labels"):
+        raise ValueError(f"upsample must be 'logits' or 'labels', got {upsample!r}")
+
+    class_queries_logits = outputs.class_queries_logits
+    masks_queries_logits = outputs.masks_queries_logits
+    batch_size = class_queries_logits.shape[0]
+    target_size = tuple(int(s) for s in target_size)
+    chunk_size = chunk_size or batch_size
+
+    predictions = []
+    for start in range(0, batch_size, chunk_size):
+        end = min(start + chunk_size, batch_size)
+        logits = semantic_logits(class_queries_logits[start:end], masks_queries_logits[start:end])
+        predictions.append(labels_from_semantic_logits(logits, target_size, upsample, refine_boundaries))
+
+    return torch.cat(predictions, dim=0)
+
+
+def labels_from_semantic_logits(logits, target_size, upsample="logits", refine_boundaries=True):
+    """
+    Turn per-class scores at mask resolution into label maps at `target_size`.
+
+    Args:
+        logits: Tensor of shape (B, num_classes, h, w), e.g. from `semantic_logits`
+        target_size: (height, width) of the returned label maps
+        upsample: "logits" or "labels", see `post_process_semantic_segmentation`
+        refine_boundaries: See `post_process_semantic_segmentation`
+
+    Returns:
+        Tensor of shape (B, height, width) with class ids (torch.long)
+    """
+    target_size = tuple(int(s) for s in target_size)
+    if upsample == "logits":
+        logits = F.interpolate(logits, size=target_size, mode="bilinear", align_corners=False)
+        return logits.argmax(dim=1)
+
+    labels = logits.argmax(dim=1, keepdim=True).float()
+    labels = F.interpolate(labels, size=target_size, mode="nearest").squeeze(1).long()
+    if refine_boundaries:
+        labels = _refine_boundaries(labels, logits, target_size)
+    return labels
+
+
+def post_process_from_config(outputs, target_size, post_cfg):
+    """Run `post_process_semantic_segmentation` with options from `cfg.model.post_processing`."""
+    return post_process_semantic_segmentation(
+        outputs,
+        target_size,
+        chunk_size=post_cfg.chunk_size,
+        upsample=post_cfg.upsample,
+        refine_boundaries=post_cfg.refine_boundaries,
+    )
+
+
+def prediction_agreement(predictions, reference):
+    """
+    Fraction of pixels where two sets of label maps agree.
+
+    Args:
+        predictions: Tensor (B, H, W) or list of (H, W) tensors
+        reference: Tensor (B, H, W) or list of (H, W) tensors
+
+    Returns:
+        float in [0, 1]
+    """
+    if isinstance(predictions, (list, tuple)):
+        predictions = torch.stack(list(predictions))
+    if isinstance(reference, (list, tuple)):
+        reference = torch.stack(list(reference))
+    return (predictions.to(reference.device) == reference).float().mean().item()
@@ -0,0 +1,229 @@
+"""
+Mixed-precision policy of training runs, the same on every device.
+
+`training.mixed_precision.policy` sets the precision of the trained parts (adapter,
+pixel decoder, transformer decoder):
+
+- "fp32": no autocast,
+- "bf16-mixed": bf16 autocast over fp32 weights,
+- "fp16-mixed": fp16 autocast over fp32 weights, with loss scaling (GradScaler).
+
+`training.mixed_precision.frozen_backbone` sets that of the frozen ViT:
+
+- "policy": the autocast of the policy (fp32 under "fp32"),
+- "bf16-autocast": bf16 autocast whatever the policy (before the policy existed,
+  this applied on CUDA only),
+- "bf16-true": bf16 weights (half the memory) and bf16 compute, no autocast,
+- "fp32": fp32 weights and compute, no autocast.
+
+The Mask2Former loss (matcher, class cross-entropy, mask BCE and dice) always runs in
+fp32 outside autocast. Lightning applies the policy autocast and the scaler around the
+training and validation steps (`precision_plugins`); `policy_autocast` gives the same
+autocast to code outside the Trainer (planner, probes, benchmark).
+
+Under autocast the deformable attention still samples in fp32 unless
+`model.deform_attn_precision` is "reduced" (see models/utils/ms_deform_attn.py).
+"""
+
+import time
+from functools import partial
+
+import torch
+from pytorch_lightning.plugins.precision import MixedPrecision
+
+from checkpointing import frozen_vit
+from micro_batching import probe_inputs
+
+# Autocast dtype of the trained parts per policy (None = no autocast)
+MIXED_PRECISION_POLICIES = {"fp32": None, "bf16-mixed": torch.bfloat16, "fp16-mixed": torch.float16}
+FROZEN_BACKBONE_PRECISIONS = ("policy", "bf16-autocast", "bf16-true", "fp32")
+_POLICY_VIT_PRECISIONS = {"fp32": "fp32", "bf16-mixed": "bf16-autocast", "fp16-mixed": "fp16-autocast"}
+
+
+def _check_policy(policy, frozen_backbone):
+    if policy not in MIXED_PRECISION_POLICIES:
+        raise ValueError(f"policy must be one of {tuple(MIXED_PRECISION_POLICIES)}, got {policy!r}")
+    if frozen_backbone not in FROZEN_BACKBONE_PRECISIONS:
+        raise ValueError(f"frozen_backbone must be one of {FROZEN_BACKBONE_PRECISIONS}, got {frozen_backbone!r}")
+
+
+def vit_precision(policy, frozen_backbone="policy"):
+    """`DINOv3_Adapter.vit_precision` of a policy and frozen-backbone setting."""
+    _check_policy(policy, frozen_backbone)
+    return _POLICY_VIT_PRECISIONS[policy] if frozen_backbone == "policy" else frozen_backbone
+
+
+def policy_autocast(policy, device):
+    """Autocast context of the trained parts under `policy` on `device`."""
+    dtype = MIXED_PRECISION_POLICIES[policy]
+    return torch.autocast(torch.device(device).type, dtype, enabled=dtype is not None)
+
+
+def precision_plugins(policy, device):
+    """Lightning Trainer plugins of `policy` (none for "fp32")."""
+    device_type = torch.device(device).type
+    if policy == "bf16-mixed":
+        return [MixedPrecision("bf16-mixed", device_type)]
+    if policy == "fp16-mixed":
+        # With an explicit scaler: `Trainer(precision="16-mixed")` falls back to bf16 on CPU
+        return [MixedPrecision("16-mixed", device_type, torch.amp.GradScaler(device_type))]
+    return []
+
+
+def _to_fp32(value):
+    if isinstance(value, torch.Tensor):
+        return value.float() if value.is_floating_point() else value
+    if isinstance(value, (list, tuple)):
+        return type(value)(_to_fp32(v) for v in value)
+    if isinstance(value, dict):
+        return {k: _to_fp32(v) for k, v in value.items()}
+    return value
+
+
+def _fp32_loss_forward(criterion, *args, **kwargs):
+    """Mask2FormerLoss forward in fp32 outside autocast (installed as the instance `forward`)."""
+    with torch.autocast(criterion.empty_weight.device.type, enabled=False):
+        return type(criterion).forward(criterion, *_to_fp32(args), **_to_fp32(kwargs))
+
+
+def apply_precision_policy(model, policy, frozen_backbone="policy"):
+    """
+    Set the frozen-ViT precision and the fp32 loss of `policy` on a model.
+
+    The autocast of the trained parts comes from the Trainer (`precision_plugins`) or
+    `policy_autocast`. Going back from "bf16-true" casts the ViT weights to fp32 again,
+    which does not restore their original values.
+
+    Args:
+        model: Mask2FormerForUniversalSegmentation with a DINOv3AdapterBackbone
+        policy: One of MIXED_PRECISION_POLICIES
+        frozen_backbone: One of FROZEN_BACKBONE_PRECISIONS
+
+    Returns:
+        The `vit_precision` set on the adapter
+    """
+    adapter = model.model.pixel_level_module.encoder.adapter
+    adapter.vit_precision = vit_precision(policy, frozen_backbone)
+    frozen_vit(model).to(torch.bfloat16 if adapter.vit_precision == "bf16-true" else torch.float32)
+    criterion = model.criterion
+    if MIXED_PRECISION_POLICIES[policy] is None:
+        criterion.__dict__.pop("forward", None)
+    else:
+        criterion.forward = partial(_fp32_loss_forward, criterion)
+    return adapter.vit_precision
+
+
+def _synchronize(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def _training_step(model, inputs, optimizer, scaler, policy, device):
+    pixel_values, mask_labels, class_labels = inputs
+    with policy_autocast(policy, device):
+        outputs = model(pixel_values=pixel_values, mask_labels=mask_labels, class_labels=class_labels)
+    scaler.scale(outputs.loss).backward()
+    scaler.step(optimizer)
+    scaler.update()
+    optimizer.zero_grad(set_to_none=True)
+    return outputs.loss.item()
+
+
+def benchmark_policies(model, settings, image_size, batch_size, device, steps=5, warmup_steps=2):
+    """
+    Training-step time and memory of `model` under several precision settings.
+
+    A step is the forward with the Mask2Former loss on random images with stripe masks,
+    the (scaled) backward and an AdamW step with learning rate 0, so the weights do not
+    change. The policy, ViT weights, BatchNorm statistics and train/eval mode are restored
+    afterwards.
+
+    Args:
+        model: Mask2FormerForUniversalSegmentation with its training checkpointing policy applied
+        settings: (policy, frozen_backbone) pairs
+        image_size: Training resolution (square, a multiple of 32)
+        batch_size: Images per step
+        device: Device to train on
+        steps: Timed steps per setting
+        warmup_steps: Untimed steps first
+
+    Returns:
+        list with one dict per setting: "policy", "frozen_backbone", "ms_per_step",
+        "images_per_s", "activations_mb" (tensors saved for backward), "peak_mb" (CUDA
+        only, else None) and the last "loss"
+    """
+    device = torch.device(device)
+    adapter = model.model.pixel_level_module.encoder.adapter
+    vit = frozen_vit(model)
+    model.to(device)
+    training, previous_precision = model.training, adapter.vit_precision
+    previous_loss_forward = model.criterion.__dict__.get("forward")
+    vit_dtype = next(vit.parameters()).dtype
+    vit_state = {name: value.clone() for name, value in vit.state_dict().items()}
+    buffers = [buffer.clone() for buffer in model.buffers()]
+    optimizer = torch.optim.AdamW([p for p in model.parameters() if p.requires_grad], lr=0.0)
+    inputs = probe_inputs(batch_size, image_size, model.config.num_labels, device)
+    model.train()
+
+    results = []
+    try:
+        for policy, frozen_backbone in settings:
+            vit.to(torch.float32).load_state_dict(vit_state)
+            apply_precision_policy(model, policy, frozen_backbone)
+            scaler = torch.amp.GradScaler(device.type, enabled=policy == "fp16-mixed")
+            if device.type == "cuda":
+                torch.cuda.empty_cache()
+                torch.cuda.reset_peak_memory_stats(device)
+
+            times = []
+            for i in range(warmup_steps + steps):
+                _synchronize(device)
+                start = time.perf_counter()
+                loss = _training_step(model, inputs, optimizer, scaler, policy, device)
+                _synchronize(device)
+                if i >= warmup_steps:
+                    times.append(time.perf_counter() - start)
+            peak = torch.cuda.max_memory_allocated(device) if device.type == "cuda" else None
+
+            # One more (untimed) step for the activations saved for backward
+            storages = {}
+
+            def _pack(tensor):
+                storage = tensor.untyped_storage()
+                storages[storage.data_ptr()] = storage.nbytes()
+                return tensor
+
+            with torch.autograd.graph.saved_tensors_hooks(_pack, lambda tensor: tensor):
+                _training_step(model, inputs, optimizer, scaler, policy, device)
+
+            results.append({
+                "policy": policy,
+                "frozen_backbone": frozen_backbone,
+                "ms_per_step": 1000.0 * sum(times) / len(times),
+                "images_per_s": batch_size * len(times) / sum(times),
+                "activations_mb": sum(storages.values()) / 2**20,
+                "peak_mb": None if peak is None else peak / 2**20,
+                "loss": loss,
+            })
+    finally:
+        vit.to(torch.float32).load_state_dict(vit_state)
+        vit.to(vit_dtype)
+        adapter.vit_precision = previous_precision
+        model.criterion.__dict__.pop("forward", None)
+        if previous_loss_forward is not None:
+            model.criterion.forward = previous_loss_forward
+        optimizer.zero_grad(set_to_none=True)
+        with torch.no_grad():
+            for buffer, saved in zip(model.buffers(), buffers):
+                buffer.copy_(saved)
+        model.train(training)
+    return results
+
+
+def print_policy_benchmark(results):
+    """Table of `benchmark_policies` results."""
+    print(f"   {'policy':<12} {'frozen ViT':<14} {'ms/step':>9} {'images/s':>9} {'activations':>12} {'peak':>10}")
+    for r in results:
+        peak = "-" if r["peak_mb"] is None else f"{r['peak_mb']:.0f} MB"
+        print(f"   {r['policy']:<12} {r['frozen_backbone']:<14} {r['ms_per_step']:>9.1f} {r['images_per_s']:>9.2f} "
+              f"{r['activations_mb']:>9.0f} MB {peak:>10}")
@@ -0,0 +1,262 @@
+import os
+import threading
+import time
+import torch
+import hydra
+from hydra.utils import to_absolute_path
+from omegaconf import DictConfig
+from torch.utils.data import DataLoader
+
+from data import ImageListDataset, collect_image_paths, inference_collate_fn
+from eval_pipeline import PredictionWriter, prefetch_to_device
+from adaptive import AdaptiveStats
+from inference import create_processor, load_model, predict_labels
+from padding import valid_sizes_from_mask
+from process_pool import ProcessPoolPredictor, fork_safe_parent
+from serve_hydra import resolve_device
+from tta import ViewBudget, build_views
+
+
+class Journal:
+    """
+    Append-only record of completed outputs (one output name per line).
+
+    Lines are appended and flushed by the PNG writer threads only after the label map
+    is on disk, so every name in the journal has a complete output file.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.completed = set()
+        if os.path.exists(path):
+            with open(path) as f:
+                # A run killed mid-write can leave a partial last line without newline; ignore it
+                lines = f.read().split("\n")[:-1]
+            self.completed = {line for line in lines if line}
+        self.file = open(path, "a")
+
+    def add(self, name):
+        with self.lock:
+            self.file.write(name + "\n")
+            self.file.flush()
+            self.completed.add(name)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def output_names(image_paths, input_root, preserve_structure):
+    """
+    Output stem for every image: the file stem (flat layout, LoveDA submission) or the
+    path relative to the input directory without extension (preserve_structure).
+    """
+    if preserve_structure and input_root is not None:
+        names = [os.path.splitext(os.path.relpath(p, input_root))[0] for p in image_paths]
+    else:
+        names = [os.path.splitext(os.path.basename(p))[0] for p in image_paths]
+
+    seen = {}
+    for path, name in zip(image_paths, names):
+        if name in seen:
+            raise ValueError(
+                f"Images {seen[name]} and {path} map to the same output '{name}.png'; "
+                f"use predict.preserve_structure=true"
+            )
+        seen[name] = path
+    return names
+
+
+@hydra.main(version_base="1.3", config_path="conf", config_name="config")
+def main(cfg: DictConfig) -> None:
+    """
+    Predict label maps for a directory or file list of images.
+
+    Writes one PNG per image at its original resolution with class ids 0..6
+    (background, building, road, water, barren, forest, agriculture), i.e. the
+    LoveDA submission format. Completed images are journaled, so re-running the
+    same command after an interruption only processes the remaining images.
+
+    Usage:
+        python predict_hydra.py checkpoint_path=/path/to/checkpoint.ckpt predict.input=/data/LoveDA/Test
+        python predict_hydra.py checkpoint_path=... predict.input=tiles.txt predict.output_dir=out
+        python predict_hydra.py checkpoint_path=... predict.input=... predict.resume=false   # start over
+    """
+    checkpoint_path = getattr(cfg, 'checkpoint_path', None)
+    if checkpoint_path is None:
+        print("❌ Error: checkpoint_path is required")
+        print("Usage: python predict_hydra.py checkpoint_path=/path/to/checkpoint.ckpt predict.input=/path/to/images")
+        return
+    # Relative to the launch directory (hydra.job.chdir moves the working directory)
+    checkpoint_path = to_absolute_path(checkpoint_path)
+    if not os.path.exists(checkpoint_path):
+        print(f"❌ Error: Checkpoint not found: {checkpoint_path}")
+        return
+    if cfg.predict.input is None:
+        print("❌ Error: predict.input is required (directory or text file with image paths)")
+        return
+
+    input_path = to_absolute_path(cfg.predict.input)
+    output_dir = to_absolute_path(cfg.predict.output_dir)
+    if not os.path.exists(input_path):
+        print(f"❌ Error: Input not found: {input_path}")
+        return
+
+    device = resolve_device(cfg.predict.device)
+    torch.set_float32_matmul_precision(cfg.training.precision)
+
+    print("🗺️  DINOv3+Mask2Former Batch Prediction")
+    print("=" * 60)
+    print(f"📂 Checkpoint: {checkpoint_path}")
+    print(f"📥 Input: {input_path}")
+    print(f"📤 Output: {output_dir}")
+    print(f"🖥️  Device: {device}")
+    print(f"📐 Input size: {cfg.data.image_size}×{cfg.data.image_size}")
+    processes = cfg.predict.processes
+    if processes > 1 and device.type != "cpu":
+        print(f"⚠️  predict.processes={processes} is for CPU inference; using a single process on {device}")
+        processes = 1
+    parent_threads = None
+    if processes > 1:
+        print(f"🧵 Process pool: {processes} workers sharing one copy of the weights")
+        # The workers are forked from this process, which must not start a multi-threaded
+        # OpenMP pool first: one intra-op thread until they run (also in CPU mode)
+        parent_threads = fork_safe_parent()
+        cfg.model.cpu_inference.intra_op_threads = 1
+    if cfg.model.tta.enabled:
+        print(f"🔄 TTA: {len(build_views(cfg.model.tta))} views per image")
+    adaptive_cfg = cfg.model.adaptive_resolution
+    if adaptive_cfg.enabled:
+        print(f"🔍 Adaptive resolution: {adaptive_cfg.low_scale}× pass, full resolution where "
+              f"{adaptive_cfg.criterion} > {adaptive_cfg.threshold}")
+    print("=" * 60)
+
+    # Collect images and drop the ones completed by a previous run
+    image_paths = collect_image_paths(input_path, tuple(cfg.predict.extensions))
+    input_root = input_path if os.path.isdir(input_path) else None
+    names = output_names(image_paths, input_root, cfg.predict.preserve_structure)
+    print(f"🖼️  Found {len(image_paths)} images")
+
+    os.makedirs(output_dir, exist_ok=True)
+    journal_path = os.path.join(output_dir, cfg.predict.journal)
+    if not cfg.predict.resume and os.path.exists(journal_path):
+        os.remove(journal_path)
+    journal = Journal(journal_path)
+
+    pending = [
+        i for i, name in enumerate(names)
+        if name not in journal.completed or not os.path.exists(os.path.join(output_dir, f"{name}.png"))
+    ]
+    if len(pending) < len(image_paths):
+        print(f"⏭️  Resuming: {len(image_paths) - len(pending)} images already done, {len(pending)} remaining")
+    if not pending:
+        journal.close()
+        print("✅ Nothing to do")
+        return
+
+    processor = create_processor(cfg)
+    dataset = ImageListDataset([image_paths[i] for i in pending], processor)
+    pending_names = [names[i] for i in pending]
+    loader = DataLoader(
+        dataset,
+        batch_size=cfg.predict.batch_size,
+        shuffle=False,
+        num_workers=cfg.predict.num_workers,
+        collate_fn=inference_collate_fn,
+        pin_memory=device.type == "cuda",
+        persistent_workers=False,
+    )
+
+    print("🏗️  Loading model...")
+    model = load_model(cfg, checkpoint_path, device)
+    writer = PredictionWriter(
+        output_dir,
+        class_colors=[tuple(c) for c in cfg.data.class_colors],
+        overlay=cfg.predict.overlay,
+        num_workers=cfg.predict.num_writers,
+        max_pending=4 * cfg.predict.batch_size,
+    )
+
+    def submit(idx, label_map, size):
+        name = pending_names[idx]
+        writer.submit(
+            label_map,
+            dataset.image_paths[idx],
+            name=name,
+            size=size,
+            on_written=lambda _, name=name: journal.add(name),
+        )
+
+    def report(processed):
+        elapsed = time.perf_counter() - start_time
+        print(f"   {processed}/{len(dataset)} images | {processed / elapsed:.2f} images/s")
+
+    tta_budget = ViewBudget.from_config(cfg.model.tta)
+    # Worker processes keep their own adaptive statistics, only the single-process run reports them
+    adaptive_stats = AdaptiveStats.from_model(model) if adaptive_cfg.enabled and processes == 1 else None
+    print(f"🚀 Predicting {len(dataset)} images...")
+    processed = 0
+    start_time = time.perf_counter()
+    pool = None
+    try:
+        if processes > 1:
+            def predict_fn(model, pixel_values, pixel_mask):
+                labels = predict_labels(
+                    model, pixel_values, cfg.model.post_processing, cfg.model.tta, tta_budget, pixel_mask, adaptive_cfg,
+                )
+                return torch.clamp(labels, 0, cfg.model.num_classes - 1)
+
+            pool = ProcessPoolPredictor(
+                model, dataset, predict_fn, processes,
+                threads_per_process=cfg.predict.threads_per_process,
+                pin_cores=cfg.predict.pin_cores,
+                batch_size=cfg.predict.batch_size,
+                parent_threads=parent_threads,
+            )
+            print(f"   {pool.shared_bytes / 1e9:.2f} GB of weights in shared memory, "
+                  f"{len(pool.cores[0])} threads per worker")
+            for idx, label_map, size in pool.predict(range(len(dataset))):
+                submit(idx, label_map, size)
+                processed += 1
+                if processed % (cfg.predict.progress_every * cfg.predict.batch_size) == 0:
+                    report(processed)
+        else:
+            for batch_idx, batch in enumerate(prefetch_to_device(loader, device)):
+                labels = predict_labels(
+                    model, batch["pixel_values"], cfg.model.post_processing, cfg.model.tta, tta_budget,
+                    batch.get("pixel_mask"), adaptive_cfg, adaptive_stats,
+                )
+                labels = torch.clamp(labels, 0, cfg.model.num_classes - 1).to(torch.uint8).cpu()
+                valid_sizes = valid_sizes_from_mask(batch.get("pixel_mask"))
+
+                for j, idx in enumerate(batch["indices"]):
+                    # Padded batch: drop the padding before resizing to the source size
+                    label_map = labels[j] if valid_sizes is None else labels[j, : valid_sizes[j, 0], : valid_sizes[j, 1]]
+                    submit(idx, label_map, batch["original_sizes"][j])
+                processed += len(batch["indices"])
+
+                if (batch_idx + 1) % cfg.predict.progress_every == 0:
+                    report(processed)
+    except KeyboardInterrupt:
+        print("\n⏸️  Interrupted: finishing pending writes, re-run the same command to resume")
+    finally:
+        if pool is not None:
+            pool.close()
+        written = writer.close()
+        journal.close()
+
+    elapsed = time.perf_counter() - start_time
+    print("\n" + "=" * 60)
+    print("🎯 PREDICTION RESULTS")
+    print("=" * 60)
+    print(f"🖼️  Written this run: {written} / {len(dataset)}")
+    print(f"📚 Completed in total: {len(journal.completed)} / {len(image_paths)}")
+    print(f"⏱️  Time: {elapsed:.1f}s  ({written / max(elapsed, 1e-9):.2f} images/s)")
+    if adaptive_stats is not None:
+        adaptive_stats.print_summary()
+    print(f"📁 Label maps: {output_dir}")
+    print("=" * 60)
+
+
+if __name__ == "__main__":
+    main()
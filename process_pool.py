@@ -0,0 +1,181 @@
+"""
+Multi-process CPU inference sharing one copy of the model weights.
+
+Independent prediction processes each load their own ViT-L + decoders (several
+GB each). `ProcessPoolPredictor` loads the model once, moves every parameter and
+buffer to shared memory (`share_model_memory`) and forks worker processes that
+use the same pages. Each worker:
+
+- is pinned to its own slice of the available cores (`os.sched_setaffinity`)
+  with as many intra-op threads, so workers do not oversubscribe the CPU,
+- pulls batches of dataset indices from a task queue (the tiles are shared out
+  dynamically, a slow batch does not hold up the others),
+- loads, predicts and crops its batches and sends the uint8 label maps back
+  through a result queue.
+
+The parent only feeds the task queue and collects results. Workers are forked
+(the DINOv3 wrapper cannot be pickled for spawn), so this needs Linux. The
+OpenMP thread pool of the parent does not survive the fork: once the parent has
+run an intra-op parallel region on more than one thread, a worker with more than
+one thread hangs in its first parallel op. The parent therefore runs on one
+intra-op thread from before the model is loaded until its workers are started
+(`fork_safe_parent`).
+"""
+
+import os
+import traceback
+
+import torch
+import torch.multiprocessing as mp
+
+from data import inference_collate_fn
+from padding import valid_sizes_from_mask
+
+
+def fork_safe_parent():
+    """
+    Run this process on one intra-op thread, so that workers forked from it can use several.
+
+    Call it before the first torch op of a process that will start a ProcessPoolPredictor
+    (before the model is loaded); the pool restores the returned count once its workers run.
+
+    Returns:
+        Previous number of intra-op threads
+    """
+    threads = torch.get_num_threads()
+    torch.set_num_threads(1)
+    return threads
+
+
+def share_model_memory(model):
+    """
+    Move all weights of a Mask2Former model (including the frozen ViT) to shared memory.
+
+    Returns:
+        Bytes of parameters and buffers now held once in shared memory
+    """
+    model.share_memory()
+    return sum(t.numel() * t.element_size() for t in (*model.parameters(), *model.buffers()))
+
+
+def core_slices(processes, threads_per_process=None):
+    """
+    Disjoint core sets for `processes` workers out of the cores this process may use.
+
+    Returns:
+        list of core lists (one per worker), each with `threads_per_process` cores
+        (default: an equal share of the available cores, at least one)
+    """
+    cores = sorted(os.sched_getaffinity(0))
+    threads = threads_per_process or max(1, len(cores) // processes)
+    if threads * processes > len(cores):
+        # More threads than cores: share the cores round-robin rather than fail
+        return [[cores[(rank * threads + i) % len(cores)] for i in range(threads)] for rank in range(processes)]
+    return [cores[rank * threads : (rank + 1) * threads] for rank in range(processes)]
+
+
+def _worker(rank, model, dataset, predict_fn, cores, pin_cores, tasks, results):
+    """Predict the batches of the task queue until the None sentinel; report errors to the parent."""
+    try:
+        if pin_cores:
+            os.sched_setaffinity(0, cores)
+        torch.set_num_threads(len(cores))
+        with torch.no_grad():
+            while True:
+                indices = tasks.get()
+                if indices is None:
+                    break
+                batch = inference_collate_fn([dataset[i] for i in indices])
+                labels = predict_fn(model, batch["pixel_values"], batch.get("pixel_mask"))
+                labels = labels.to(torch.uint8)
+                valid_sizes = valid_sizes_from_mask(batch.get("pixel_mask"))
+                for j, index in enumerate(indices):
+                    label_map = labels[j] if valid_sizes is None else labels[j, : valid_sizes[j, 0], : valid_sizes[j, 1]]
+                    results.put((index, label_map.numpy().copy(), batch["original_sizes"][j]))
+        results.put(("done", rank))
+    except BaseException:
+        results.put(("error", rank, traceback.format_exc()))
+
+
+class ProcessPoolPredictor:
+    """
+    Predict a dataset with several forked CPU workers sharing one model.
+
+    Args:
+        model: Mask2Former model on the CPU, in eval mode
+        dataset: Dataset with `inference_collate_fn` items (data.ImageListDataset)
+        predict_fn: (model, pixel_values, pixel_mask) -> (B, H, W) class ids; closures are
+            fine, workers are forked and nothing is pickled
+        processes: Worker processes
+        threads_per_process: Intra-op threads (and cores) per worker; None shares the cores equally
+        pin_cores: Pin every worker to its own cores
+        batch_size: Images per task
+        parent_threads: Intra-op threads of the parent once the workers are started (the count
+            returned by `fork_safe_parent`); None keeps the current count
+    """
+
+    def __init__(
+        self, model, dataset, predict_fn, processes, threads_per_process=None, pin_cores=True, batch_size=1,
+        parent_threads=None,
+    ):
+        if "fork" not in mp.get_all_start_methods():
+            raise RuntimeError("predict.processes > 1 needs the fork start method (Linux)")
+        self.model = model
+        self.dataset = dataset
+        self.predict_fn = predict_fn
+        self.processes = processes
+        self.cores = core_slices(processes, threads_per_process)
+        self.pin_cores = pin_cores
+        self.batch_size = batch_size
+        self.parent_threads = parent_threads or torch.get_num_threads()
+        # One intra-op thread from here until the workers are forked (see the module docstring)
+        torch.set_num_threads(1)
+        self.shared_bytes = share_model_memory(model)
+        self.workers = []
+
+    def predict(self, indices):
+        """
+        Yield (dataset index, (h, w) uint8 label map cropped to the valid region,
+        original (height, width)) for every index, in completion order.
+        """
+        indices = list(indices)
+        context = mp.get_context("fork")
+        tasks, results = context.Queue(), context.Queue()
+        for start in range(0, len(indices), self.batch_size):
+            tasks.put(indices[start : start + self.batch_size])
+        for _ in range(self.processes):
+            tasks.put(None)
+
+        self.workers = [
+            context.Process(
+                target=_worker,
+                args=(rank, self.model, self.dataset, self.predict_fn, cores, self.pin_cores, tasks, results),
+                daemon=True,
+            )
+            for rank, cores in enumerate(self.cores)
+        ]
+        torch.set_num_threads(1)
+        for worker in self.workers:
+            worker.start()
+        torch.set_num_threads(self.parent_threads)
+
+        finished = 0
+        try:
+            while finished < self.processes:
+                message = results.get()
+                if message[0] == "done":
+                    finished += 1
+                elif message[0] == "error":
+                    raise RuntimeError(f"Inference worker {message[1]} failed:\n{message[2]}")
+                else:
+                    yield message
+        finally:
+            self.close()
+
+    def close(self):
+        """Stop the workers (after completion, an error or an interrupt)."""
+        for worker in self.workers:
+            if worker.is_alive():
+                worker.terminate()
+            worker.join()
+        self.workers = []
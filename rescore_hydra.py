@@ -0,0 +1,88 @@
+import time
+import torch
+import hydra
+from omegaconf import DictConfig
+import os
+from tqdm import tqdm
+
+from evaluate_hydra import create_metrics, metric_names, report_results
+from eval_pipeline import confmat_metrics
+from logit_cache import LogitStore, store_dir
+from postprocess import post_process_from_config
+
+
+@hydra.main(version_base="1.3", config_path="conf", config_name="config")
+def main(cfg: DictConfig) -> None:
+    """
+    Recompute evaluation metrics from a prediction logit cache, without running the model.
+    
+    The cache is written by evaluate_hydra.py with evaluation.logit_cache.enabled=true.
+    Post-processing (model.post_processing) and metric settings
+    (training.validation.metrics) are taken from the current config, so they can be
+    changed and re-scored in seconds.
+    
+    Usage:
+        python rescore_hydra.py checkpoint_path=/path/to/checkpoint.ckpt
+        python rescore_hydra.py evaluation.logit_cache.store=/path/to/logit_cache/<hash>_<size>
+    """
+    cache_cfg = cfg.evaluation.logit_cache
+    checkpoint_path = getattr(cfg, 'checkpoint_path', None)
+    
+    if cache_cfg.store:
+        path = hydra.utils.to_absolute_path(cache_cfg.store)
+    elif checkpoint_path is not None:
+        if not os.path.exists(checkpoint_path):
+            print(f"❌ Error: Checkpoint not found: {checkpoint_path}")
+            return
+        path = store_dir(hydra.utils.to_absolute_path(cache_cfg.root), checkpoint_path, cfg.data.image_size)
+    else:
+        print("❌ Error: Please provide checkpoint_path or evaluation.logit_cache.store")
+        print("Usage: python rescore_hydra.py checkpoint_path=/path/to/checkpoint.ckpt")
+        return
+    
+    if not os.path.exists(os.path.join(path, "meta.json")):
+        print(f"❌ Error: No logit cache found at {path}")
+        print("💡 Create it with: python evaluate_hydra.py checkpoint_path=... evaluation.logit_cache.enabled=true")
+        return
+    
+    store = LogitStore.open(path)
+    meta = store.meta
+    
+    print("♻️  DINOv3+Mask2Former Re-scoring from Logit Cache")
+    print("=" * 60)
+    print(f"💾 Store: {path}")
+    print(f"📂 Checkpoint: {meta.get('checkpoint_path')}")
+    print(f"📊 Samples: {store.num_done}/{meta['num_samples']}")
+    print(f"🔢 Queries kept: {meta['queries_kept']}/{meta['num_queries']}")
+    print(f"📐 Mask logits: {meta['mask_size'][0]}×{meta['mask_size'][1]} → labels {meta['label_size'][0]}×{meta['label_size'][1]}")
+    print("=" * 60)
+    if store.num_done < meta['num_samples']:
+        print(f"⚠️  Cache is incomplete: scoring {store.num_done} of {meta['num_samples']} samples")
+    
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    confusion = create_metrics(cfg, device)
+    target_size = tuple(meta['label_size'])
+    
+    start_time = time.perf_counter()
+    num_batches = (store.num_done + cache_cfg.batch_size - 1) // cache_cfg.batch_size
+    for _, outputs, labels in tqdm(store.batches(cache_cfg.batch_size, device), desc='Re-scoring', total=num_batches):
+        preds = post_process_from_config(outputs, target_size, cfg.model.post_processing)
+        preds = torch.clamp(preds, 0, cfg.model.num_classes - 1).long()
+        confusion.update(preds, labels)
+    elapsed = time.perf_counter() - start_time
+    
+    final_results = confmat_metrics(confusion.compute(), metric_names(cfg))
+    print(f"⏱️  Re-scored {store.num_done} samples in {elapsed:.1f}s ({store.num_done / max(elapsed, 1e-9):.1f} images/s)")
+    
+    report_results(
+        cfg,
+        final_results,
+        meta.get('checkpoint_path'),
+        store.num_done,
+        results_filename="rescore_results.json",
+        extra={"logit_cache": path, "queries_kept": meta['queries_kept']},
+    )
+
+
+if __name__ == "__main__":
+    main()
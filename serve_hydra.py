@@ -0,0 +1,93 @@
+import asyncio
+import torch
+import hydra
+from omegaconf import DictConfig
+import os
+
+from inference import create_processor, decode_image, load_model, predict_labels, preprocess_image
+from inference_server import InferenceServer
+from tta import ViewBudget, build_views
+
+
+def resolve_device(name):
+    """"auto" → CUDA when available, else CPU."""
+    if name == "auto":
+        return torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    return torch.device(name)
+
+
+def build_server(cfg, model, processor, device):
+    """Wire the model and processor into an InferenceServer configured from cfg.serve."""
+    tta_budget = ViewBudget.from_config(cfg.model.tta)
+    
+    def preprocess(data):
+        return preprocess_image(processor, decode_image(data))
+    
+    def predict(pixel_values, pixel_mask):
+        return predict_labels(
+            model, pixel_values.to(device), cfg.model.post_processing, cfg.model.tta, tta_budget, pixel_mask,
+            cfg.model.adaptive_resolution,
+        )
+    
+    return InferenceServer(
+        preprocess,
+        predict,
+        max_batch_size=cfg.serve.max_batch_size,
+        max_latency_ms=cfg.serve.max_latency_ms,
+        max_queue_size=cfg.serve.max_queue_size,
+        num_preprocess_workers=cfg.serve.num_preprocess_workers,
+        max_body_bytes=int(cfg.serve.max_body_mb * 1024 * 1024),
+    )
+
+
+@hydra.main(version_base="1.3", config_path="conf", config_name="config")
+def main(cfg: DictConfig) -> None:
+    """
+    Serve the DINOv3+Mask2Former model over HTTP with dynamic batching.
+    
+    Usage:
+        python serve_hydra.py checkpoint_path=/path/to/checkpoint.ckpt
+        python serve_hydra.py checkpoint_path=... serve.port=9000 serve.max_batch_size=16
+        python serve_hydra.py serve.device=cpu      # untrained weights, for testing the stack
+    
+        curl --data-binary @tile.png "http://127.0.0.1:8080/predict" -o labels.png
+        curl "http://127.0.0.1:8080/metrics"
+    """
+    checkpoint_path = getattr(cfg, 'checkpoint_path', None)
+    if checkpoint_path is not None and not os.path.exists(checkpoint_path):
+        print(f"❌ Error: Checkpoint not found: {checkpoint_path}")
+        return
+    
+    device = resolve_device(cfg.serve.device)
+    torch.set_float32_matmul_precision(cfg.training.precision)
+    
+    print("🛰️  DINOv3+Mask2Former Inference Server")
+    print("=" * 60)
+    print(f"📂 Checkpoint: {checkpoint_path or 'none (untrained heads)'}")
+    print(f"🖥️  Device: {device}")
+    print(f"📐 Input size: {cfg.data.image_size}×{cfg.data.image_size}")
+    print(f"📦 Batching: up to {cfg.serve.max_batch_size} images / {cfg.serve.max_latency_ms} ms")
+    if cfg.model.tta.enabled:
+        print(f"🔄 TTA: {len(build_views(cfg.model.tta))} views per image")
+    print("=" * 60)
+    
+    processor = create_processor(cfg)
+    model = load_model(cfg, checkpoint_path, device)
+    server = build_server(cfg, model, processor, device)
+    
+    async def _run():
+        host, port = await server.start(cfg.serve.host, cfg.serve.port)
+        print(f"🚀 Listening on http://{host}:{port}  (POST /predict, GET /health, GET /metrics)")
+        try:
+            await server.serve_forever()
+        finally:
+            await server.stop()
+    
+    try:
+        asyncio.run(_run())
+    except KeyboardInterrupt:
+        print("\n👋 Server stopped")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""
+Token merging inside the frozen DINOv3 ViT.
+
+Remote-sensing tiles are dominated by homogeneous regions (water, forest,
+fields) whose 16x16 patch tokens stay nearly identical through the ViT. After
+a layer, bipartite soft matching (Bolya et al., "Token Merging: Your ViT but
+Faster") pairs every other patch token with its most similar token of the
+other half and merges the `ratio` most similar pairs by a size-weighted
+average; the following layers run on fewer tokens.
+
+- CLS and register tokens are never merged.
+- A merged token keeps the RoPE position of the token it was merged into.
+- Each token counts the patches it stands for (`size`), and `source` maps
+  every patch of the full grid to the token that currently represents it, so
+  `unmerge_patch_tokens` restores the (B, num_patches, C) layout the adapter
+  expects: all patches of a merged token get its features.
+
+Plain (not proportional) attention is kept so that the attention
+implementation of the HF model is untouched.
+"""
+
+import torch
+import torch.nn.functional as F
+
+
+def merge_ratios(ratio, num_layers):
+    """
+    Per-layer merge ratios from the `model.token_merging` setting.
+
+    Args:
+        ratio: None, a fraction of the patch tokens merged after every layer, or a
+            list with one fraction per ViT layer (missing layers do not merge)
+        num_layers: Number of ViT layers
+
+    Returns:
+        list of num_layers floats, or None when no layer merges
+    """
+    if ratio is None:
+        return None
+    ratios = [float(ratio)] * num_layers if isinstance(ratio, (int, float)) else [float(r) for r in ratio]
+    if len(ratios) > num_layers:
+        raise ValueError(f"token_merging has {len(ratios)} ratios for {num_layers} ViT layers")
+    if any(not 0.0 <= r <= 0.5 for r in ratios):
+        raise ValueError(f"token merging ratios must be in [0, 0.5], got {ratios}")
+    ratios += [0.0] * (num_layers - len(ratios))
+    return ratios if any(ratios) else None
+
+
+def _gather(tokens, index, dim=1):
+    """tokens.gather along `dim` with a (B, N) index broadcast over the trailing dims."""
+    shape = list(tokens.shape)
+    shape[dim] = index.shape[-1]
+    view = [index.shape[0]] + [1] * (tokens.dim() - 1)
+    view[dim] = index.shape[-1]
+    return tokens.gather(dim, index.view(view).expand(shape))
+
+
+def merge_patch_tokens(hidden_states, position_embeddings, merge, ratio, num_prefix_tokens):
+    """
+    Merge `ratio` of the patch tokens into their most similar tokens.
+
+    Args:
+        hidden_states: (B, num_prefix_tokens + P, C) output of a ViT layer
+        position_embeddings: RoPE (cos, sin) of the P patch tokens, (P, D) or (B, 1, P, D)
+        merge: (source, size) of the previous merges, or None before the first one
+        ratio: Fraction of the P patch tokens merged away (at most 0.5)
+        num_prefix_tokens: CLS + register tokens at the start of the sequence
+
+    Returns:
+        (hidden_states, position_embeddings, merge) with P - int(ratio * P) patch tokens
+    """
+    prefix, patches = hidden_states[:, :num_prefix_tokens], hidden_states[:, num_prefix_tokens:]
+    batch_size, num_patches, channels = patches.shape
+    num_a, num_b = (num_patches + 1) // 2, num_patches // 2
+    r = min(int(ratio * num_patches), num_b)
+    if r == 0:
+        return hidden_states, position_embeddings, merge
+
+    device = patches.device
+    if merge is None:
+        merge = (
+            torch.arange(num_patches, device=device).expand(batch_size, -1),
+            patches.new_ones((batch_size, num_patches, 1)),
+        )
+    source, size = merge
+    cos, sin = (
+        embedding if embedding.dim() == 4 else embedding.expand(batch_size, 1, -1, -1)
+        for embedding in position_embeddings
+    )
+
+    # Bipartite soft matching: every token of set A (even) proposes its most similar
+    # token of set B (odd); the r best proposals are merged
+    metric = F.normalize(patches.float(), dim=-1)
+    scores = metric[:, ::2] @ metric[:, 1::2].transpose(1, 2)
+    best, best_idx = scores.max(dim=-1)
+    order = best.argsort(dim=-1, descending=True)
+    src_idx, unm_idx = order[:, :r], order[:, r:]
+    dst_idx = best_idx.gather(1, src_idx)
+
+    # Size-weighted average of the merged tokens
+    patches_a, patches_b = patches[:, ::2], patches[:, 1::2]
+    size_a, size_b = size[:, ::2], size[:, 1::2]
+    weighted_b = (patches_b * size_b).scatter_add(
+        1, dst_idx[..., None].expand(-1, -1, channels), _gather(patches_a * size_a, src_idx)
+    )
+    size_b = size_b.scatter_add(1, dst_idx[..., None], _gather(size_a, src_idx))
+    patches = torch.cat([_gather(patches_a, unm_idx), weighted_b / size_b], dim=1)
+    size = torch.cat([_gather(size_a, unm_idx), size_b], dim=1)
+    cos, sin = (torch.cat([_gather(e[:, :, ::2], unm_idx, dim=2), e[:, :, 1::2]], dim=2) for e in (cos, sin))
+
+    # New index of every old token, then of every patch of the full grid
+    num_unm = num_a - r
+    new_a = torch.empty((batch_size, num_a), dtype=torch.long, device=device)
+    new_a.scatter_(1, unm_idx, torch.arange(num_unm, device=device).expand(batch_size, -1))
+    new_a.scatter_(1, src_idx, num_unm + dst_idx)
+    old_to_new = torch.empty((batch_size, num_patches), dtype=torch.long, device=device)
+    old_to_new[:, ::2] = new_a
+    old_to_new[:, 1::2] = num_unm + torch.arange(num_b, device=device)
+    source = old_to_new.gather(1, source)
+
+    return torch.cat([prefix, patches], dim=1), (cos, sin), (source, size)
+
+
+def unmerge_patch_tokens(patch_tokens, merge):
+    """(B, num_patches, C) tokens of the full grid from merged (B, P, C) patch tokens."""
+    if merge is None:
+        return patch_tokens
+    return _gather(patch_tokens, merge[0])
@@ -1,7 +1,7 @@
 import torch
 import pytorch_lightning as pl
 from transformers import AutoImageProcessor, Mask2FormerConfig
-from torchmetrics.classification import JaccardIndex
+from torchmetrics.classification import JaccardIndex, MulticlassConfusionMatrix
 import hydra
 from omegaconf import DictConfig, OmegaConf
 import os
@@ -10,7 +10,22 @@ from datetime import datetime
 from pathlib import Path
 
 # Import the model creation function from the new DINOv3 integration script
-from dinov3_mask2former_integration import create_dinov3_mask2former
+from checkpointing import CHECKPOINT_GROUPS, checkpointed_groups, plan_checkpointing, print_plan, set_checkpointing
+from dinov3_mask2former_integration import HF_TOKEN, create_dinov3_mask2former
+from distillation import distillation_losses, precompute_teacher_targets, student_config, teacher_targets
+from distributed import (
+    ddp_strategy,
+    local_device,
+    num_processes,
+    per_rank_batch_size,
+    prepare_data_parallel,
+    shard_validation,
+)
+from eval_pipeline import confmat_miou, reconstruct_ground_truth
+from logit_cache import store_dir
+from micro_batching import probe_micro_batch_size, rebatch
+from postprocess import post_process_from_config
+from precision import apply_precision_policy, policy_autocast, precision_plugins
 
 class SegmentationLightningModule(pl.LightningModule):
     """
@@ -32,6 +47,7 @@ class SegmentationLightningModule(pl.LightningModule):
             cfg.model.processor.name,
             do_reduce_labels=cfg.model.processor.do_reduce_labels,
             ignore_index=cfg.model.processor.ignore_index,
+            do_resize=cfg.data.resize,
             size={"height": cfg.data.image_size, "width": cfg.data.image_size}
         )
 
@@ -39,25 +55,25 @@ class SegmentationLightningModule(pl.LightningModule):
         model_kwargs = {
             "dinov3_model_name": cfg.model.dinov3_model_name,
             "interaction_indexes": cfg.model.interaction_indexes,
+            "matcher": cfg.model.matcher.type,
+            "matcher_workers": cfg.model.matcher.num_workers,
+            "num_queries": cfg.model.num_queries,
+            "query_init": cfg.model.query_init,
+            "projection_channels": cfg.model.projection_channels,
+            "fusion": cfg.model.adapter_fusion,
+            "schedule": cfg.model.adapter_schedule,
+            "deform_attn_precision": cfg.model.deform_attn_precision,
         }
         self.model, _, _ = create_dinov3_mask2former(
             num_classes=self.num_classes, **model_kwargs
         )
+        # Activation checkpointing; "auto" is planned in main() once the device is known
+        if cfg.training.checkpointing.modules != "auto":
+            set_checkpointing(self.model, cfg.training.checkpointing.modules)
 
-        # 2. Instantiate the Evaluation Metrics (mIoU)
-        self.val_mean_iou = JaccardIndex(
-            task="multiclass", 
-            num_classes=self.num_classes, 
-            ignore_index=255
-        )
-        
-        # Additional validation metric that excludes background (class 0)
-        if cfg.training.validation.metrics.exclude_background:
-            self.val_mean_iou_no_bg = JaccardIndex(
-                task="multiclass", 
-                num_classes=self.num_classes - 1,
-                ignore_index=255
-            )
+        # 2. Validation confusion matrix: both mIoUs (with and without background) are derived
+        # from it, and its state is merged across ranks once per epoch
+        self.val_confusion = MulticlassConfusionMatrix(num_classes=self.num_classes, ignore_index=255)
         
         # Test metrics (separate instance for testing)
         self.test_mean_iou = JaccardIndex(
@@ -66,19 +82,17 @@ class SegmentationLightningModule(pl.LightningModule):
             ignore_index=255
         )
 
-    def forward(self, pixel_values, mask_labels=None, class_labels=None):
-        """Forward pass through the model."""
+    def forward(self, pixel_values, mask_labels=None, class_labels=None, pixel_mask=None):
+        """Forward pass through the model (`pixel_mask` marks the real pixels of a padded batch)."""
         return self.model(
             pixel_values=pixel_values,
+            pixel_mask=pixel_mask,
             mask_labels=mask_labels,
             class_labels=class_labels
         )
 
-    def training_step(self, batch, batch_idx):
-        """
-        Defines one step of the training loop.
-        """
-        # Log image shapes on first batch of first epoch
+    def log_batch_shapes(self, batch):
+        """Print the input shapes and DINOv3 token counts of the first training batch."""
         if not self.logged_shapes:
             pixel_values_shape = batch["pixel_values"].shape
             print(f"📐 Training batch shapes:")
@@ -96,11 +110,19 @@ class SegmentationLightningModule(pl.LightningModule):
             print(f"  Resolution level: HIGH ({patches_h}×{patches_w} patches)")
             
             self.logged_shapes = True
+
+    def training_step(self, batch, batch_idx):
+        """
+        Defines one step of the training loop.
+        """
+        # Log image shapes on first batch of first epoch
+        self.log_batch_shapes(batch)
         
         outputs = self.forward(
             pixel_values=batch["pixel_values"],
             mask_labels=batch["mask_labels"],
             class_labels=batch["class_labels"],
+            pixel_mask=batch.get("pixel_mask"),
         )
         
         loss = outputs.loss
@@ -112,54 +134,21 @@ class SegmentationLightningModule(pl.LightningModule):
         """
         Defines one step of the validation loop.
         """
-        outputs = self.model(pixel_values=batch["pixel_values"])
+        outputs = self.model(pixel_values=batch["pixel_values"], pixel_mask=batch.get("pixel_mask"))
         
         # Post-process the raw outputs to get the final segmentation map.
-        original_sizes = [tuple(img.shape[-2:]) for img in batch["pixel_values"]]
-        predicted_maps = self.processor.post_process_semantic_segmentation(
-            outputs, target_sizes=original_sizes
-        )
+        # Class scores are combined at mask resolution for the whole batch at once.
+        target_size = tuple(batch["pixel_values"].shape[-2:])
+        preds_tensor = post_process_from_config(outputs, target_size, self.cfg.model.post_processing)
         
-        # Reconstruct the ground truth mask from the processor's format.
-        ground_truth_maps = []
-        for i in range(len(batch["pixel_values"])):
-            gt_map = torch.full_like(predicted_maps[i], 255)
-            for mask, class_id in zip(batch["mask_labels"][i], batch["class_labels"][i]):
-                gt_map[mask.bool()] = class_id.item()
-            ground_truth_maps.append(gt_map)
+        # Reconstruct the ground truth mask from the processor's format (255 = not covered).
+        gt_tensor = reconstruct_ground_truth(batch["mask_labels"], batch["class_labels"], target_size, self.device)
 
         # Ensure predictions are valid (clamp to valid class range)
-        pred_maps_clamped = []
-        for pred_map in predicted_maps:
-            pred_clamped = torch.clamp(pred_map, 0, self.num_classes - 1)
-            pred_maps_clamped.append(pred_clamped)
-        
-        preds_tensor = torch.stack(pred_maps_clamped)
-        gt_tensor = torch.stack(ground_truth_maps)
+        preds_tensor = torch.clamp(preds_tensor, 0, self.num_classes - 1).to(self.device).long()
         
-        # Ensure tensors are on the same device and have the correct dtype
-        preds_tensor = preds_tensor.to(self.device).long()
-        gt_tensor = gt_tensor.to(self.device).long()
-        
-        # Update standard validation metric (includes background)
-        if self.cfg.training.validation.metrics.include_background:
-            self.val_mean_iou.update(preds_tensor, gt_tensor)
-        
-        # Prepare tensors for no-background metric
-        if self.cfg.training.validation.metrics.exclude_background:
-            preds_no_bg = preds_tensor.clone()
-            gt_no_bg = gt_tensor.clone()
-            
-            for original_class in range(self.num_classes):
-                if original_class == 0:  # background -> ignore
-                    preds_no_bg[preds_tensor == original_class] = 255
-                    gt_no_bg[gt_tensor == original_class] = 255
-                else:  # classes 1-6 -> 0-5
-                    preds_no_bg[preds_tensor == original_class] = original_class - 1
-                    gt_no_bg[gt_tensor == original_class] = original_class - 1
-            
-            # Update no-background validation metric (semantic classes only)
-            self.val_mean_iou_no_bg.update(preds_no_bg, gt_no_bg)
+        # Accumulated on this rank only; merged in on_validation_epoch_end
+        self.val_confusion.update(preds_tensor, gt_tensor)
 
     def on_validation_epoch_end(self):
         """
@@ -168,40 +157,37 @@ class SegmentationLightningModule(pl.LightningModule):
         metrics = {}
         current_epoch = self.current_epoch
         
+        # One merge of the per-rank confusion matrices; the mIoUs derived from it are the
+        # same on every rank, so they are logged without sync_dist
+        confmat = self.val_confusion.compute()
+        self.val_confusion.reset()
+        
         # Compute metrics based on configuration
         if self.cfg.training.validation.metrics.include_background:
-            miou = self.val_mean_iou.compute()
-            metrics["val_mean_iou"] = miou
-            self.log("val_mean_iou", miou, prog_bar=True, logger=True, sync_dist=True)
+            metrics["val_mean_iou"] = confmat_miou(confmat)
         
         if self.cfg.training.validation.metrics.exclude_background:
-            miou_no_bg = self.val_mean_iou_no_bg.compute()
-            metrics["val_mean_iou_no_bg"] = miou_no_bg  
-            self.log("val_mean_iou_no_bg", miou_no_bg, prog_bar=True, logger=True, sync_dist=True)
+            # Background pixels ignored; other pixels predicted as background count as misses
+            metrics["val_mean_iou_no_bg"] = confmat_miou(confmat, exclude_background=True)
         
-        # Print progress info
+        for name, value in metrics.items():
+            self.log(name, value, prog_bar=True, logger=True)
+        
+        # Print progress info (rank 0 only)
         if len(metrics) == 2:
-            print(f"🎯 Epoch {current_epoch}: val_mean_iou = {metrics['val_mean_iou']:.4f} | val_mean_iou_no_bg = {metrics['val_mean_iou_no_bg']:.4f}")
-            print(f"   📊 All classes: {metrics['val_mean_iou']:.1%} | Semantic only: {metrics['val_mean_iou_no_bg']:.1%}")
+            self.print(f"🎯 Epoch {current_epoch}: val_mean_iou = {metrics['val_mean_iou']:.4f} | val_mean_iou_no_bg = {metrics['val_mean_iou_no_bg']:.4f}")
+            self.print(f"   📊 All classes: {metrics['val_mean_iou']:.1%} | Semantic only: {metrics['val_mean_iou_no_bg']:.1%}")
         elif "val_mean_iou_no_bg" in metrics:
-            print(f"🎯 Epoch {current_epoch}: val_mean_iou_no_bg = {metrics['val_mean_iou_no_bg']:.4f} ({metrics['val_mean_iou_no_bg']:.1%})")
+            self.print(f"🎯 Epoch {current_epoch}: val_mean_iou_no_bg = {metrics['val_mean_iou_no_bg']:.4f} ({metrics['val_mean_iou_no_bg']:.1%})")
         elif "val_mean_iou" in metrics:
-            print(f"🎯 Epoch {current_epoch}: val_mean_iou = {metrics['val_mean_iou']:.4f} ({metrics['val_mean_iou']:.1%})")
-        
-        # Reset metrics
-        if self.cfg.training.validation.metrics.include_background:
-            self.val_mean_iou.reset()
-        if self.cfg.training.validation.metrics.exclude_background:
-            self.val_mean_iou_no_bg.reset()
+            self.print(f"🎯 Epoch {current_epoch}: val_mean_iou = {metrics['val_mean_iou']:.4f} ({metrics['val_mean_iou']:.1%})")
 
     def configure_optimizers(self):
         """
         Configures the optimizer and learning rate scheduler.
         """
-        trainable_params = [
-            p for n, p in self.model.named_parameters() 
-            if "dinov3_backbone" not in n and p.requires_grad
-        ]
+        # The frozen ViT (encoder.vit) has requires_grad=False
+        trainable_params = [p for p in self.model.parameters() if p.requires_grad]
         
         print(f"Found {len(trainable_params)} trainable parameters.")
         
@@ -233,6 +219,142 @@ class SegmentationLightningModule(pl.LightningModule):
         return optimizer
 
 
+class DistillationLightningModule(SegmentationLightningModule):
+    """
+    Trains a student model against a trained teacher (see distillation.py).
+
+    `cfg` is the student config (`distillation.student_config`); the teacher targets
+    come from a precomputed TeacherStore or, without one, from running `teacher`.
+    """
+    def __init__(self, cfg: DictConfig, teacher=None, teacher_store=None):
+        """
+        Args:
+            cfg: Hydra configuration of the student
+            teacher: Frozen teacher Mask2Former model (run every step if there is no store)
+            teacher_store: distillation.TeacherStore with the targets of every training sample
+        """
+        super().__init__(cfg)
+        if teacher is None and teacher_store is None:
+            raise ValueError("distillation needs a teacher model or a teacher store")
+        self.distill_cfg = cfg.training.distillation
+        self.levels = list(self.distill_cfg.feature_levels)
+        self.teacher_store = teacher_store
+        # Plain attribute, not a submodule: the teacher is neither trained nor saved in checkpoints
+        self.__dict__["teacher"] = teacher
+
+    def on_fit_start(self):
+        if self.teacher is not None:
+            self.teacher.to(self.device).eval()
+
+    def training_step(self, batch, batch_idx):
+        """
+        Mask2Former loss on the labels plus feature and logit distillation losses.
+        """
+        self.log_batch_shapes(batch)
+        pixel_values, pixel_mask = batch["pixel_values"], batch.get("pixel_mask")
+        outputs = self.model(
+            pixel_values=pixel_values,
+            pixel_mask=pixel_mask,
+            mask_labels=batch["mask_labels"],
+            class_labels=batch["class_labels"],
+            output_hidden_states=True,
+        )
+        
+        if self.teacher_store is not None:
+            targets = self.teacher_store.read(batch["indices"], self.device)
+        else:
+            with torch.no_grad():
+                targets = teacher_targets(self.teacher, pixel_values, pixel_mask, self.levels)
+        losses = distillation_losses(outputs, targets, self.levels, pixel_values, pixel_mask)
+        
+        loss = (
+            self.distill_cfg.task_weight * outputs.loss
+            + self.distill_cfg.feature_weight * losses["feature"]
+            + self.distill_cfg.logit_weight * losses["logit"]
+        )
+        
+        batch_size = pixel_values.shape[0]
+        self.log("train_loss", loss, on_step=True, on_epoch=True, prog_bar=True, logger=True, batch_size=batch_size)
+        self.log("train_task_loss", outputs.loss, on_step=False, on_epoch=True, logger=True, batch_size=batch_size)
+        self.log("train_feature_loss", losses["feature"], on_step=False, on_epoch=True, logger=True, batch_size=batch_size)
+        self.log("train_logit_loss", losses["logit"], on_step=False, on_epoch=True, logger=True, batch_size=batch_size)
+        return loss
+
+
+def load_frozen_model(cfg: DictConfig, checkpoint_path):
+    """Trained model of a checkpoint (architecture from cfg.model), frozen and in eval mode."""
+    model = SegmentationLightningModule.load_from_checkpoint(checkpoint_path, cfg=cfg, map_location="cpu").model
+    model.requires_grad_(False)
+    return model.eval()
+
+
+def prepare_distillation(cfg: DictConfig, train_dataset, device):
+    """
+    Teacher and teacher store for a distillation run.
+
+    With the cache enabled the teacher runs once over the training set (resumable)
+    and is released; otherwise it is returned to be run at every step.
+
+    Returns:
+        (teacher or None, TeacherStore or None)
+    """
+    from torch.utils.data import DataLoader
+    from data import collate_fn
+
+    distill_cfg = cfg.training.distillation
+    print(f"👩‍🏫 Loading teacher: {distill_cfg.teacher_checkpoint}")
+    teacher = load_frozen_model(cfg, distill_cfg.teacher_checkpoint)
+    if not distill_cfg.cache.enabled:
+        return teacher, None
+    
+    path = store_dir(hydra.utils.to_absolute_path(distill_cfg.cache.root),
+                     distill_cfg.teacher_checkpoint, cfg.data.image_size)
+    loader = DataLoader(train_dataset, batch_size=cfg.data.batch_size, shuffle=False,
+                        num_workers=cfg.data.num_workers, collate_fn=collate_fn)
+    store = precompute_teacher_targets(
+        teacher.to(device), loader, path, distill_cfg.feature_levels, device,
+        teacher_checkpoint=distill_cfg.teacher_checkpoint, image_size=cfg.data.image_size,
+    )
+    del teacher
+    if device.type == "cuda":
+        torch.cuda.empty_cache()
+    return None, store
+
+
+def compare_with_teacher(cfg: DictConfig, student_cfg: DictConfig, student_checkpoint, val_loader, device):
+    """
+    Throughput and mIoU of the best student checkpoint and of the teacher on Val.
+
+    Both models are measured with benchmark_hydra.run_benchmark on the first
+    `training.distillation.report_batches` validation batches (all if null).
+
+    Returns:
+        dict with "teacher" and "student" benchmark results
+    """
+    from itertools import islice
+    from benchmark_hydra import print_results, run_benchmark
+
+    distill_cfg = cfg.training.distillation
+    models = {
+        "teacher": (cfg, load_frozen_model(cfg, distill_cfg.teacher_checkpoint)),
+        "student": (student_cfg, load_frozen_model(student_cfg, student_checkpoint)),
+    }
+    comparison = {}
+    print("\n⚖️  Student vs. teacher on Val")
+    for name, (model_cfg, model) in models.items():
+        model = model.to(device)
+        with torch.no_grad():
+            comparison[name] = run_benchmark(model_cfg, model, islice(val_loader, distill_cfg.report_batches),
+                                             device, has_labels=True)
+        comparison[name]["dinov3_model_name"] = model_cfg.model.dinov3_model_name
+        print_results(f"{name} ({model_cfg.model.dinov3_model_name})", comparison[name])
+        del model
+    teacher_speed = comparison["teacher"]["images_per_s"]
+    comparison["speedup"] = comparison["student"]["images_per_s"] / teacher_speed if teacher_speed else float("nan")
+    print(f"  Student speed-up: {comparison['speedup']:.2f}×")
+    return comparison
+
+
 def setup_run_directory(cfg: DictConfig) -> Path:
     """Setup the run directory and copy config."""
     # Hydra automatically sets the working directory to the output directory
@@ -266,8 +388,23 @@ def main(cfg: DictConfig) -> None:
     # Set matmul precision
     torch.set_float32_matmul_precision(cfg.training.precision)
     
+    # Distillation: the run trains (and its config.yaml describes) the student model
+    distill_cfg = cfg.training.distillation
+    train_cfg = cfg
+    if distill_cfg.enabled:
+        if distill_cfg.teacher_checkpoint is None or not os.path.exists(distill_cfg.teacher_checkpoint):
+            print(f"❌ Error: Teacher checkpoint not found: {distill_cfg.teacher_checkpoint}")
+            print("Usage: python train_hydra.py training.distillation.enabled=true "
+                  "training.distillation.teacher_checkpoint=/path/to/teacher.ckpt")
+            return
+        train_cfg = student_config(cfg, HF_TOKEN)
+        print(f"👩‍🏫 Distillation: {cfg.model.dinov3_model_name} {list(cfg.model.interaction_indexes)} → "
+              f"{train_cfg.model.dinov3_model_name} {list(train_cfg.model.interaction_indexes)}")
+        print(f"   Losses: task ×{distill_cfg.task_weight}, features (levels {list(distill_cfg.feature_levels)}) "
+              f"×{distill_cfg.feature_weight}, logits ×{distill_cfg.logit_weight}")
+    
     # Setup run directory
-    run_dir = setup_run_directory(cfg)
+    run_dir = setup_run_directory(train_cfg)
     
     # Import data loading
     from data import create_dataloaders
@@ -277,6 +414,7 @@ def main(cfg: DictConfig) -> None:
         cfg.model.processor.name,
         do_reduce_labels=cfg.model.processor.do_reduce_labels,
         ignore_index=cfg.model.processor.ignore_index,
+        do_resize=cfg.data.resize,
         size={"height": cfg.data.image_size, "width": cfg.data.image_size}
     )
 
@@ -287,8 +425,76 @@ def main(cfg: DictConfig) -> None:
         num_workers=cfg.data.num_workers
     )
     
+    # Data-parallel training: one process per device; the launcher reruns this script in the
+    # other processes, which probe on their own device
+    distributed_cfg = cfg.training.distributed
+    world_size = num_processes(distributed_cfg.devices)
+    device = local_device()
+    # The processor pads to a multiple of 32 (720 → 736)
+    image_size = -(-cfg.data.image_size // 32) * 32
+    
     # Setup Lightning module
-    model_module = SegmentationLightningModule(cfg)
+    if distill_cfg.enabled:
+        teacher, teacher_store = prepare_distillation(cfg, train_loader.dataset, device)
+        model_module = DistillationLightningModule(train_cfg, teacher=teacher, teacher_store=teacher_store)
+    else:
+        model_module = SegmentationLightningModule(cfg)
+    if world_size > 1:
+        ddp_setup = prepare_data_parallel(model_module, device)
+        print(f"🌐 Data parallel: {world_size} processes on {device.type}, frozen ViT left out of DDP "
+              f"({ddp_setup['ignored']} tensors)"
+              + (f", {ddp_setup['reverted_sync_batchnorm']} SyncBatchNorms as per-rank BatchNorms"
+                 if ddp_setup["reverted_sync_batchnorm"] else ""))
+    
+    # Mixed precision: frozen ViT and fp32 loss here, autocast and loss scaling in the Trainer
+    precision_cfg = cfg.training.mixed_precision
+    vit_precision = apply_precision_policy(model_module.model, precision_cfg.policy, precision_cfg.frozen_backbone)
+    print(f"🎚️  Precision: {precision_cfg.policy}, frozen ViT {vit_precision}, loss fp32")
+    
+    # Micro-batching: the largest micro-batch that fits, accumulated to the effective batch size
+    micro_batch_size, accumulate_grad_batches = cfg.data.batch_size, cfg.training.accumulate_grad_batches
+    micro_batch_probe = None
+    if cfg.training.effective_batch_size is not None:
+        probe_cfg = cfg.training.micro_batch_probe
+        rank_batch_size = per_rank_batch_size(cfg.training.effective_batch_size, world_size)
+        if cfg.training.checkpointing.modules == "auto":
+            # Probed with every group checkpointed (the least memory); the plan below then
+            # relaxes the policy as far as the chosen micro-batch allows
+            set_checkpointing(model_module.model, CHECKPOINT_GROUPS)
+        with policy_autocast(precision_cfg.policy, device):
+            micro_batch_probe = probe_micro_batch_size(
+                model_module.model, image_size, rank_batch_size, device,
+                probe_cfg.max_micro_batch_size, probe_cfg.memory_fraction,
+            )
+        micro_batch_size = micro_batch_probe["micro_batch_size"]
+        accumulate_grad_batches = micro_batch_probe["accumulate_grad_batches"]
+        for probe in micro_batch_probe["probes"]:
+            peak = "out of memory" if probe["peak_mb"] is None else f"{probe['peak_mb']:.0f} MB"
+            print(f"   micro-batch {probe['micro_batch_size']}: {peak} ({micro_batch_probe['method']})")
+        if not micro_batch_probe["fits"]:
+            print(f"⚠️  No micro-batch fits {micro_batch_probe['budget_mb']:.0f} MB; training with 1")
+        train_loader = rebatch(train_loader, micro_batch_size)
+        val_loader = rebatch(val_loader, micro_batch_size)
+    # Activation checkpointing policy from the memory planner, for the micro-batch trained
+    checkpointing_plan = None
+    if cfg.training.checkpointing.modules == "auto":
+        with policy_autocast(precision_cfg.policy, device):
+            checkpointing_plan = plan_checkpointing(
+                model_module.model, image_size, micro_batch_size,
+                cfg.training.checkpointing.memory_budget_mb, device,
+            )
+        print_plan(checkpointing_plan)
+        set_checkpointing(model_module.model, checkpointing_plan["groups"])
+    print(f"♻️  Activation checkpointing: {checkpointed_groups(model_module.model) or 'none'}")
+    
+    effective_batch_size = micro_batch_size * accumulate_grad_batches * world_size
+    # Each rank validates its own shard, every sample once; the teacher comparison after
+    # fit (rank 0 only) keeps the whole Val set
+    fit_val_loader = shard_validation(val_loader) if world_size > 1 else val_loader
+    print(f"📦 Batch: {micro_batch_size} × {accumulate_grad_batches} accumulated"
+          + (f" × {world_size} processes" if world_size > 1 else "")
+          + f" = {effective_batch_size} images per step"
+          + (f", gradients clipped to norm {cfg.training.gradient_clipping}" if cfg.training.gradient_clipping else ""))
     
     # Setup callbacks
     checkpoint_callback = pl.callbacks.ModelCheckpoint(
@@ -321,15 +527,23 @@ def main(cfg: DictConfig) -> None:
     trainer = pl.Trainer(
         max_epochs=cfg.training.max_epochs,
         accelerator="auto",
-        devices="auto",
+        devices=world_size,
+        strategy=ddp_strategy(distributed_cfg, accumulate_grad_batches) if world_size > 1 else "auto",
         callbacks=[checkpoint_callback],
         logger=loggers,
         log_every_n_steps=cfg.logging.log_every_n_steps,
+        accumulate_grad_batches=accumulate_grad_batches,
+        gradient_clip_val=cfg.training.gradient_clipping,
+        plugins=precision_plugins(precision_cfg.policy, device),
     )
     
     # Start training
     print("🚀 Starting training...")
-    trainer.fit(model=model_module, train_dataloaders=train_loader, val_dataloaders=val_loader)
+    trainer.fit(model=model_module, train_dataloaders=train_loader, val_dataloaders=fit_val_loader)
+    
+    # Summary, teacher comparison and results file once, from rank 0
+    if not trainer.is_global_zero:
+        return
     
     # Training Summary
     print("\n" + "="*60)
@@ -354,11 +568,18 @@ def main(cfg: DictConfig) -> None:
         
         print(f"📊 Performance Level: {performance}")
         
+        # Throughput and mIoU of the distilled student against its teacher
+        distillation_report = None
+        if distill_cfg.enabled:
+            distillation_report = compare_with_teacher(
+                cfg, train_cfg, checkpoint_callback.best_model_path, val_loader, device
+            )
+        
         # Save training summary
         if cfg.logging.save_results:
             import json
             results_summary = {
-                "model": cfg.model.name,
+                "model": train_cfg.model.name,
                 "dataset": cfg.data.name,
                 "best_val_miou_metric": cfg.training.validation.primary_metric,
                                   "best_val_miou_score": float(checkpoint_callback.best_model_score),
@@ -366,11 +587,29 @@ def main(cfg: DictConfig) -> None:
                   "image_size": f"{cfg.data.image_size}x{cfg.data.image_size}",
                   "patches_per_side": cfg.data.image_size // 16,
                   "total_patches": (cfg.data.image_size // 16) ** 2,
-                "batch_size": cfg.data.batch_size,
-                "interaction_indexes": cfg.model.interaction_indexes,
+                "batch_size": micro_batch_size,
+                "accumulate_grad_batches": accumulate_grad_batches,
+                "effective_batch_size": effective_batch_size,
+                "world_size": world_size,
+                "gradient_clipping": cfg.training.gradient_clipping,
+                "mixed_precision": {"policy": precision_cfg.policy, "frozen_backbone": vit_precision},
+                "interaction_indexes": list(train_cfg.model.interaction_indexes),
+                "activation_checkpointing": checkpointed_groups(model_module.model),
                 "config_path": str(run_dir / "config.yaml"),
                 "note": "mIoU calculated based on configured metrics"
             }
+            if micro_batch_probe is not None:
+                results_summary["micro_batch_probe"] = micro_batch_probe
+            if checkpointing_plan is not None:
+                results_summary["checkpointing_plan"] = {
+                    key: checkpointing_plan[key]
+                    for key in ("groups", "fits", "total_mb", "recompute_s", "budget_mb", "static_mb", "measured")
+                }
+            if distillation_report is not None:
+                results_summary["distillation"] = {
+                    "teacher_checkpoint": distill_cfg.teacher_checkpoint,
+                    **distillation_report,
+                }
             
             results_path = run_dir / cfg.logging.results_filename
             with open(results_path, "w") as f:
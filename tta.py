@@ -0,0 +1,278 @@
+"""
+Batched test-time augmentation (TTA) for semantic segmentation.
+
+Every image of a batch is evaluated under a set of views (scale × {identity,
+horizontal/vertical flip, 90/180/270° rotation}). Instead of one forward per
+view, all (image, view) pairs that produce the same input shape are packed into
+forwards of as many views as fit in `memory_budget_mb`. The per-class scores of
+each view (`postprocess.semantic_logits`, at mask resolution) are mapped back to
+the original orientation and scale, averaged, and only then turned into labels.
+
+Remote-sensing tiles have no canonical orientation, so flips and rotations are
+label-preserving augmentations.
+
+Padded batches (see padding.py) are augmented per image on the valid region
+only; views whose size is not a multiple of `size_multiple` are padded again
+and run with a `pixel_mask`.
+"""
+
+from collections import namedtuple
+
+import torch
+import torch.nn.functional as F
+
+from padding import group_by_size, pad_batch, valid_sizes_from_mask
+from postprocess import labels_from_semantic_logits, semantic_logits
+
+# flip: None, "horizontal" or "vertical"; rotation: number of counter-clockwise quarter turns
+View = namedtuple("View", ["scale", "flip", "rotation"])
+
+_FLIPS = ("horizontal", "vertical")
+
+
+def build_views(tta_cfg):
+    """
+    Views from `cfg.model.tta`: every scale combined with the identity, each flip
+    and each rotation (flips and rotations are not composed with each other).
+    """
+    transforms = [(None, 0)]
+    for flip in tta_cfg.flips:
+        if flip not in _FLIPS:
+            raise ValueError(f"TTA flips must be in {_FLIPS}, got {flip!r}")
+        transforms.append((flip, 0))
+    for degrees in tta_cfg.rotations:
+        if degrees % 90 != 0:
+            raise ValueError(f"TTA rotations must be multiples of 90 degrees, got {degrees}")
+        if degrees % 360 != 0:
+            transforms.append((None, (degrees // 90) % 4))
+
+    views = []
+    for scale in tta_cfg.scales:
+        for flip, rotation in dict.fromkeys(transforms):
+            views.append(View(float(scale), flip, rotation))
+    return views
+
+
+def view_size(size, view, size_multiple=32):
+    """(height, width) of the model input for `view` of an image of `size`."""
+    height, width = size
+    if view.scale != 1.0:
+        height = max(size_multiple, int(round(height * view.scale / size_multiple)) * size_multiple)
+        width = max(size_multiple, int(round(width * view.scale / size_multiple)) * size_multiple)
+    if view.rotation % 2 == 1:
+        height, width = width, height
+    return height, width
+
+
+def apply_view(images, view, size_multiple=32):
+    """Augment a (B, 3, H, W) batch: rescale, then flip, then rotate."""
+    if view.scale != 1.0:
+        scaled = view_size(images.shape[-2:], View(view.scale, None, 0), size_multiple)
+        images = F.interpolate(images, size=scaled, mode="bilinear", align_corners=False)
+    if view.flip == "horizontal":
+        images = images.flip(-1)
+    elif view.flip == "vertical":
+        images = images.flip(-2)
+    if view.rotation:
+        images = torch.rot90(images, view.rotation, dims=(-2, -1))
+    return images
+
+
+def invert_view(logits, view, size):
+    """Map (N, C, h, w) scores of `view` back to the original orientation at `size`."""
+    if view.rotation:
+        logits = torch.rot90(logits, -view.rotation, dims=(-2, -1))
+    if view.flip == "horizontal":
+        logits = logits.flip(-1)
+    elif view.flip == "vertical":
+        logits = logits.flip(-2)
+    if tuple(logits.shape[-2:]) != tuple(size):
+        logits = F.interpolate(logits, size=size, mode="bilinear", align_corners=False)
+    return logits
+
+
+class ViewBudget:
+    """
+    Number of views that fit into one forward pass.
+
+    On CUDA the activation memory per input pixel is measured once with two
+    small forwards (1 and 2 views) and chunks are sized so the estimated peak
+    stays under `memory_budget_mb`. Elsewhere (no peak-memory statistics) the
+    chunk size is `max_views_per_forward`.
+    """
+
+    def __init__(self, memory_budget_mb, max_views_per_forward=None):
+        self.budget_bytes = memory_budget_mb * 1024 * 1024
+        self.max_views = max_views_per_forward
+        self.bytes_per_pixel = None
+        self.fixed_bytes = 0
+
+    @classmethod
+    def from_config(cls, tta_cfg):
+        return cls(tta_cfg.memory_budget_mb, tta_cfg.max_views_per_forward)
+
+    @torch.no_grad()
+    def calibrate(self, model, input_shape, device):
+        """Measure per-pixel forward memory for (3, H, W) inputs (CUDA only, once)."""
+        if self.bytes_per_pixel is not None or device.type != "cuda":
+            return
+        peaks = []
+        for num_views in (1, 2):
+            torch.cuda.synchronize(device)
+            torch.cuda.reset_peak_memory_stats(device)
+            baseline = torch.cuda.memory_allocated(device)
+            probe = torch.zeros((num_views, *input_shape), device=device)
+            model(pixel_values=probe)
+            torch.cuda.synchronize(device)
+            peaks.append(torch.cuda.max_memory_allocated(device) - baseline)
+            del probe
+        per_view = max(peaks[1] - peaks[0], 1)
+        self.bytes_per_pixel = per_view / (input_shape[-2] * input_shape[-1])
+        self.fixed_bytes = max(peaks[0] - per_view, 0)
+        print(f"📏 TTA budget: ~{per_view / 2**20:.0f} MB per {input_shape[-2]}×{input_shape[-1]} view, "
+              f"{self.capacity(*input_shape[-2:])} views per forward")
+
+    def capacity(self, height, width):
+        """Views of (height, width) per forward."""
+        if self.bytes_per_pixel is None:
+            return max(1, self.max_views or 1)
+        views = int((self.budget_bytes - self.fixed_bytes) // (self.bytes_per_pixel * height * width))
+        if self.max_views:
+            views = min(views, self.max_views)
+        return max(1, views)
+
+
+class TTAPlan:
+    """
+    Packing of all (image, view) pairs of one batch into forward-sized chunks.
+
+    Iterating yields `(entries, inputs)` where `entries` lists the (view index,
+    image index) of every row of `inputs`, the keyword arguments of the model
+    forward (`pixel_values` and, for padded views, `pixel_mask`). Model outputs
+    for each chunk are folded into a running sum with `accumulate()`;
+    `finalize()` averages over views and produces the label maps.
+    """
+
+    def __init__(self, pixel_values, views, budget, size_multiple=32, pixel_mask=None):
+        self.pixel_values = pixel_values
+        self.views = views
+        self.size_multiple = size_multiple
+        batch_size, _, height, width = pixel_values.shape
+        # Mask2Former predicts masks at 1/4 of the input resolution
+        self.output_size = ((height + 3) // 4, (width + 3) // 4)
+        valid_sizes = valid_sizes_from_mask(pixel_mask)
+        self.sizes = group_by_size(valid_sizes) if valid_sizes is not None else {(height, width): list(range(batch_size))}
+        self.image_sizes = {i: size for size, images in self.sizes.items() for i in images}
+
+        # Views producing the same input shape from images of the same size can share a forward
+        groups = {}
+        for size, images in self.sizes.items():
+            for view_idx, view in enumerate(views):
+                shape = view_size(size, view, size_multiple)
+                groups.setdefault((size, shape), []).extend((view_idx, b) for b in images)
+
+        self.chunks = []
+        for (_, (view_height, view_width)), entries in groups.items():
+            capacity = budget.capacity(view_height, view_width)
+            for start in range(0, len(entries), capacity):
+                self.chunks.append(entries[start : start + capacity])
+
+    def __len__(self):
+        return len(self.chunks)
+
+    def __iter__(self):
+        for entries in self.chunks:
+            yield entries, self._materialize(entries)
+
+    def _by_view(self, entries):
+        """Rows of `entries` grouped by view: {view index: (rows, image indices)}."""
+        grouped = {}
+        for row, (view_idx, image_idx) in enumerate(entries):
+            rows, images = grouped.setdefault(view_idx, ([], []))
+            rows.append(row)
+            images.append(image_idx)
+        return grouped
+
+    def _materialize(self, entries):
+        # All images of a chunk have the same size
+        height, width = self.image_sizes[entries[0][1]]
+        parts = []
+        for view_idx, (_, images) in self._by_view(entries).items():
+            images = self.pixel_values[images, :, :height, :width]
+            parts.append(apply_view(images, self.views[view_idx], self.size_multiple))
+        pixel_values, pixel_mask = pad_batch(list(torch.cat(parts, dim=0)), self.size_multiple)
+        if pixel_mask is None:
+            return {"pixel_values": pixel_values}
+        return {"pixel_values": pixel_values, "pixel_mask": pixel_mask.to(pixel_values.device)}
+
+    def accumulate(self, running, entries, outputs):
+        """
+        Add the de-augmented class scores of one chunk to `running`.
+
+        Args:
+            running: (B, num_classes, h, w) running sum, or None for the first chunk
+            entries: Entries yielded with the chunk
+            outputs: Model outputs for the chunk
+
+        Returns:
+            The updated running sum
+        """
+        logits = semantic_logits(outputs.class_queries_logits, outputs.masks_queries_logits)
+        if running is None:
+            running = logits.new_zeros((self.pixel_values.shape[0], logits.shape[1], *self.output_size))
+        height, width = self.image_sizes[entries[0][1]]
+        output_size = ((height + 3) // 4, (width + 3) // 4)
+        for view_idx, (rows, images) in self._by_view(entries).items():
+            # Scores of the valid region of the (possibly padded) view
+            view_height, view_width = view_size((height, width), self.views[view_idx], self.size_multiple)
+            view_logits = logits[rows, :, : (view_height + 3) // 4, : (view_width + 3) // 4]
+            restored = invert_view(view_logits, self.views[view_idx], output_size)
+            target = running[:, :, : output_size[0], : output_size[1]]
+            target.index_add_(0, torch.as_tensor(images, device=running.device), restored)
+        return running
+
+    def finalize(self, running, target_size, post_cfg):
+        """Average over views and post-process to (B, H, W) label maps (zeros on padding)."""
+        running = running / len(self.views)
+        if len(self.sizes) == 1 and next(iter(self.sizes)) == tuple(self.pixel_values.shape[-2:]):
+            return labels_from_semantic_logits(running, target_size, post_cfg.upsample, post_cfg.refine_boundaries)
+
+        # Padded batch: every image size is post-processed on its valid region only
+        labels = None
+        scale_h = target_size[0] / self.pixel_values.shape[-2]
+        scale_w = target_size[1] / self.pixel_values.shape[-1]
+        for (height, width), images in self.sizes.items():
+            size = (round(height * scale_h), round(width * scale_w))
+            part = labels_from_semantic_logits(
+                running[images, :, : (height + 3) // 4, : (width + 3) // 4], size,
+                post_cfg.upsample, post_cfg.refine_boundaries,
+            )
+            if labels is None:
+                labels = part.new_zeros((running.shape[0], *target_size))
+            labels[images, : size[0], : size[1]] = part
+        return labels
+
+
+@torch.no_grad()
+def tta_predict(model, pixel_values, tta_cfg, post_cfg, budget=None, pixel_mask=None):
+    """
+    Label maps for a batch averaged over all TTA views.
+
+    Args:
+        model: Mask2Former model
+        pixel_values: (B, 3, H, W) tensor on the model's device
+        tta_cfg: cfg.model.tta
+        post_cfg: cfg.model.post_processing
+        budget: ViewBudget to reuse across calls (created from `tta_cfg` if None)
+        pixel_mask: Optional (B, H, W) padding mask of the batch (see padding.py)
+
+    Returns:
+        (B, H, W) tensor of class ids at input resolution
+    """
+    budget = budget or ViewBudget.from_config(tta_cfg)
+    budget.calibrate(model, tuple(pixel_values.shape[1:]), pixel_values.device)
+    plan = TTAPlan(pixel_values, build_views(tta_cfg), budget, tta_cfg.size_multiple, pixel_mask)
+    running = None
+    for entries, inputs in plan:
+        running = plan.accumulate(running, entries, model(**inputs))
+    return plan.finalize(running, tuple(pixel_values.shape[-2:]), post_cfg)